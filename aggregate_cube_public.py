@@ -0,0 +1,184 @@
+'''This code builds the counts behind the figures of "GMM_figures.ipynb" once,
+instead of scanning every profile for each figure. Profiles are aggregated
+into a compact (sparse) cube with one entry for each combination of 1x1
+degree box (the grid of spatial_index_public.py), year, season-adjusted month
+(as in chla_months.txt: months in the southern hemisphere are shifted by six,
+so month 1 is January in the north and July in the south) and cluster; each
+entry holds the number of profiles and the count, sum and sum of squares of
+some per-profile variables (e.g. MLD and FSURF from
+profile_diagnostics_public.py), so means and standard deviations can be
+recovered. The cube is saved as a netCDF file with a fingerprint of the
+profiles it contains; when profiles are added to the end of the dataset, only
+the new ones are aggregated and merged in. Figures then come from cube_sum, a
+weighted histogram of the (small) list of entries, with the same bins as the
+plt.hist calls of the notebook. Counts over any grid aligned with whole
+degrees (e.g. the 5x5 degree boxes starting at 78S) are exact. This code was
+written by PhD student Rosalind Echols.
+'''
+
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+
+from spatial_index_public import grid_index
+
+#multipliers used to pack (cell, year, month, cluster) into one integer key
+n_years=10000
+n_months=13
+n_clusters_max=1024
+
+
+def season_month(month,lat):
+    #month of the year, shifted by six months south of the equator
+    month=np.asarray(month)
+    return np.where(np.asarray(lat)<0,np.where(month>=7,month-6,month+6),month)
+
+
+def profile_keys(juld,lat,lon,labels,resolution=1.):
+    '''Box (cell of grid_index, -1 if there is no position), year, season
+    adjusted month (0 if there is no date) and cluster (-1 if there is no
+    label) of each profile, packed into one integer.'''
+    juld=np.asarray(juld,dtype='datetime64[ns]')
+    cell=grid_index(lat,lon,resolution)['cell']
+    dated=~np.isnat(juld)
+    year=np.where(dated,juld.astype('datetime64[Y]').astype(int)+1970,0)
+    month=np.where(dated,season_month(juld.astype('datetime64[M]').astype(int)%12+1,lat),0)
+    labels=np.asarray(labels,dtype=float)
+    cluster=np.where(np.isfinite(labels),np.nan_to_num(labels),-1).astype(int)
+    return (((cell+1)*n_years+year)*n_months+month)*n_clusters_max+cluster+1
+
+
+def aggregate(keys,values):
+    '''Sparse cube of the profiles with the given keys: the distinct keys,
+    the number of profiles for each, and the count, sum and sum of squares of
+    each variable in values (a dictionary of per-profile arrays; nans are
+    left out).'''
+    entries,inverse=np.unique(keys,return_inverse=True)
+    cube={'KEY':entries,'COUNT':np.bincount(inverse,minlength=len(entries))}
+    for name,v in values.items():
+        v=np.asarray(v,dtype=float)
+        valid=~np.isnan(v)
+        w=np.where(valid,v,0.)
+        cube[name+'_N']=np.bincount(inverse,valid,len(entries))
+        cube[name+'_SUM']=np.bincount(inverse,w,len(entries))
+        cube[name+'_SUMSQ']=np.bincount(inverse,w*w,len(entries))
+    return cube
+
+
+def merge_cubes(cube,other):
+    #entries of both cubes, adding the sums of entries with the same key
+    keys=np.concatenate([cube['KEY'],other['KEY']])
+    entries,inverse=np.unique(keys,return_inverse=True)
+    merged={'KEY':entries}
+    for name in cube:
+        if name!='KEY':
+            merged[name]=np.bincount(inverse,np.concatenate([cube[name],other[name]]),len(entries))
+    merged['COUNT']=merged['COUNT'].astype(int)
+    return merged
+
+
+def fingerprint(md5,juld,lat,lon,labels):
+    #add the dates, positions and labels of some profiles to a running hash,
+    #profile by profile (so hashing the first profiles, then the rest, gives
+    #the same hash as all of them at once)
+    rows=np.column_stack([np.asarray(juld,dtype='datetime64[ns]').view('i8'),np.asarray(lat,dtype=float).view('i8'),
+                          np.asarray(lon,dtype=float).view('i8'),np.asarray(labels,dtype=float).view('i8')])
+    md5.update(np.ascontiguousarray(rows).tobytes())
+    return md5
+
+
+def load_cube(cube_file):
+    with xr.open_dataset(cube_file) as stored:
+        cube=dict((k,v.values) for k,v in stored.data_vars.items())
+        attrs=dict(stored.attrs)
+    return cube,attrs
+
+
+def save_cube(cube,attrs,cube_file):
+    xr.Dataset(dict((k,('entry',v)) for k,v in cube.items()),attrs=attrs).to_netcdf(cube_file)
+
+
+def build_cube(data,labels,variables=('MLD','FSURF'),resolution=1.,cube_file=None):
+    '''Cube of the profiles in data (JULD, LATITUDE, LONGITUDE and the
+    per-profile variables; those that are missing are skipped) with cluster
+    labels (e.g. new_labels). If cube_file holds a cube of the first profiles
+    of data (same dates, positions and labels), only the profiles after them
+    are aggregated and merged in; otherwise the cube is built from scratch.
+    The cube is saved to cube_file if given. Returns the cube and its
+    attributes (resolution, number of profiles, variables, fingerprint).'''
+    juld=np.asarray(data['JULD'],dtype='datetime64[ns]')
+    lat=np.asarray(data['LATITUDE'],dtype=float)
+    lon=np.asarray(data['LONGITUDE'],dtype=float)
+    labels=np.asarray(labels,dtype=float)
+    variables=[v for v in variables if v in data]
+    n=len(juld)
+
+    cube,attrs,start=None,None,0
+    md5=hashlib.md5()
+    if cube_file is not None and os.path.exists(cube_file):
+        cube,attrs=load_cube(cube_file)
+        start=int(attrs['n_profiles'])
+        same=(float(attrs['resolution'])==resolution and str(attrs['variables'])==','.join(variables)
+              and start<=n)
+        if same:
+            fingerprint(md5,juld[:start],lat[:start],lon[:start],labels[:start])
+            same=md5.hexdigest()==attrs['fingerprint']
+        if not same:
+            print('Stored cube is for other profiles, labels or settings; building it again')
+            cube,start=None,0
+            md5=hashlib.md5()
+
+    if start<n or cube is None:
+        print('Aggregating %d profiles' %(n-start))
+        values=dict((v,np.asarray(data[v],dtype=float)[start:]) for v in variables)
+        new=aggregate(profile_keys(juld[start:],lat[start:],lon[start:],labels[start:],resolution),values)
+        cube=new if cube is None else merge_cubes(cube,new)
+        fingerprint(md5,juld[start:],lat[start:],lon[start:],labels[start:])
+        attrs={'resolution':resolution,'n_profiles':n,'variables':','.join(variables),
+               'fingerprint':md5.hexdigest()}
+        if cube_file is not None:
+            save_cube(cube,attrs,cube_file)
+    return cube,attrs
+
+
+def cube_coords(cube,attrs):
+    '''Coordinates of each entry of the cube: 'lat' and 'lon' (centre of the
+    box, nan if there was no position), 'year', 'month' (season adjusted),
+    'calendar_month' and 'cluster' (-1 for no label).'''
+    resolution=float(attrs['resolution'])
+    key=np.array(cube['KEY'])
+    cluster=key%n_clusters_max-1
+    key//=n_clusters_max
+    month=key%n_months
+    key//=n_months
+    year=key%n_years
+    cell=key//n_years-1
+    n_lon=int(round(360/resolution))
+    lat=np.where(cell>=0,-90+resolution*(cell//n_lon+0.5),np.nan)
+    lon=np.where(cell>=0,-180+resolution*(cell%n_lon+0.5),np.nan)
+    #the hemisphere of the box gives the calendar month back
+    calendar=np.where((lat<0)&(month>0),(month+5)%12+1,month)
+    return {'lat':lat,'lon':lon,'year':year,'month':month,'calendar_month':calendar,'cluster':cluster}
+
+
+def cube_sum(cube,attrs,bins,value='COUNT',mask=None):
+    '''Sum of value (COUNT, or e.g. MLD_SUM) over the entries of the cube, in
+    the bins of one or more coordinates (a list of (name, edges) pairs, with
+    edges as for plt.hist or np.histogramdd). mask selects entries (a boolean
+    array, e.g. from cube_coords). Returns an array with one axis for each
+    coordinate.'''
+    coords=cube_coords(cube,attrs)
+    keep=np.ones(len(cube['KEY']),dtype=bool) if mask is None else np.asarray(mask)
+    sample=np.column_stack([coords[name][keep] for name,edges in bins])
+    counts,edges=np.histogramdd(sample,bins=[e for name,e in bins],weights=np.asarray(cube[value],dtype=float)[keep])
+    return counts
+
+
+def cube_mean(cube,attrs,bins,variable,mask=None):
+    #mean and standard deviation of a variable in each bin (nan where there are no values)
+    n=cube_sum(cube,attrs,bins,variable+'_N',mask)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean=cube_sum(cube,attrs,bins,variable+'_SUM',mask)/n
+        std=np.sqrt(np.maximum(cube_sum(cube,attrs,bins,variable+'_SUMSQ',mask)/n-mean**2,0))
+    return mean,std
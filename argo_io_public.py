@@ -0,0 +1,205 @@
+'''This code writes the interpolated profiles from
+"bgc_argo_data_process_public.py" to a netCDF file as they are produced,
+instead of holding arrays for every input file in memory and writing them all
+at the end. Accepted profiles are appended in batches along an unlimited time
+dimension, and after each batch the number of input files that have been
+processed (with the name of the last one and a hash of all of their names)
+is stored in the file as a checkpoint, so an interrupted run can be resumed from where it stopped. The
+output has the same variables and dimensions as the file written by
+export_data.
+
+The output can also be written compressed: the profile variables are stored
+as float32 (more than enough for the precision of the data) with zlib
+compression, in chunks of chunk_profiles profiles by chunk_depths depths, so
+reading a single profile only decompresses the few chunks along its depths,
+and a single depth across all profiles the chunks of that depth band. export_compressed does the same for a whole dataset, as netCDF4 or
+Zarr, and load_profiles opens either format lazily, reading only the
+variables that are used.
+
+For fine depth grids (e.g. 1 m to 1000 m), memmap_arrays keeps the output
+arrays of the in-memory (stream_output=False) path in memory-mapped files, so
+they do not have to fit in RAM. gsw and xarray are only imported by the
+functions that use them, so the writer starts quickly. This code was written
+by PhD student Rosalind Echols.
+'''
+
+import os
+import hashlib
+import numpy as np
+import netCDF4
+
+profile_vars=['TEMP','PSAL','DOXY','NITRATE','CHLA','PDENSITY','PRES','DEPTH']
+time_units='days since 1950-01-01 00:00:00'
+
+
+def open_output(sfpath,depths,resume=True,dtype='f8',complevel=0,chunk_profiles=1024,chunk_depths=10):
+    '''Open the output file for streaming. If resume is True and the file
+    already exists, it is opened for appending and the checkpoint it holds is
+    used; otherwise a new, empty file is created. With complevel>0 the
+    variables are compressed, and the profile variables are stored as dtype
+    (e.g. 'f4') in chunks of chunk_profiles profiles by chunk_depths depths.'''
+    if resume and os.path.exists(sfpath):
+        return netCDF4.Dataset(sfpath,'a')
+
+    nc=netCDF4.Dataset(sfpath,'w')
+    nc.createDimension('time',None)
+    nc.createDimension('z',len(depths))
+    #uncompressed output keeps the netCDF default chunks
+    profile_options,options={},{}
+    if complevel>0:
+        options={'zlib':True,'complevel':complevel,'shuffle':True,'chunksizes':(chunk_profiles,)}
+        profile_options=dict(options,chunksizes=(chunk_profiles,min(chunk_depths,len(depths))))
+    for var in profile_vars:
+        nc.createVariable(var,dtype,('time','z'),fill_value=np.nan,**profile_options)
+    for var in ['LATITUDE','LONGITUDE']:
+        nc.createVariable(var,'f8',('time',),fill_value=np.nan,**options)
+    juld=nc.createVariable('JULD','f8',('time',),fill_value=np.nan,**options)
+    juld.units=time_units
+    juld.calendar='standard'
+    #checkpoint: profiles written, input files processed and the last of them
+    nc.n_profiles=0
+    nc.n_files=0
+    nc.n_qc=0
+    nc.n_qc_pass=0
+    nc.last_file=''
+    nc.files_hash=''
+    nc.sync()
+    return nc
+
+
+def checkpoint(nc):
+    #(input files processed, last input file, files with a QC code, files passing QC)
+    return int(nc.n_files),nc.last_file,int(nc.n_qc),int(nc.n_qc_pass)
+
+
+def files_hash(files,md5=None):
+    #md5 of the names of a list of files, in order (continuing md5 if given)
+    md5=hashlib.md5() if md5 is None else md5
+    for f in files:
+        md5.update((f+'\n').encode())
+    return md5
+
+
+def resume_position(nc,all_files):
+    '''Number of files in all_files that were already processed in an earlier
+    run. Raises a ValueError if the file list does not match the checkpoint
+    (the number of files, the last of them and the hash of their names).'''
+    n_files,last_file=checkpoint(nc)[:2]
+    if n_files==0:
+        return 0
+    stored=getattr(nc,'files_hash','')
+    if n_files>len(all_files) or all_files[n_files-1]!=last_file or \
+            (stored and files_hash(all_files[:n_files]).hexdigest()!=stored):
+        raise ValueError('checkpoint (%d files, last file %s) does not match the file list'
+                         %(n_files,last_file))
+    return n_files
+
+
+def append_profiles(nc,profiles,n_files,last_file,n_qc,n_qc_pass,processed_hash=''):
+    '''Append a batch of interpolated profiles (dictionaries as returned by
+    process_files) and move the checkpoint to n_files input files processed
+    (processed_hash is the files_hash hexdigest of their names).
+    Rows are written from n_profiles onwards, so rows left behind by a run
+    that stopped before its checkpoint was updated are overwritten.'''
+    start=int(nc.n_profiles)
+    if len(profiles)>0:
+        import gsw
+        stop=start+len(profiles)
+        batch={}
+        for var in ['TEMP','PSAL','DOXY','NITRATE','CHLA','PRES','DEPTH']:
+            batch[var]=np.array([p[var] for p in profiles])
+        batch['PDENSITY']=gsw.rho(batch['PSAL'],batch['TEMP'],0)
+        for var in profile_vars:
+            nc[var][start:stop,:]=batch[var]
+        for var in ['LATITUDE','LONGITUDE']:
+            nc[var][start:stop]=np.array([p[var] for p in profiles],dtype=float)
+        juld=np.array([p['JULD'] for p in profiles],dtype='datetime64[ns]')
+        nc['JULD'][start:stop]=(juld-np.datetime64('1950-01-01'))/np.timedelta64(1,'D')
+        start=stop
+
+    #the data are flushed before the checkpoint moves on
+    nc.sync()
+    nc.n_profiles=start
+    nc.n_files=n_files
+    nc.n_qc=n_qc
+    nc.n_qc_pass=n_qc_pass
+    nc.last_file=last_file
+    nc.files_hash=processed_hash
+    nc.sync()
+    return start
+
+
+def output_encoding(ds,complevel=4,chunk_profiles=1024,engine='netcdf4',chunk_depths=10):
+    '''Encoding for writing a dataset of profiles with to_netcdf or to_zarr:
+    float32 (time, z) variables in chunks of chunk_profiles profiles by
+    chunk_depths depths, and compression (zlib for netCDF4, the Zarr default
+    compressor for Zarr).'''
+    size={'time':chunk_profiles,'z':chunk_depths}
+    encoding={}
+    for var in ds.data_vars:
+        chunks=tuple(min(size.get(dim,n),n) for dim,n in zip(ds[var].dims,ds[var].shape))
+        encoding[var]={}
+        if ds[var].dims==('time','z'):
+            encoding[var]['dtype']='float32'
+        if engine=='zarr':
+            encoding[var]['chunks']=chunks
+        else:
+            encoding[var].update(zlib=True,complevel=complevel,shuffle=True,chunksizes=chunks)
+    return encoding
+
+
+def export_compressed(ds,sfpath,complevel=4,chunk_profiles=1024,chunk_depths=10):
+    '''Write a dataset of profiles (e.g. from export_data) compressed, as
+    Zarr if sfpath ends in ".zarr" (this needs the zarr package) and as
+    netCDF4 otherwise.'''
+    if sfpath.endswith('.zarr'):
+        ds.to_zarr(sfpath,mode='w',encoding=output_encoding(ds,complevel,chunk_profiles,'zarr',chunk_depths))
+    else:
+        ds.to_netcdf(sfpath,encoding=output_encoding(ds,complevel,chunk_profiles,chunk_depths=chunk_depths))
+    return sfpath
+
+
+def load_profiles(sfpath,variables=None,chunks=None):
+    '''Open an output file (netCDF or Zarr) without reading any data. Only the
+    variables listed in variables (all of them by default) are included, and
+    each one is read from the file the first time its values are used. chunks
+    is passed on to xarray (it needs dask), e.g. {'time':10000} to work
+    through the profiles in blocks. Data stored as float32 are returned as
+    float32.'''
+    import xarray as xr
+    engine='zarr' if sfpath.rstrip('/').endswith('.zarr') else None
+    if variables is not None:
+        with xr.open_dataset(sfpath,engine=engine) as ds:
+            names=list(ds.variables)
+        drop=[v for v in names if v not in variables and v not in ds.dims]
+    else:
+        drop=None
+    return xr.open_dataset(sfpath,engine=engine,chunks=chunks,drop_variables=drop)
+
+
+def memmap_arrays(scratch_dir,n_profiles,n_depths,variables):
+    '''Arrays for the output of n_profiles profiles, backed by .npy files in
+    scratch_dir instead of memory: (n_profiles, n_depths) arrays for
+    variables, and (n_profiles,) arrays for LATITUDE, LONGITUDE, JULD and QC.
+    Arrays are filled with nans (NaT for JULD).'''
+    os.makedirs(scratch_dir,exist_ok=True)
+    arrays={}
+    shapes=[(var,(n_profiles,n_depths),'f8') for var in variables]
+    shapes+=[(var,(n_profiles,),'f8') for var in ['LATITUDE','LONGITUDE','QC']]
+    shapes+=[('JULD',(n_profiles,),'datetime64[ns]')]
+    for var,shape,dtype in shapes:
+        arrays[var]=np.lib.format.open_memmap(os.path.join(scratch_dir,var+'.npy'),mode='w+',
+                                              dtype=dtype,shape=shape)
+        arrays[var][:]=np.datetime64('NaT') if dtype.startswith('datetime') else np.nan
+    return arrays
+
+
+def potential_density(psal,temp,out=None,chunk=10000):
+    #gsw.rho(psal,temp,0) computed chunk rows at a time, into out if given
+    #(e.g. a memory-mapped array)
+    import gsw
+    if out is None:
+        out=np.empty(psal.shape)
+    for start in range(0,len(psal),chunk):
+        out[start:start+chunk]=gsw.rho(psal[start:start+chunk],temp[start:start+chunk],0)
+    return out
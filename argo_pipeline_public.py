@@ -0,0 +1,160 @@
+'''This code runs the steps of the data pipeline from the command line, with
+the paths given as arguments instead of edited into each program:
+
+    python argo_pipeline_public.py download /Volumes/RE_DATA/
+    python argo_pipeline_public.py float-list /Volumes/RE_DATA/SyntheticBioArgo/ floats.txt
+    python argo_pipeline_public.py process /Volumes/RE_DATA/SyntheticBioArgo/ out/ floats.txt
+    python argo_pipeline_public.py night gmm_output.nc night_flags.nc
+
+Each step calls the function of its program (download, make_float_list,
+process_all and night_file_flags), which is only imported when that step is
+run; the programs themselves only import xarray, scipy, gsw and skyfield
+inside the functions that use them. So --help and the light steps start
+without loading them. startup_benchmark (the "startup" step) times --help and
+the import of each program in new processes and lists the heavy packages
+each one loads. This code was written by PhD student Rosalind Echols.
+'''
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+here=os.path.dirname(os.path.abspath(__file__))
+
+#packages that take a large part of a second to import; none of them should
+#be loaded by --help or by importing the programs
+heavy_packages=['xarray','scipy','gsw','skyfield','pandas','matplotlib','sklearn','lmfit']
+
+#programs of the steps
+stage_modules={'download':'bgc_argo_download_public','float-list':'bgc_argo_float_list_public',
+               'process':'bgc_argo_data_process_public','night':'night_time_public'}
+
+
+def run_download(args):
+    from bgc_argo_download_public import download
+    download(os.path.join(args.data_dir,''),delta_sync=args.delta_sync,connections=args.connections)
+
+
+def run_float_list(args):
+    from bgc_argo_float_list_public import make_float_list
+    make_float_list(os.path.join(args.path,''),args.save_file,args.keyword,fast_probe=not args.slow_probe)
+
+
+def run_process(args):
+    from bgc_argo_data_process_public import process_all
+    os.makedirs(args.out_dir,exist_ok=True)
+    process_all(os.path.join(args.path,''),os.path.join(args.out_dir,''),args.chl_file,
+                make_file_list=not args.file_list,save_file=args.save_file,catalog_file=args.catalog,
+                full_refresh=args.full_refresh,max_depth=args.max_depth,grid_spacing=args.grid_spacing,
+                workers=args.workers,stream_output=not args.in_memory,resume=not args.restart,
+                batch_size=args.batch_size,compressed_output=args.compressed,cache_file=args.cache,
+                archive_file=args.archive,rebuild_archive=args.rebuild_archive,scratch_dir=args.scratch_dir,
+                profile_file=args.profile)
+
+
+def run_night(args):
+    from night_time_public import night_file_flags
+    night_file_flags(args.data_file,args.night_file,args.ephemeris,args.workers)
+
+
+def run_startup(args):
+    times,ok=startup_benchmark(args.repeats,args.limit)
+    if not ok:
+        sys.exit(1)
+
+
+def loaded_packages(command):
+    #top level packages imported by command (from python -X importtime)
+    result=subprocess.run([command[0],'-X','importtime']+command[1:],cwd=here,capture_output=True,text=True)
+    names=set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            names.add(line.rsplit('|',1)[1].strip().split('.')[0])
+    return names
+
+
+def startup_benchmark(repeats=5,limit=1.,python=sys.executable):
+    '''Time (best of repeats, each in a new python process) the interpreter
+    on its own, --help of this program and the import of the program of each
+    step, and list the heavy packages each one imports. Returns the times and
+    whether --help and the imports all took less than limit seconds without
+    importing a heavy package.'''
+    commands={'python':[python,'-c','pass'],'--help':[python,os.path.join(here,'argo_pipeline_public.py'),'--help']}
+    for stage,module in stage_modules.items():
+        commands[stage]=[python,'-c','import '+module]
+    times={}
+    ok=True
+    for name,command in commands.items():
+        best=float('inf')
+        for n in range(repeats):
+            start=time.perf_counter()
+            subprocess.run(command,cwd=here,check=True,stdout=subprocess.DEVNULL)
+            best=min(best,time.perf_counter()-start)
+        heavy=sorted(loaded_packages(command)&set(heavy_packages))
+        times[name]={'seconds':best,'heavy':heavy}
+        slow=name!='python' and (best>limit or len(heavy)>0)
+        ok=ok and not slow
+        print('%-12s %7.3f s  %s%s' %(name,best,','.join(heavy) if heavy else '-','  SLOW' if slow else ''))
+    return times,ok
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(prog='argo_pipeline_public.py',
+                                   description='Download, list, process and flag BGC Argo profiles.')
+    steps=parser.add_subparsers(dest='step',required=True)
+
+    p=steps.add_parser('download',help='download the synthetic profiles from the GDAC')
+    p.add_argument('data_dir',help='storage location (the profiles go in data_dir/SyntheticBioArgo/)')
+    p.add_argument('--delta-sync',action='store_true',help='only download new or reprocessed profiles')
+    p.add_argument('--connections',type=int,default=8,help='number of FTP connections')
+    p.set_defaults(func=run_download)
+
+    p=steps.add_parser('float-list',help='list the floats with a variable')
+    p.add_argument('path',help='folder of the profile files')
+    p.add_argument('save_file',help='file to write the float numbers to')
+    p.add_argument('--keyword',default='CHLA',help='variable the files must have')
+    p.add_argument('--slow-probe',action='store_true',help='open each file with xarray instead of reading headers')
+    p.set_defaults(func=run_float_list)
+
+    p=steps.add_parser('process',help='QC and interpolate the profiles into one file')
+    p.add_argument('path',help='folder of the profile files')
+    p.add_argument('out_dir',help='folder for the output file and report')
+    p.add_argument('chl_file',help='float list from float-list (or a file list, with --file-list)')
+    p.add_argument('--file-list',action='store_true',help='chl_file is a file list saved by an earlier run')
+    p.add_argument('--save-file',help='file to save the file list to')
+    p.add_argument('--catalog',help='catalog of the data directory (file_catalog_public.py)')
+    p.add_argument('--full-refresh',action='store_true',help='check the size and time of every file in the catalog')
+    p.add_argument('--max-depth',type=float,default=250)
+    p.add_argument('--grid-spacing',type=float,default=5)
+    p.add_argument('--workers',type=int,help='worker processes (default: number of CPUs)')
+    p.add_argument('--in-memory',action='store_true',help='hold the output in memory instead of streaming it')
+    p.add_argument('--restart',action='store_true',help='start the output over instead of resuming')
+    p.add_argument('--batch-size',type=int,default=1000)
+    p.add_argument('--compressed',action='store_true',help='write compressed float32 instead of float64')
+    p.add_argument('--cache',help='profile cache file (profile_cache_public.py)')
+    p.add_argument('--archive',help='raw profile archive file (ragged_archive_public.py)')
+    p.add_argument('--rebuild-archive',action='store_true')
+    p.add_argument('--scratch-dir',help='folder for memory-mapped arrays (with --in-memory)')
+    p.add_argument('--profile',help='file for cProfile statistics of the run')
+    p.set_defaults(func=run_process)
+
+    p=steps.add_parser('night',help='flag night time profiles')
+    p.add_argument('data_file',help='netCDF file with LATITUDE, LONGITUDE and JULD')
+    p.add_argument('night_file',help='file to keep the NIGHT flags in')
+    p.add_argument('--ephemeris',help='skyfield ephemeris (e.g. de421.bsp); without it the fast method is used')
+    p.add_argument('--workers',type=int,default=1)
+    p.set_defaults(func=run_night)
+
+    p=steps.add_parser('startup',help='time --help and the import of each step')
+    p.add_argument('--repeats',type=int,default=5)
+    p.add_argument('--limit',type=float,default=1.,help='seconds allowed for --help and each import')
+    p.set_defaults(func=run_startup)
+
+    args=parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
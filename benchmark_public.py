@@ -0,0 +1,212 @@
+'''This code times the stages of the data processing on synthetic archives of
+1,000, 10,000 and 100,000 profiles made by "synthetic_argo_public.py", so the
+performance of the processing can be measured (and compared between
+versions) without the full local copy of the GDAC. For each archive it times
+the float list, the file list (find_dups and the file catalog), the QC
+(quality_control and dataset_qc), the interpolation (interpolate_data and
+interpolate_variables), the output (export_data and the streaming writer)
+and the whole processing run, and checks that the QC codes are the ones the
+synthetic profiles were made to give. Results are appended to a JSON lines
+file together with the git version, and compare_runs reports the stages that
+have become slower since the previous version. This code was written by PhD
+student Rosalind Echols.
+'''
+
+import os
+import json
+import time
+import subprocess
+import numpy as np
+import xarray as xr
+import gsw
+
+from synthetic_argo_public import make_archive, read_expected
+from bgc_argo_float_list_public import float_list_fast
+from file_catalog_public import open_catalog, refresh_catalog, best_files
+from profile_engine_public import benchmark_qc, benchmark_interpolation
+from argo_io_public import open_output, append_profiles
+import bgc_argo_data_process_public as process
+
+depths=np.arange(0,251,5)
+var_all=['TEMP','PSAL','DOXY','NITRATE','CHLA']
+
+
+def git_version():
+    #short hash of the current commit (with a + if there are local changes)
+    here=os.path.dirname(os.path.abspath(__file__))
+    try:
+        rev=subprocess.run(['git','rev-parse','--short','HEAD'],cwd=here,capture_output=True,
+                           text=True,check=True).stdout.strip()
+        dirty=subprocess.run(['git','status','--porcelain','--untracked-files=no'],cwd=here,
+                             capture_output=True,text=True).stdout.strip()
+        return rev+('+' if dirty else '')
+    except (OSError,subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def timed_call(func,*args,**kwargs):
+    start=time.perf_counter()
+    result=func(*args,**kwargs)
+    return result,time.perf_counter()-start
+
+
+def archive(work_dir,size,workers=None):
+    #synthetic archive of size profiles, made once and reused
+    path=os.path.join(work_dir,'synthetic_%d' %size)+'/'
+    if not os.path.exists(os.path.join(path,'expected.csv')):
+        print('Making synthetic archive of %d profiles' %size)
+        make_archive(path,size,workers=workers)
+    return path
+
+
+def load_sample(files,sample):
+    '''Load up to sample profile files into memory, adding the DEPTH variable
+    used by interpolate_data. Returns all of the datasets (for the QC) and
+    those that pass QC (for the interpolation).'''
+    datasets=[]
+    passed=[]
+    for f in files[:sample]:
+        with xr.open_dataset(f) as data:
+            if 'CHLA' not in data.keys() or np.isnan(data['CHLA']).all():
+                continue
+            data=data.load()
+        datasets.append(data)
+        if process.dataset_qc(data,'CHLA')==0:
+            data=data.copy()
+            data['DEPTH']=('N_LEVELS',abs(gsw.z_from_p(data['PRES'].values[0],data['LATITUDE'].values[0])))
+            passed.append(data)
+    return datasets,passed
+
+
+def benchmark_archive(path,size,workers=None,sample=2000,dups_limit=10000):
+    '''Time each stage on one synthetic archive. Per-profile stages are timed
+    on the first sample files, and find_dups (which takes time proportional to
+    the square of the number of files) on the first dups_limit files; rates
+    are in items (floats, files or profiles) per second.'''
+    timings=[]
+    def add(stage,seconds,items):
+        timings.append({'size':size,'stage':stage,'seconds':seconds,'items':items,
+                        'rate':items/seconds if seconds>0 else float('inf')})
+        print('  %-24s %9.3f s  %12.1f /s' %(stage,seconds,timings[-1]['rate']))
+
+    floats,seconds=timed_call(float_list_fast,path,'^S',"CHLA",workers=workers)
+    add('float_list_fast',seconds,len(floats))
+
+    names=sorted(n for n in os.listdir(path) if n.endswith('.nc') and not n.endswith('D.nc'))
+    files,seconds=timed_call(process.find_dups,[path+n for n in names[:dups_limit]])
+    add('find_dups',seconds,len(names[:dups_limit]))
+    catalog_file=os.path.join(path,'..','catalog_%d.sqlite' %size)
+    if os.path.exists(catalog_file):
+        os.remove(catalog_file)
+    catalog=open_catalog(catalog_file)
+    start=time.perf_counter()
+    refresh_catalog(catalog,path)
+    all_files=best_files(catalog,path,floats)
+    add('catalog',time.perf_counter()-start,len(names))
+    catalog.close()
+
+    datasets,passed=load_sample(all_files,sample)
+    qc_times,agree=benchmark_qc(datasets,'CHLA')
+    for stage,seconds in qc_times.items():
+        add(stage,seconds,len(datasets))
+    t_original,t_batch,diff=benchmark_interpolation(passed,depths,var_all)
+    add('interpolate_data',t_original,len(passed))
+    add('interpolate_variables',t_batch,len(passed))
+
+    results,seconds=timed_call(lambda: list(process.process_files(all_files,depths,var_all,workers=workers)))
+    add('process_files',seconds,len(all_files))
+
+    #check the QC codes against the kinds of profiles that were made
+    expected=read_expected(path)
+    mismatched=0
+    codes={}
+    for f,(qc,profile) in zip(all_files,results):
+        kind,qc_expected=expected[os.path.basename(f)]
+        codes[qc]=codes.get(qc,0)+1
+        if kind=='spike':
+            mismatched+=not (qc==0 and profile is None)
+        else:
+            mismatched+=qc!=qc_expected or (qc==0 and profile is None)
+
+    #every QC code of the kinds that were made should have come up
+    missing=sorted(set(q for k,q in expected.values() if q is not None)-set(codes))
+
+    good=[profile for qc,profile in results if qc==0 and profile is not None]
+    all_data=dict((var,np.array([p[var] for p in good])) for var in var_all+['PRES','DEPTH','LATITUDE','LONGITUDE','JULD'])
+    all_data['PDENSITY']=gsw.rho(all_data['PSAL'],all_data['TEMP'],0)
+    out_file=os.path.join(path,'..','output_%d.nc' %size)
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    ds,seconds=timed_call(process.export_data,all_data,var_all+['PDENSITY'],out_file)
+    add('export_data',seconds,len(good))
+    os.remove(out_file)
+    start=time.perf_counter()
+    out=open_output(out_file,depths,resume=False)
+    for n in range(0,len(good),1000):
+        append_profiles(out,good[n:n+1000],n,'',0,0)
+    out.close()
+    add('append_profiles',time.perf_counter()-start,len(good))
+
+    print('QC codes agree: %s, largest interpolation differences: %s, unexpected results: %d'
+          %(agree,diff,mismatched))
+    print('profiles by QC code: %s, codes never produced: %s'
+          %(', '.join('%s: %d' %(q,codes[q]) for q in sorted(codes,key=lambda q: -1 if q is None else q)),missing))
+    return timings,agree and mismatched==0 and len(missing)==0
+
+
+def run_benchmarks(work_dir,sizes=(1000,10000,100000),workers=None,sample=2000,
+                   results_file='benchmark_results.jsonl'):
+    '''Run benchmark_archive for each archive size and append the timings to
+    results_file (in work_dir) with the git version and the date.'''
+    os.makedirs(work_dir,exist_ok=True)
+    version=git_version()
+    stamp=time.strftime('%Y-%m-%dT%H:%M:%S')
+    all_timings=[]
+    for size in sizes:
+        path=archive(work_dir,size,workers)
+        print('Benchmark, %d profiles' %size)
+        timings,ok=benchmark_archive(path,size,workers,sample)
+        if not ok:
+            print('WARNING: results do not match the synthetic profiles')
+        with open(os.path.join(work_dir,results_file),'a') as fp:
+            for t in timings:
+                t.update(version=version,date=stamp,correct=ok)
+                fp.write(json.dumps(t)+'\n')
+        all_timings+=timings
+    return all_timings
+
+
+def compare_runs(work_dir,results_file='benchmark_results.jsonl',slowdown=1.25):
+    '''Compare the latest version in results_file with the version before it
+    and print the stages (and archive sizes) whose rate has dropped by more
+    than a factor of slowdown. Returns the list of slower stages.'''
+    with open(os.path.join(work_dir,results_file)) as fp:
+        rows=[json.loads(line) for line in fp if line.strip()]
+    versions=[]
+    for row in rows:
+        key=(row['version'],row['date'])
+        if key not in versions:
+            versions.append(key)
+    if len(versions)<2:
+        print('Need at least two runs to compare')
+        return []
+    rates={}
+    for row in rows:
+        rates[(row['version'],row['date'],row['size'],row['stage'])]=row['rate']
+    new,old=versions[-1],versions[-2]
+    slower=[]
+    for (version,date,size,stage),rate in rates.items():
+        if (version,date)!=new or old+(size,stage) not in rates:
+            continue
+        before=rates[old+(size,stage)]
+        if rate*slowdown<before:
+            slower.append((size,stage,before,rate))
+            print('%s at %d profiles: %.1f/s -> %.1f/s' %(stage,size,before,rate))
+    print('%d stages slower than %s (%s)' %(len(slower),old[0],old[1]))
+    return slower
+
+
+if __name__ == '__main__':
+    work_dir='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/benchmark/'
+    run_benchmarks(work_dir,sizes=(1000,10000,100000),workers=os.cpu_count())
+    compare_runs(work_dir)
@@ -8,11 +8,14 @@ Rosalind Echols.
 import numpy as np
 import os
 import re
-import xarray as xr
-from scipy import ndimage
-from scipy.interpolate import interp1d
-import gsw
-import matplotlib.pyplot as plt
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from file_catalog_public import open_catalog, refresh_catalog, best_files
+from profile_engine_public import dataset_qc, qc_codes, pad_profiles, interpolate_variables, make_grid
+from argo_io_public import open_output, resume_position, files_hash, append_profiles, export_compressed, memmap_arrays, potential_density
+from profile_cache_public import config_key, open_cache, cached_results, close_cache
+from pipeline_metrics_public import new_metrics, timed, tally, skip, merge, record_result, print_report, save_report, start_profiler, stop_profiler
+from ragged_archive_public import status_codes, create_archive, append_rows, finish_archive, open_archive, gather, close_archive
 
 
 ''' Steps to prepare data for machine learning application described in Echols,
@@ -30,7 +33,7 @@ Rocap, and Riser ().
 
 '''
     
-def file_list(chl_file):
+def file_list(chl_file,path):
     with open(chl_file) as numbers:
         floats=numbers.read()
         float_numbers=floats.split('\n')
@@ -163,6 +166,8 @@ def quality_control(data,variable):
     return qc, data
 
 def interpolate_data(data,var,depths,mask):
+    from scipy import ndimage
+    from scipy.interpolate import interp1d
     if len(data[var].values[0,mask])<2:
         interp_data=np.nan*np.ones(len(depths))
         return(interp_data)
@@ -175,7 +180,7 @@ def interpolate_data(data,var,depths,mask):
         #subtract smallest deepwater value to account for other fluorescence contributions, Carranza et al 2018
         #except in the Black Sea, where deep sea red fluorescence is a known issue
         if 27.5<data['LONGITUDE'].values[0]<42.5 and 41<data['LATITUDE'].values[0]<47:
-            pass
+            interp_data = chl
         else:
             interp_data = chl-np.nanmin(chl[-10:])
         #remove infinite zero values (artifact of extrapolation)
@@ -197,7 +202,7 @@ def interpolate_data(data,var,depths,mask):
     return interp_data
 
 
-def export_data(int_data,all_vars,sfpath):
+def export_data(int_data,all_vars,sfpath,compress=False):
     '''Example of formatting for dictionary to dataset
         d = {'t': {'dims': ('t'), 'data': t},
              'a': {'dims': ('t'), 'data': x},
@@ -210,6 +215,7 @@ def export_data(int_data,all_vars,sfpath):
          'data_vars': {'a': {'dims': 't', 'data': x, },
                        'b': {'dims': 't', 'data': y}}}
     '''
+    import xarray as xr
     
     dict_data={}
     for v in all_vars:
@@ -224,68 +230,16 @@ def export_data(int_data,all_vars,sfpath):
     ds=xr.Dataset.from_dict(dict_data)
     print(ds.keys())
     
-    ds.to_netcdf(sfpath)
+    #compressed float32 output (netCDF4, or Zarr if sfpath ends in .zarr);
+    #see argo_io_public.py
+    if compress:
+        export_compressed(ds,sfpath)
+    else:
+        ds.to_netcdf(sfpath)
     
     return ds
 
 
-###MAIN FILE###
-#filepath for float data:
-path='/Volumes/RE_DATA/SyntheticBioArgo/'
-
-sfpath='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/Argo_Merged/CHL_Data/'
-
-#make a list of all of the files with chlorophyll data in them. If you do
-#this step once and want to re-run the code later, set make_file_list to 
-#False so you don't have to repeat this step
-make_file_list=True
-
-if make_file_list==True:
-    #filename and location from bgc_argo_float_list_public.py
-    chl_file='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/argo_CHL_float_list_synthetic.txt'
-    print('Make file list')
-    #This routine checks to make sure that profiles have a chlorophyll variable
-    #in them and that realtime and delayed mode profiles are not duplicated in the analysis
-    all_files=file_list(chl_file)
-    
-    print('Save files')   
-    save_file='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/argo_CHL_file_list_synthetic.txt'
-    files = open(save_file,'w')
-    
-#for f in file_list:
-    for f in all_files:
-        files.write(f)
-        files.write('\n')
-    
-    print('Close file list')
-    files.close()
-
-else:
-    chl_file='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/argo_CHL_file_list_synthetic.txt'
-    print('Open file list')
-    with open(chl_file) as numbers:
-        files=numbers.read()
-        all_files=files.split('\n')
-
-print(len(all_files))
-print('Initialize arrays')
-all_data={}
-depths=np.arange(0,251,5)
-var_all=['TEMP','PSAL','DOXY','NITRATE','CHLA']
-#want to initialize these with nans, so that if not all the profiles end
-#up being used, the blank ones can be easily identified and removed. This
-#is more efficient than appending tens of thousands of values to empty
-#arrays.
-for var in var_all:
-    all_data[var]=np.nan*np.ones((len(all_files),len(depths)))
-for var in ['LATITUDE','LONGITUDE']:
-    all_data[var]=np.nan*np.ones(len(all_files))
-all_data['JULD']=np.empty(len(all_files),dtype='datetime64[ns]')
-all_data['PRES']=np.nan*np.ones((len(all_files),len(depths)))
-all_data['DEPTH']=np.nan*np.ones((len(all_files),len(depths)))
-#keep track of QC for comparing various effects
-all_data['QC']=np.nan*np.ones(len(all_files))
-
 #because some files have adjusted values and some do not, we need to be able
 #to check for both and then ultimately store them in a single variable name
 #for analysis purposes. 
@@ -293,27 +247,10 @@ key_dict={'TEMP':'TEMP','PSAL':'PSAL','DOXY':'DOXY','NITRATE':'NITRATE','CHLA':'
           'TEMP_ADJUSTED':'TEMP','PSAL_ADJUSTED':'PSAL','DOXY_ADJUSTED':'DOXY',
           'NITRATE_ADJUSTED':'NITRATE','CHLA_ADJUSTED':'CHLA'}
 
-count=0
-qc_all=[]
-qc_good=[]
-
-print('Import data')
-for f in all_files:
-    #defective file that makes the program crash
-    if f=='/Volumes/RE_DATA/SyntheticBioArgo/SR5904855_122.nc':
-        continue
-    #print counts to keep track of progress
-    if count%1000==0:
-        print('Number of completed files: ', count)
-    data=xr.open_dataset(f) 
-    
-    #even if a float collected CHLA data at some point, not all files for
-    #that float may have CHLA. Skip those. 
-    if 'CHLA' not in data.keys():
-        continue
-    elif np.isnan(data['CHLA']).all():
-        continue
-    
+#defective files that make the program crash
+skip_files={'/Volumes/RE_DATA/SyntheticBioArgo/SR5904855_122.nc'}
+
+def select_variables(data,var_all):
     var_list=[]
     #need to use adjusted data if possible, but if not, use the regular
     for var in var_all:
@@ -321,7 +258,6 @@ for f in all_files:
             for i in range(0,len(data['PRES'])):
                 #need to check to see if adjusted data is all nans before using
                 if ~np.isnan(data[var+'_ADJUSTED'][i]).all():
-                   # print(var,i)
                     var_list.append(var+'_ADJUSTED')
                     break
                 elif np.isnan(data[var+'_ADJUSTED'][i]).all() and i==len(data['PRES'])-1:
@@ -331,63 +267,610 @@ for f in all_files:
             pass
         else:
             var_list.append(var)
-                 
-    qc,data=quality_control(data,'CHLA')
-    qc_all.append(qc)
-    if qc!=0:
-        continue    
-    
-    qc_good.append(qc)
-    all_data['QC'][count]=qc
-    
-    data['DEPTH']=abs(gsw.z_from_p(data['PRES'].values[0],data['LATITUDE'].values[0]))
 
+    return var_list
+
+def load_profile(f,var_all,metrics=None):
+    '''Open a profile file, choose the adjusted or unadjusted variables and run
+    the QC checks. Returns the QC code (None if the file was skipped before QC
+    because it has no CHLA data) and, for profiles that pass, a dictionary
+    with the raw profile data needed for the interpolation. If metrics is
+    given, the time spent in each step and the rejection branch are recorded
+    (pipeline_metrics_public.py).'''
+    import gsw
+    import xarray as xr
+    if f in skip_files:
+        skip(metrics,f,'skip_file')
+        return None,None
+
+    with timed(metrics,'open'):
+        data=xr.open_dataset(f)
+        #even if a float collected CHLA data at some point, not all files for
+        #that float may have CHLA. Skip those. 
+        if 'CHLA' not in data.keys():
+            no_chla='no_chla_variable'
+        elif np.isnan(data['CHLA']).all():
+            no_chla='all_nan_chla'
+        else:
+            no_chla=None
+    with data:
+        if no_chla is not None:
+            skip(metrics,f,no_chla)
+            return None,None
+
+        with timed(metrics,'select'):
+            var_list=select_variables(data,var_all)
+
+        #dataset_qc gives the same QC codes as quality_control, using array
+        #operations instead of loops over the data points
+        with timed(metrics,'qc'):
+            qc=dataset_qc(data,'CHLA')
+        if qc!=0:
+            tally(metrics,'rejected','qc_%d' %qc)
+            return qc,None
+
+        with timed(metrics,'gsw'):
+            raw={'DEPTH':abs(gsw.z_from_p(data['PRES'].values[0],data['LATITUDE'].values[0]))}
+        with timed(metrics,'open'):
+            for var in ['LATITUDE','LONGITUDE','JULD']:
+                raw[var]=data[var].values[0]
+            raw['variables']=dict((key_dict[var],data[var].values[0]) for var in var_list)
+        #interpolate_data only median filters the unadjusted CHLA
+        raw['filtered']='CHLA' in var_list
+
+    return qc,raw
+
+def finish_profiles(stack,depth,lat,lon,juld,filtered,depths,var_all,metrics=None):
+    '''Interpolate stacks of profiles that passed QC (a dictionary of padded
+    2D arrays for var_all, and the matching depths) onto the depth grid and run
+    the post-interpolation check. Returns a list with the interpolated profile
+    dictionary, or None if the check failed, for each row.'''
+    import gsw
+    with timed(metrics,'interp'):
+        interp=interpolate_variables(stack,depth,depths,lat,lon,filtered=filtered)
 
-    for var in var_list:
-        #need to only use the real values because of the weird synthetic profiles
-        mask=[i for i,j in enumerate(data[var].values[0]) if ~np.isnan(j)]
-        all_data[key_dict[var]][count]=interpolate_data(data,var,depths,mask)
-    
     #do one more QC check after interpolation to make sure there are no extreme problems:
-    if all(~np.isnan(all_data['CHLA'][count])) and abs(all_data['CHLA'][count,50])<=0.5 and \
-                abs(all_data['CHLA'][count,-1])<=0.5:
-        if any(np.isinf(all_data['CHLA'][count])) or any(abs(all_data['CHLA'][count])>50) or \
-                    any(all_data['CHLA'][count]<-0.02):
-            bad=True
-        else:
-            bad=False
+    #(values at 250 m, or the deepest level if the grid is shallower, and at the bottom)
+    chla=interp['CHLA']
+    level=min(int(np.searchsorted(depths,250)),len(depths)-1)
+    with timed(metrics,'post_check'), np.errstate(invalid='ignore'):
+        ok=(~np.isnan(chla)).all(axis=1)&(abs(chla[:,level])<=0.5)&(abs(chla[:,-1])<=0.5)
+        ok&=~(np.isinf(chla).any(axis=1)|(abs(chla)>50).any(axis=1)|(chla<-0.02).any(axis=1))
+    tally(metrics,'rejected','post_check',int((~ok).sum()))
+
+    with timed(metrics,'gsw'):
+        pres=gsw.p_from_z(-1*np.array(depths,dtype=float)[None,:],lat[:,None])
+    profiles=[]
+    for i in range(len(lat)):
+        if not ok[i]:
+            profiles.append(None)
+            continue
+        profile=dict((var,interp[var][i]) for var in var_all)
+        profile['DEPTH']=np.array(depths,dtype=float)
+        profile['PRES']=pres[i]
+        profile['LATITUDE']=lat[i]
+        profile['LONGITUDE']=lon[i]
+        profile['JULD']=juld[i]
+        profiles.append(profile)
+
+    return profiles
+
+def process_chunk(files,depths,var_all,metrics=None):
+    '''QC and interpolate a list of profile files. Returns a list with the QC
+    code and a dictionary of the interpolated profile and its position and
+    time for each file; the dictionary is None if the profile was rejected.
+    All of the profiles that pass QC are interpolated together.'''
+    loaded=[load_profile(f,var_all,metrics) for f in files]
+    results=[(qc,None) for qc,raw in loaded]
+    good=[n for n,(qc,raw) in enumerate(loaded) if raw is not None]
+    if len(good)==0:
+        return results
+
+    raws=[loaded[n][1] for n in good]
+    with timed(metrics,'interp'):
+        n_levels=max(len(r['DEPTH']) for r in raws)
+        stack={}
+        for var in var_all:
+            stack[var]=pad_profiles([r['variables'].get(var,[]) for r in raws],n_levels=n_levels)
+        depth=pad_profiles([r['DEPTH'] for r in raws],n_levels=n_levels)
+    lat=np.array([r['LATITUDE'] for r in raws])
+    lon=np.array([r['LONGITUDE'] for r in raws])
+    juld=[r['JULD'] for r in raws]
+    profiles=finish_profiles(stack,depth,lat,lon,juld,[r['filtered'] for r in raws],depths,var_all,metrics)
+    for n,profile in zip(good,profiles):
+        if profile is not None:
+            results[n]=(loaded[n][0],profile)
+
+    return results
+
+def process_file(f,depths,var_all):
+    #QC and interpolate a single profile file (see process_chunk)
+    return process_chunk([f],depths,var_all)[0]
+
+def timed_chunk(files,depths,var_all):
+    #process_chunk with a fresh set of metrics, for the worker processes
+    metrics=new_metrics()
+    return process_chunk(files,depths,var_all,metrics),metrics
+
+def process_files(all_files,depths,var_all,workers=1,chunksize=32,cache=None,metrics=None,skipped=None):
+    '''Run process_chunk over a list of files, yielding the results in the
+    same order as all_files. With workers>1 the chunks of files are processed
+    by a pool of worker processes. If a cache (profile_cache_public.open_cache)
+    is given, only the files without a cached result are processed. If
+    metrics (pipeline_metrics_public.new_metrics) is given, the stage times
+    and rejection counts of all the chunks are added to it (for cached
+    results, the rejection branch stored with them). skipped, if given, is a
+    dictionary that collects the reason each file skipped before QC was
+    skipped.'''
+    if cache is not None:
+        skipped={}
+        process=lambda files: process_files(files,depths,var_all,workers,chunksize,metrics=metrics,
+                                            skipped=skipped)
+        for result in cached_results(all_files,cache,process,skipped,metrics):
+            yield result
+        return
+    chunks=[all_files[n:n+chunksize] for n in range(0,len(all_files),chunksize)]
+    if workers==1:
+        for chunk in chunks:
+            results,chunk_metrics=timed_chunk(chunk,depths,var_all)
+            if metrics is not None:
+                merge(metrics,chunk_metrics)
+            if skipped is not None:
+                skipped.update(chunk_metrics['skipped_files'])
+            for result in results:
+                yield result
     else:
-        bad=True
-    
-    if bad==True:
-        continue
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for results,chunk_metrics in pool.map(timed_chunk,chunks,itertools.repeat(depths),
+                                                  itertools.repeat(var_all)):
+                if metrics is not None:
+                    merge(metrics,chunk_metrics)
+                if skipped is not None:
+                    skipped.update(chunk_metrics['skipped_files'])
+                for result in results:
+                    yield result
+
+def original_file(f,depths,var_all):
+    '''QC and interpolate a single profile file as the original loop over the
+    files did (quality_control, and interpolate_data one variable at a time),
+    returning the QC code and profile dictionary as process_file does.'''
+    import gsw
+    import xarray as xr
+    if f in skip_files:
+        return None,None
+    with xr.open_dataset(f) as data:
+        if 'CHLA' not in data.keys() or np.isnan(data['CHLA']).all():
+            return None,None
+        var_list=select_variables(data,var_all)
+        qc,data=quality_control(data,'CHLA')
+        if qc!=0:
+            return qc,None
+        data['DEPTH']=abs(gsw.z_from_p(data['PRES'].values[0],data['LATITUDE'].values[0]))
+        profile=dict((var,np.nan*np.ones(len(depths))) for var in var_all)
+        for var in var_list:
+            #need to only use the real values because of the weird synthetic profiles
+            mask=[i for i,j in enumerate(data[var].values[0]) if ~np.isnan(j)]
+            profile[key_dict[var]][:]=interpolate_data(data,var,depths,mask)
+        chla=profile['CHLA']
+        level=min(int(np.searchsorted(depths,250)),len(depths)-1)
+        if not (all(~np.isnan(chla)) and abs(chla[level])<=0.5 and abs(chla[-1])<=0.5) or \
+                any(np.isinf(chla)) or any(abs(chla)>50) or any(chla<-0.02):
+            return qc,None
+        profile['DEPTH']=np.array(depths,dtype=float)
+        profile['PRES']=gsw.p_from_z(-1*profile['DEPTH'],data['LATITUDE'].values[0])
+        for var in ['LATITUDE','LONGITUDE','JULD']:
+            profile[var]=data[var].values[0]
+    return qc,profile
+
+def check_parallel(files,depths,var_all,workers=4,rtol=1e-5,atol=1e-5):
+    '''Make sure the parallel results give the same QC codes and accepted
+    profiles as the original serial loop (original_file), with the same
+    values up to float32 rounding of the data (rtol, atol).'''
+    serial=[original_file(f,depths,var_all) for f in files]
+    parallel=list(process_files(files,depths,var_all,workers=workers))
+    for f,(qc1,p1),(qc2,p2) in zip(files,serial,parallel):
+        assert qc1==qc2 and (p1 is None)==(p2 is None), f
+        if p1 is not None:
+            for var in p1:
+                if var=='JULD':
+                    assert p1[var]==p2[var], (f,var)
+                else:
+                    assert np.allclose(p1[var],p2[var],rtol=rtol,atol=atol,equal_nan=True), (f,var)
+    print('Serial and parallel results agree for %d files' %len(files))
+    return True
+
+juld_units='days since 1950-01-01 00:00:00'
+
+def archive_record(f,var_all):
+    '''Raw data of one profile file for the archive (ragged_archive_public.py):
+    PRES, the variables chosen by select_variables (under their key_dict
+    names), the unadjusted CHLA used for QC (CHLA_RAW), and the position and
+    undecoded time of the profile.'''
+    import xarray as xr
+    name=os.path.basename(f)
+    if f in skip_files:
+        return {'status':status_codes['skip_file'],'name':name}
+    with xr.open_dataset(f,decode_times=False) as data:
+        if 'CHLA' not in data.keys():
+            return {'status':status_codes['no_chla_variable'],'name':name}
+        elif np.isnan(data['CHLA']).all():
+            return {'status':status_codes['all_nan_chla'],'name':name}
+        if not data['JULD'].attrs.get('units','').startswith(juld_units):
+            raise ValueError('unexpected JULD units in %s' %f)
+
+        var_list=select_variables(data,var_all)
+        obs={'PRES':data['PRES'].values[0],'CHLA_RAW':data['CHLA'].values[0]}
+        for var in var_list:
+            obs[key_dict[var]]=data[var].values[0]
+        profile={'LATITUDE':data['LATITUDE'].values[0],'LONGITUDE':data['LONGITUDE'].values[0],
+                 'JULD':data['JULD'].values[0],'FILTERED':float('CHLA' in var_list)}
+    return {'status':status_codes['archived'],'name':name,'obs':obs,'profile':profile}
+
+def archive_chunk(files,var_all):
+    return [archive_record(f,var_all) for f in files]
+
+def build_archive(all_files,archive_file,var_all,workers=1,chunksize=64,batch=2048):
+    '''Read every file in all_files once and store the raw profiles in a
+    single ragged array archive, with one row per file (in order). The QC and
+    interpolation can then be repeated from the archive with process_archive,
+    e.g. with a different depth grid. Changing var_all or key_dict needs a new
+    archive.'''
+    writer=create_archive(archive_file,len(all_files),['PRES','CHLA_RAW']+var_all,
+                          ['LATITUDE','LONGITUDE','JULD','FILTERED'])
+    writer['units']['JULD']=juld_units
+    writer['attrs']['variables_selected']=' '.join(var_all)
+    chunks=[all_files[n:n+chunksize] for n in range(0,len(all_files),chunksize)]
+    pending=[]
+    written=0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for records in pool.map(archive_chunk,chunks,itertools.repeat(var_all)):
+            pending+=records
+            if len(pending)>=batch:
+                written=append_rows(writer,written,pending)
+                pending=[]
+                print('Archived files: ',written)
+    if len(pending)>0:
+        written=append_rows(writer,written,pending)
+    finish_archive(writer)
+    return written
+
+def process_archive(archive,files,depths,var_all,chunk=2000,metrics=None):
+    '''Same results as process_files, but reading the raw profiles from an
+    archive opened with ragged_archive_public.open_archive instead of from
+    the individual files. files must all be in the archive.'''
+    import gsw
+    import xarray as xr
+    row_of=dict((name,n) for n,name in enumerate(archive['FILE']))
+    try:
+        rows=np.array([row_of[os.path.basename(f)] for f in files],dtype=int)
+    except KeyError as err:
+        raise ValueError('%s is not in the archive; rebuild it with build_archive' %err)
+    reasons=dict((code,name) for name,code in status_codes.items())
+    for start in range(0,len(rows),chunk):
+        block=rows[start:start+chunk]
+        status=archive['STATUS'][block]
+        results=[(None,None)]*len(block)
+        for code in status[status!=0]:
+            tally(metrics,'rejected',reasons[int(code)])
+        stored=np.flatnonzero(status==0)
+        if len(stored)==0:
+            for result in results:
+                yield result
+            continue
+
+        with timed(metrics,'open'):
+            n_levels=max(int(archive['row_size'][block[stored]].max()),1)
+            pres=gather(archive,'PRES',block[stored],n_levels)
+            chla=gather(archive,'CHLA_RAW',block[stored],n_levels)
+            lat=np.asarray(archive['LATITUDE'][block[stored]],dtype=float)
+            lon=np.asarray(archive['LONGITUDE'][block[stored]],dtype=float)
+        with timed(metrics,'qc'):
+            qc=qc_codes(pres,chla,chla,lat,lon)
+        for n,code in zip(stored,qc):
+            results[n]=(int(code),None)
+            if code!=0:
+                tally(metrics,'rejected','qc_%d' %code)
+
+        passed=stored[qc==0]
+        if len(passed)>0:
+            good=block[passed]
+            with timed(metrics,'open'):
+                stack=dict((var,gather(archive,var,good,n_levels)) for var in var_all)
+                juld=xr.coding.times.decode_cf_datetime(np.asarray(archive['JULD'][good],dtype=float),
+                                                        juld_units,'standard')
+                filtered=np.asarray(archive['FILTERED'][good])==1
+            with timed(metrics,'gsw'):
+                depth=abs(gsw.z_from_p(pres[qc==0],lat[qc==0][:,None]))
+            profiles=finish_profiles(stack,depth,lat[qc==0],lon[qc==0],juld,filtered,depths,var_all,metrics)
+            for n,profile in zip(passed,profiles):
+                if profile is not None:
+                    results[n]=(0,profile)
+        for result in results:
+            yield result
+
+
+def process_all(path,sfpath,chl_file,make_file_list=True,save_file=None,catalog_file=None,full_refresh=False,
+                max_depth=250,grid_spacing=5,workers=None,stream_output=True,resume=True,batch_size=1000,
+                compressed_output=False,cache_file=None,archive_file=None,rebuild_archive=False,
+                scratch_dir=None,profile_file=None):
+    '''Quality control, smooth and interpolate all of the profiles of the
+    floats in chl_file (the float list from bgc_argo_float_list_public.py) in
+    path, and write them to sfpath+'all_chla_argo_<max_depth>_<grid_spacing>m.nc'.
+    With make_file_list, the file list is made (from the catalog in
+    catalog_file, if given; full_refresh checks every file in it) and written to save_file; otherwise chl_file is a
+    file list saved by an earlier run. cache_file and archive_file turn on the
+    profile cache and the raw profile archive. Returns the metrics of the run.'''
+    if make_file_list==True:
+        print('Make file list')
+        #This routine checks to make sure that profiles have a chlorophyll variable
+        #in them and that realtime and delayed mode profiles are not duplicated in the analysis.
+        if catalog_file is not None:
+            with open(chl_file) as numbers:
+                float_numbers=[n for n in numbers.read().split('\n') if n]
+            catalog=open_catalog(catalog_file)
+            print('Catalog changes (added, removed, changed): ', refresh_catalog(catalog,path,full_refresh))
+            all_files=best_files(catalog,path,float_numbers)
+            catalog.close()
+        else:
+            all_files=file_list(chl_file,path)
     
-    all_data['DEPTH'][count]=depths
-    all_data['PRES'][count]=gsw.p_from_z(-1*all_data['DEPTH'][count],data['LATITUDE'][0])
+        if save_file is not None:
+            print('Save files')   
+            files = open(save_file,'w')
     
-    for var in ['LATITUDE','LONGITUDE','JULD']:
-        all_data[var][count]=data[var].values[0]
-    if np.isnan(all_data['CHLA'][count]).all():
-        continue
+            for f in all_files:
+                files.write(f)
+                files.write('\n')
     
+            print('Close file list')
+            files.close()
+
+    else:
+        print('Open file list')
+        with open(chl_file) as numbers:
+            files=numbers.read()
+            all_files=[f for f in files.split('\n') if f]
+
+    print(len(all_files))
+    depths=make_grid(max_depth,grid_spacing)
+    out_name='all_chla_argo_%g_%gm' %(max_depth,grid_spacing)
+    var_all=['TEMP','PSAL','DOXY','NITRATE','CHLA']
+    if workers is None:
+        workers=os.cpu_count()
+
+    cache=None
+    if cache_file is not None:
+        #the processing functions outside profile_engine_public.py are part of the key
+        cache=open_cache(cache_file,config_key(depths,var_all,key_dict,sorted(skip_files),
+                                               functions=[select_variables,load_profile,finish_profiles,
+                                                          process_chunk]),
+                         max_bytes=4*1024**3)
+
+    archive=None
+    if archive_file is not None:
+        if rebuild_archive==True or not os.path.exists(archive_file):
+            print('Build archive')
+            build_archive(all_files,archive_file,var_all,workers=workers)
+        archive=open_archive(archive_file)
+        if archive['attrs'].get('variables_selected',b'').decode()!=' '.join(var_all) or 'CHLA_RAW' not in archive:
+            raise ValueError('archive was built with other variables; set rebuild_archive')
+
+    def run(files):
+        #results for files, in order, from the archive or from the files themselves
+        if archive is not None:
+            return process_archive(archive,files,depths,var_all,metrics=metrics)
+        return process_files(files,depths,var_all,workers=workers,cache=cache,metrics=metrics)
+
+    metrics=new_metrics()
+    report_file=sfpath+out_name+'_report.json'
+    profiler=start_profiler(profile_file)
+
+    if stream_output==True:
+        if compressed_output==True:
+            out=open_output(sfpath+out_name+'.nc',depths,resume=resume,dtype='f4',complevel=4)
+        else:
+            out=open_output(sfpath+out_name+'.nc',depths,resume=resume)
+        start=resume_position(out,all_files)
+        n_qc,n_qc_pass=(int(out.n_qc),int(out.n_qc_pass)) if start>0 else (0,0)
+        print('Resuming after %d files' %start)
+        processed=files_hash(all_files[:start])
+        batch=[]
+        n=start-1
+        print('Import data')
+        for n,(qc,profile) in enumerate(run(all_files[start:]),start):
+            record_result(metrics,qc,profile)
+            files_hash([all_files[n]],processed)
+            if qc is not None:
+                n_qc+=1
+                if qc==0:
+                    n_qc_pass+=1
+                    if profile is not None:
+                        batch.append(profile)
+            if (n+1)%batch_size==0:
+                with timed(metrics,'write'):
+                    count=append_profiles(out,batch,n+1,all_files[n],n_qc,n_qc_pass,processed.hexdigest())
+                batch=[]
+                print('Number of completed files: ', n+1, ' profiles: ', count)
+        with timed(metrics,'write'):
+            count=append_profiles(out,batch,n+1,all_files[n] if n>=0 else '',n_qc,n_qc_pass,
+                                  processed.hexdigest())
+            out.close()
+
+        print("Total number of files:", n_qc)
+        print("Total number of files passing QC checks:", n_qc_pass)
+        print("Total number of files with realistic values after interpolation:", count)
+
+    else:
+        print('Initialize arrays')
+        if scratch_dir is not None:
+            all_data=memmap_arrays(scratch_dir,len(all_files),len(depths),var_all+['PRES','DEPTH','PDENSITY'])
+        else:
+            all_data={}
+            #want to initialize these with nans, so that if not all the profiles end
+            #up being used, the blank ones can be easily identified and removed. This
+            #is more efficient than appending tens of thousands of values to empty
+            #arrays.
+            for var in var_all:
+                all_data[var]=np.nan*np.ones((len(all_files),len(depths)))
+            for var in ['LATITUDE','LONGITUDE']:
+                all_data[var]=np.nan*np.ones(len(all_files))
+            all_data['JULD']=np.empty(len(all_files),dtype='datetime64[ns]')
+            all_data['PRES']=np.nan*np.ones((len(all_files),len(depths)))
+            all_data['DEPTH']=np.nan*np.ones((len(all_files),len(depths)))
+            #keep track of QC for comparing various effects
+            all_data['QC']=np.nan*np.ones(len(all_files))
+
+        count=0
+        qc_all=[]
+        qc_good=[]
+
+        print('Import data')
+        #profiles are processed by a pool of worker processes, but the results come
+        #back in the same order as all_files, so the output does not depend on the
+        #number of workers; set workers=1 to process them one at a time
+        for n,(qc,profile) in enumerate(run(all_files)):
+            record_result(metrics,qc,profile)
+            #print counts to keep track of progress
+            if n%1000==0:
+                print('Number of completed files: ', count)
+            if qc is None:
+                continue
+
+            qc_all.append(qc)
+            if qc!=0:
+                continue    
+    
+            qc_good.append(qc)
+            if profile is None:
+                continue
+
+            with timed(metrics,'write'):
+                all_data['QC'][count]=qc
+                for var in profile:
+                    all_data[var][count]=profile[var]
+            count+=1
+
+
+        #remove extra placeholder values from the data arrays
+        #(slicing keeps the memory-mapped arrays on disk, where np.delete would copy them)
+        for var in ['LATITUDE','LONGITUDE','JULD','TEMP','PSAL','CHLA','DOXY','NITRATE','DEPTH','PRES']:
+            all_data[var]=all_data[var][:count]
+
+        if scratch_dir is not None:
+            all_data['PDENSITY']=potential_density(all_data['PSAL'],all_data['TEMP'],all_data['PDENSITY'][:count])
+        else:
+            all_data['PDENSITY']=potential_density(all_data['PSAL'],all_data['TEMP'])
+
+        print(count)
     
-    data.close()
-    count+=1
+        print('Export data to a file')
+        var_all=['TEMP','PSAL','DOXY','NITRATE','CHLA','PDENSITY']
+        print(all_data.keys())
+        with timed(metrics,'write'):
+            export_data(all_data,var_all,sfpath+out_name+'.nc',compress=compressed_output)
 
+        print("Total number of files:", len(qc_all))
+        print("Total number of files passing QC checks:", len(qc_good))
+        print("Total number of files with realistic values after interpolation:", len(all_data['QC']))
 
-#remove extra placeholder values from the data arrays
-for var in ['LATITUDE','LONGITUDE','JULD','TEMP','PSAL','CHLA','DOXY','NITRATE','DEPTH','PRES']:
-    all_data[var]=np.delete(all_data[var],np.s_[count:],0)
+    stop_profiler(profiler,profile_file)
+    if cache is not None:
+        close_cache(cache)
+    if archive is not None:
+        close_archive(archive)
+    print_report(metrics)
+    save_report(metrics,report_file)
+    return metrics
 
-all_data['PDENSITY']=gsw.rho(all_data['PSAL'],all_data['TEMP'],0)
 
-print(count)
-    
-print('Export data to a file')
-var_all=['TEMP','PSAL','DOXY','NITRATE','CHLA','PDENSITY']
-print(all_data.keys())
-export_data(all_data,var_all,sfpath+'all_chla_argo_250_5m.nc')
-
-print("Total number of files:", len(qc_all))
-print("Total number of files passing QC checks:", len(qc_good))
-print("Total number of files with realistic values after interpolation:", len(all_data['QC']))
\ No newline at end of file
+###MAIN FILE###
+if __name__ == '__main__':
+    #filepath for float data:
+    path='/Volumes/RE_DATA/SyntheticBioArgo/'
+
+    sfpath='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/Argo_Merged/CHL_Data/'
+
+    #make a list of all of the files with chlorophyll data in them. If you do
+    #this step once and want to re-run the code later, set make_file_list to 
+    #False so you don't have to repeat this step
+    make_file_list=True
+
+    if make_file_list==True:
+        #filename and location from bgc_argo_float_list_public.py
+        chl_file='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/argo_CHL_float_list_synthetic.txt'
+        save_file='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/argo_CHL_file_list_synthetic.txt'
+    else:
+        chl_file='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/argo_CHL_file_list_synthetic.txt'
+        save_file=None
+
+    #With use_catalog, the file names come from a catalog of the data directory
+    #(file_catalog_public.py) that is only rescanned when files are added or removed;
+    #keep the catalog file outside of the data directory. Files rewritten in place
+    #(same name) do not change the directory; set full_refresh to check every file.
+    use_catalog=True
+    full_refresh=False
+    catalog_file=None
+    if use_catalog==True:
+        catalog_file='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/argo_synthetic_catalog.sqlite'
+
+    #vertical grid: 0 to max_depth m every grid_spacing m (the output file name
+    #follows the grid, e.g. all_chla_argo_250_5m.nc). Note that profiles are
+    #extrapolated below their deepest data point, as in interpolate_data
+    max_depth=250
+    grid_spacing=5
+    #number of worker processes for the QC and interpolation
+    workers=os.cpu_count()
+
+    #With stream_output, accepted profiles are appended to the output file in
+    #batches (argo_io_public.py) instead of being held in memory until the end,
+    #and a checkpoint is stored in the file after each batch. If the run is
+    #interrupted, running it again with the same file list picks up where it
+    #stopped; set resume to False to start over.
+    stream_output=True
+    resume=True
+    batch_size=1000
+    #With compressed_output, the profiles are stored as compressed float32 in
+    #chunks of profiles and depths, which makes the file several times smaller;
+    #load it with argo_io_public.load_profiles to only read the variables needed
+    compressed_output=False
+    #With scratch_dir (and stream_output False), the arrays are memory-mapped files
+    #in scratch_dir rather than arrays in memory (argo_io_public.py), so fine grids
+    #(e.g. grid_spacing=1, max_depth=1000) do not need to fit in memory
+    scratch_dir=None
+
+    #With use_cache, the QC code and interpolated profile for each file are kept
+    #in a cache (profile_cache_public.py), so a re-run after a GDAC update only
+    #processes new or changed files and rebuilds the output from the cache for
+    #the rest (set resume to False to rebuild the whole output file). Changing
+    #depths, var_all, key_dict, skip_files, profile_engine_public.py (QC and
+    #interpolation) or the functions here that choose adjusted or raw variables,
+    #load the profiles and run the post-interpolation check (select_variables,
+    #load_profile, finish_profiles, process_chunk) starts a fresh set of results.
+    #Other edits to this program do not, so clear the cache after changing
+    #anything else that affects the results.
+    use_cache=True
+    cache_file=None
+    if use_cache==True:
+        cache_file='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/argo_profile_cache.sqlite'
+
+    #With use_archive, the raw profiles are first copied into a single ragged
+    #array archive (ragged_archive_public.py) and the QC and interpolation are run
+    #from the memory-mapped archive instead of opening every file again, which
+    #is much faster for repeated runs (e.g. trying other depth grids). Delete the
+    #archive (or set rebuild_archive) after updating the file list; the cache is
+    #not used with the archive.
+    use_archive=False
+    rebuild_archive=False
+    archive_file=None
+    if use_archive==True:
+        archive_file='/Users/rosalindechols/Documents/Generals/Self_Shading_Research/Data/argo_raw_profiles.nc'
+
+    #Time spent in each stage and the reasons profiles are rejected are recorded
+    #(pipeline_metrics_public.py), printed at the end and saved as a JSON report.
+    #Set profile_file to a file name to also profile the run with cProfile.
+    profile_file=None
+
+    process_all(path,sfpath,chl_file,make_file_list,save_file,catalog_file,full_refresh,max_depth,grid_spacing,
+                workers=workers,stream_output=stream_output,resume=resume,batch_size=batch_size,
+                compressed_output=compressed_output,cache_file=cache_file,archive_file=archive_file,
+                rebuild_archive=rebuild_archive,scratch_dir=scratch_dir,profile_file=profile_file)
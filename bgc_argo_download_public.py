@@ -12,96 +12,138 @@ from ftplib import FTP
 import numpy as np
 from os.path import isfile, join
 import shutil
-from tqdm import tqdm
-
-#Set the high-level storage location for the data
-mypath = '/Volumes/RE_DATA/'
-
-
-# Change the directory to your desired path
-# You should already be here, but it is good to check
-os.chdir(mypath)
-
-# Create a folder to put the data into. Here, we are downloading
-# the merged (Synthetic) BioArgo files, so we use that as a folder name.
-# If the folder already exists, just use that. This makes sure that you
-# don't try to store the data in a non-existent location
-direc = mypath+'/SyntheticBioArgo/'
-if not os.path.exists(direc):
-	os.makedirs(direc)
-
-os.chdir(mypath+'SyntheticBioArgo/')
-
-# FTP into the GDAC
-ftp = FTP('ftp.ifremer.fr')
-ftp.login()
-ftp.cwd('/ifremer/argo')
-
-# Load in the greylist and the profile lists
-print('Downloading Lists')
-
-ftp.retrbinary('RETR ar_greylist.txt',open('ar_greylist.txt','wb').write)
-#this is where you set which directory on the GDAC you will be downloading data
-#from. If you want something other than the synthetic profiles, you'll need to 
-#change the names of these text files.
-ftp.retrbinary('RETR argo_synthetic-profile_index.txt',open('argo_synthetic-profile_index.txt','wb').write)
-
-# Set up variables for greylist and profile files
-# Look to see which files you have already downloaded
-greylist = 'ar_greylist.txt'
-
-named = 'argo_synthetic-profile_index.txt'
-gotten = 'synthetic_namefile.txt'
-
-# Find the greylisted floats (load as strings)
-grey = np.genfromtxt(greylist,dtype='|S7',skip_header=1,delimiter=',',usecols=0)
-
-# Retrieve all names (column0)
-names = np.genfromtxt(named,dtype=None,skip_header=9,delimiter=',',usecols=0)
-amounts = len(names)
-
-if os.path.isfile(gotten):
-	filesdone = np.genfromtxt(gotten,dtype=None,usecols=0)
-else:
-	filesdone = []
-
-
-# Remove the floats that are on the greylist or that you have already downloaded
-print('Collecting Downloads')
-arnames =[]
-for t in range(amounts):
-	if names[t] not in filesdone:
-		a = names[t].decode().split("/")
-		if a[1] not in grey:
-			arnames.append(names[t])
-		del(a)
-
-arnames = sorted(list(set(arnames)))
-
-# Print out the total number of files to work with total
-amounts2 = len(arnames)
-print('Number of Files: ')
-print(amounts2)
-
-# Create a file with the names of all the floats
-ff = open("synthetic_namefile.txt",'ab')
-for n in range(amounts2):
-	ff.write(arnames[n]+'\n'.encode('utf-8'))
-
-ff.close()
-del(ff)
-
-#ftp.sendcmd('PASV')
-ftp.cwd('dac')
-
-# Go through the FTP selecting only the data files that are in the focus area
-# for t in tqdm(range(amounts2)):
-for t in tqdm(range(amounts2)):
-	floaty = arnames[t].decode().split("/")
-	filepaths = direc+floaty[3]
-	ftp.retrbinary('RETR '+ arnames[t].decode() ,open(filepaths,'wb').write)
-
-# End the connection
-ftp.quit()
-
-os.chdir(mypath)
\ No newline at end of file
+from gdac_ftp_public import download_files
+from gdac_index_public import read_greylist, open_manifest, bootstrap_manifest
+from gdac_index_public import delta_sync as delta_sync_files
+
+def download(mypath,delta_sync=False,connections=8):
+	'''Download the merged (Synthetic) BioArgo profiles into
+	mypath/SyntheticBioArgo/, or with delta_sync bring that folder up to date
+	with the index. Returns the summary of the download engine (failed
+	downloads are in summary['failed']).'''
+	start_dir = os.getcwd()
+
+	# Change the directory to your desired path
+	# You should already be here, but it is good to check
+	os.chdir(mypath)
+
+	# Create a folder to put the data into. Here, we are downloading
+	# the merged (Synthetic) BioArgo files, so we use that as a folder name.
+	# If the folder already exists, just use that. This makes sure that you
+	# don't try to store the data in a non-existent location
+	direc = mypath+'/SyntheticBioArgo/'
+	if not os.path.exists(direc):
+		os.makedirs(direc)
+
+	try:
+		os.chdir(mypath+'SyntheticBioArgo/')
+
+		# FTP into the GDAC
+		ftp = FTP('ftp.ifremer.fr')
+		ftp.login()
+		ftp.cwd('/ifremer/argo')
+
+		# Load in the greylist and the profile lists
+		print('Downloading Lists')
+
+		ftp.retrbinary('RETR ar_greylist.txt',open('ar_greylist.txt','wb').write)
+		#this is where you set which directory on the GDAC you will be downloading data
+		#from. If you want something other than the synthetic profiles, you'll need to 
+		#change the names of these text files.
+		ftp.retrbinary('RETR argo_synthetic-profile_index.txt',open('argo_synthetic-profile_index.txt','wb').write)
+
+		# Set up variables for greylist and profile files
+		# Look to see which files you have already downloaded
+		greylist = 'ar_greylist.txt'
+
+		named = 'argo_synthetic-profile_index.txt'
+		gotten = 'synthetic_namefile.txt'
+		manifest = 'synthetic_manifest.sqlite'
+
+		# End the list connection; the profiles are downloaded by the engine in
+		# gdac_ftp_public.py, which opens its own connections
+		ftp.quit()
+
+		if delta_sync==True:
+			print('Syncing Downloads')
+			if not os.path.isfile(manifest) and os.path.isfile(gotten):
+				conn = open_manifest(manifest)
+				print('Files added to manifest: ')
+				print(bootstrap_manifest(conn,gotten,named,direc))
+				conn.close()
+
+			summary = delta_sync_files(direc,named,greylist,manifest,namefile=gotten,connections=connections)
+
+		else:
+			# Find the greylisted floats (load as strings)
+			grey = read_greylist(greylist)
+
+			# Retrieve all names (column0)
+			names = np.genfromtxt(named,dtype=None,skip_header=9,delimiter=',',usecols=0)
+			amounts = len(names)
+
+			# Sets, so that checking each of the names is not a scan of the whole list
+			if os.path.isfile(gotten):
+				with open(gotten,'rb') as done:
+					filesdone = set(n.strip() for n in done)
+			else:
+				filesdone = set()
+
+			# Remove the floats that are on the greylist or that you have already downloaded
+			print('Collecting Downloads')
+			arnames =[]
+			for t in range(amounts):
+				if names[t] not in filesdone:
+					a = names[t].decode().split("/")
+					if a[1] not in grey:
+						arnames.append(names[t])
+					del(a)
+
+			arnames = sorted(list(set(arnames)))
+
+			# Print out the total number of files to work with total
+			amounts2 = len(arnames)
+			print('Number of Files: ')
+			print(amounts2)
+
+			# Go through the FTP selecting only the data files that are in the focus area.
+			# Each file is only added to the list of downloaded files once it has been
+			# completely transferred, so if the connection drops you can just run this
+			# program again to pick up where it stopped.
+			ff = open(gotten,'ab')
+
+			def record_file(remote,local):
+				ff.write(remote.encode('utf-8')+'\n'.encode('utf-8'))
+				ff.flush()
+
+			# anything not in the list of downloaded files is fetched again, since a file
+			# left over from an older, interrupted run may be truncated
+			summary = download_files([n.decode() for n in arnames],direc,connections=connections,
+				overwrite=True,on_complete=record_file)
+
+			ff.close()
+			del(ff)
+
+		if len(summary['failed'])>0:
+			print('Failed downloads (re-run to retry): ')
+			print(len(summary['failed']))
+	finally:
+		os.chdir(start_dir)
+	return summary
+
+
+if __name__ == '__main__':
+	#Set the high-level storage location for the data
+	mypath = '/Volumes/RE_DATA/'
+
+	# Several connections are used at once for the profile downloads
+	connections=8
+
+	# Set delta_sync to True to keep the local files in step with the index using
+	# the date_update column: new profiles are downloaded, profiles that the DACs
+	# have reprocessed are downloaded again, and profiles that have been removed
+	# from the GDAC are removed (and from synthetic_namefile.txt). The first delta sync builds its manifest from
+	# synthetic_namefile.txt, so it does not repeat a previous full download.
+	delta_sync=False
+
+	download(mypath,delta_sync=delta_sync,connections=connections)
@@ -10,10 +10,13 @@ import os
 import re
 import numpy as np
 import itertools
-import xarray as xr
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 #Compile a list of data files (can vary the search criteria depending on file source)
 def float_list_with_keyword(path,search_crit,keyword):
+    #xarray is only loaded for this (slow) version, so the fast one starts quickly
+    import xarray as xr
     float_list=[]
     bad_floats=[]
     count=0
@@ -44,22 +47,118 @@ def float_list_with_keyword(path,search_crit,keyword):
     return float_list
 
 
-#Main program
-folder='/Volumes/RE_DATA/SyntheticBioArgo/'
-path=folder
+def float_number(data_file):
+    #float (WMO) number from a profile file name, e.g. SD5904855_122D.nc
+    match = re.search(r'(\d+)_\d+D?\.nc$', data_file)
+    if match:
+        return match.group(1)
+    return None
+
+def probe_variables(file_path):
+    #read only the netCDF header (variable names); no data or coordinates are
+    #read or decoded
+    with Dataset(file_path) as ds:
+        return set(ds.variables.keys())
+
+def probe_float(file_paths,keyword):
+    #the first readable file of each float decides whether it has the keyword,
+    #as in float_list_with_keyword
+    for file_path in file_paths:
+        try:
+            variables = probe_variables(file_path)
+        except OSError:
+            continue
+        return keyword in variables
+    return None
+
+def float_list_fast(path,search_crit,keyword,workers=None,chunksize=8):
+    '''Same result as float_list_with_keyword, but files are grouped by float
+    after a single directory listing, only the netCDF headers are read, and
+    the floats are checked in parallel across a process pool.'''
+    files_by_float = {}
+    for data_file in os.listdir(path):
+        if re.search(search_crit, data_file):
+            number = float_number(data_file)
+            if number is not None:
+                files_by_float.setdefault(number,[]).append(path+data_file)
+
+    float_list = set()
+    numbers = list(files_by_float.keys())
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(probe_float,[files_by_float[n] for n in numbers],
+                           itertools.repeat(keyword),chunksize=chunksize)
+        for number,has_keyword in zip(numbers,results):
+            if has_keyword is True:
+                float_list.add(number)
+                if len(float_list)%100==0:
+                    print(len(float_list))
+
+    return sorted(float_list)
+
+def benchmark_probe(path,search_crit,keyword,n_files=200,workers=None,rounds=3):
+    #compare files/s for opening files with xarray and for reading headers
+    #only. The first pass to read the files warms the disk cache for the
+    #others, so the order of the passes is rotated each round and the rates
+    #are averaged over the rounds
+    import xarray as xr
+    files = [path+f for f in sorted(os.listdir(path)) if re.search(search_crit, f)][:n_files]
+
+    def xarray_pass():
+        for file_path in files:
+            with xr.open_dataset(file_path) as ds:
+                keyword in ds.keys()
 
+    def header_pass():
+        for file_path in files:
+            keyword in probe_variables(file_path)
 
-print('Find files')
-float_list = float_list_with_keyword(path, '.nc','CHLA')
+    def parallel_pass():
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(probe_float,[[f] for f in files],itertools.repeat(keyword),chunksize=8))
 
+    passes = [('xarray',xarray_pass),('header',header_pass),('header_parallel',parallel_pass)]
+    times = dict((name,[]) for name,run in passes)
+    for r in range(rounds):
+        for name,run in passes[r%len(passes):]+passes[:r%len(passes)]:
+            start = time.perf_counter()
+            run()
+            times[name].append(time.perf_counter()-start)
+    rates = dict((name,len(files)/np.mean(times[name])) for name in times)
 
-print('Save files')   
-save_file='' #set filename/location for saving file list, ending with .txt
-files = open(save_file,'w')
+    for k in rates:
+        print('%s: %.1f files/s' %(k,rates[k]))
+    return rates
+
+
+def make_float_list(path,save_file,keyword='CHLA',search_crit='.nc',fast_probe=True):
+    '''Write the numbers of the floats in path with keyword in their files to
+    save_file (one per line). Returns the list of float numbers.'''
+    print('Find files')
+    if fast_probe==True:
+        float_list = float_list_fast(path, search_crit, keyword)
+    else:
+        float_list = float_list_with_keyword(path, search_crit, keyword)
+
+    print('Save files')   
+    files = open(save_file,'w')
     
-for f in float_list:
-    files.write(f)
-    files.write('\n')
+    for f in float_list:
+        files.write(f)
+        files.write('\n')
+
+    print('Close file list')    
+    files.close()
+    return float_list
+
+
+#Main program
+if __name__ == '__main__':
+    folder='/Volumes/RE_DATA/SyntheticBioArgo/'
+    path=folder
+
+    #fast_probe reads only the file headers, in parallel; set it to False to
+    #use the original (much slower) xarray version
+    fast_probe=True
 
-print('Close file list')    
-files.close()
\ No newline at end of file
+    save_file='' #set filename/location for saving file list, ending with .txt
+    make_float_list(path,save_file,'CHLA',fast_probe=fast_probe)
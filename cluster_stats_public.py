@@ -0,0 +1,88 @@
+'''This code computes the statistics of the profiles in each GMM cluster used
+in "GMM_Public.ipynb" and "GMM_figures.ipynb" (average, probability-weighted
+average, standard deviation, weighted standard deviation and median at every
+depth), and resequences the cluster labels. Instead of making a copy of the
+profiles of each cluster, the profiles are sorted by cluster once, and the
+sums for all clusters and depths are taken in the same pass (np.add.reduceat
+over the sorted profiles); only the medians need a step per cluster, on the
+sorted (contiguous) block of profiles. Relabeling is a single lookup in a
+table of the new number of each cluster. This code was written by PhD student
+Rosalind Echols.
+'''
+
+import numpy as np
+
+
+def cluster_blocks(labels,n_clusters):
+    '''Order that sorts the profiles by cluster, and the start of each
+    cluster in the sorted profiles (n_clusters+1 values).'''
+    labels=np.asarray(labels).astype(int)
+    order=np.argsort(labels,kind='stable')
+    starts=np.searchsorted(labels[order],np.arange(n_clusters+1))
+    return order,starts
+
+
+def block_sums(values,starts):
+    #sum over the rows of each block of values (zero for empty blocks)
+    sums=np.zeros((len(starts)-1,)+values.shape[1:])
+    full=np.flatnonzero(np.diff(starts)>0)
+    if len(full)>0:
+        sums[full]=np.add.reduceat(values,starts[full],axis=0)
+    return sums
+
+
+def cluster_statistics(values,labels,probs,n_clusters=None):
+    '''Statistics of the profiles (rows of values) in each cluster, as
+    (n_clusters, levels) arrays in a dictionary: 'ave' (as np.nanmean),
+    'wave' (average weighted by the probability of the cluster, as
+    np.average, so nans are not skipped), 'std' (as np.nanstd), 'wstd'
+    (weighted standard deviation around 'ave', as in the notebook),
+    'median' (as np.nanmedian) and 'count' (number of profiles). Clusters
+    without profiles are nan.'''
+    values=np.asarray(values,dtype=float)
+    probs=np.asarray(probs,dtype=float)
+    if n_clusters is None:
+        n_clusters=probs.shape[1]
+    order,starts=cluster_blocks(labels,n_clusters)
+    x=values[order]
+    sorted_labels=np.repeat(np.arange(n_clusters),np.diff(starts))
+    #probability of each (sorted) profile for its own cluster
+    w=probs[order,sorted_labels][:,None]
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        valid=~np.isnan(x)
+        n=block_sums(valid.astype(float),starts)
+        ave=block_sums(np.where(valid,x,0.),starts)/n
+        std=np.sqrt(block_sums(np.where(valid,(x-ave[sorted_labels])**2,0.),starts)/n)
+        w_sum=block_sums(w,starts)
+        wave=block_sums(x*w,starts)/w_sum
+        wstd=np.sqrt(block_sums((x-ave[sorted_labels])**2*w,starts)/w_sum)
+
+    median=np.nan*np.ones((n_clusters,)+values.shape[1:])
+    for m in range(n_clusters):
+        if starts[m+1]>starts[m]:
+            median[m]=np.nanmedian(x[starts[m]:starts[m+1]],0)
+    return {'ave':ave,'wave':wave,'std':std,'wstd':wstd,'median':median,'count':np.diff(starts)}
+
+
+def relabel(labels,new_groups):
+    '''New label of each profile when cluster new_groups[i] becomes cluster
+    i, by a lookup table (the position of each cluster in new_groups).'''
+    table=np.empty(len(new_groups),dtype=int)
+    table[np.asarray(new_groups).astype(int)]=np.arange(len(new_groups))
+    return table[np.asarray(labels).astype(int)]
+
+
+def sort_chl_profs(data,labels,groups=12,keyword='surf'):
+    '''Resequence the clusters by the surface chlorophyll (keyword='surf') or
+    the integrated chlorophyll of their central profiles (data['CHLA'], one
+    row per cluster). Returns the clusters in the new order and the new label
+    of each profile.'''
+    profiles=np.asarray(data['CHLA'])[:groups]
+    if keyword=='surf':
+        new_chl=profiles[:,0]
+    else:
+        integrate=np.trapezoid if hasattr(np,'trapezoid') else np.trapz
+        new_chl=integrate(profiles,axis=1)
+    new_groups=[int(g) for g in np.argsort(new_chl,kind='stable')]
+    return new_groups,relabel(labels,new_groups).astype(float)
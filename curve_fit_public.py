@@ -0,0 +1,511 @@
+'''This code fits the six shapes of "GMM_curve_fit.ipynb" (Gaussian, sigmoid,
+exponential, Gaussian + line, Gaussian + sigmoid and Gaussian + exponential)
+to every chlorophyll profile, with the same initial guesses (fsurf, zhalf,
+zmax, amp) and bounds as the lmfit Models of the notebook. Instead of building
+six Models per profile, each shape is fitted to a whole chunk of profiles at
+once: a Levenberg-Marquardt step is taken for all of the profiles together
+(numpy arrays of residuals and analytic Jacobians, and one batched solve of the
+small normal equations), and each profile stops when it has converged. Bounds
+are handled as lmfit does (the parameters are mapped to an unbounded internal
+variable with a sine), and chunks can be run on several processes. Profiles
+can also start from the fit of their cluster-average profile (warm start).
+The batched steps do not follow the same path as lmfit's MINPACK solver and
+can end in a different local minimum, so each shape is also fitted from a few
+other starting points (a grid search of its nonlinear parameters, and for the
+composite shapes the fits of the single shapes) and the best fit is kept;
+fits that do not converge or end above their initial guess are refitted one
+at a time with MINPACK and lmfit's settings (fit_minpack). A few composite
+fits (about 1%) still end in a worse minimum than lmfit's, and more are
+better; check_with_lmfit fails if more than max_worse are worse. params, AIC
+and chisq have the same columns as in the notebook. This code was
+written by PhD student Rosalind Echols.
+'''
+
+import time
+import warnings
+import numpy as np
+from scipy.special import expit
+from concurrent.futures import ProcessPoolExecutor
+
+from profile_diagnostics_public import chl_max, half_surface_depth, surface_mean
+
+
+def gaussian(depth,amplitude,mean_depth,width):
+    return amplitude*np.exp(-(depth-mean_depth)**2/width)
+
+
+def gaussian_jac(depth,amplitude,mean_depth,width):
+    e=np.exp(-(depth-mean_depth)**2/width)
+    return [e,amplitude*e*2*(depth-mean_depth)/width,amplitude*e*(depth-mean_depth)**2/width**2]
+
+
+def sigmoid(depth,surface,zhalf,slope):
+    #surface/(1+exp((zhalf-depth)*slope)), without overflow
+    return surface*expit((depth-zhalf)*slope)
+
+
+def sigmoid_jac(depth,surface,zhalf,slope):
+    s=expit((depth-zhalf)*slope)
+    ds=surface*s*(1-s)
+    return [s,-ds*slope,ds*(depth-zhalf)]
+
+
+def exponential(depth,surface,zhalf):
+    return surface*np.exp((-np.log(2)/zhalf)*depth)
+
+
+def exponential_jac(depth,surface,zhalf):
+    e=np.exp((-np.log(2)/zhalf)*depth)
+    return [e,surface*e*np.log(2)*depth/zhalf**2]
+
+
+def line(depth,slope,intercept):
+    return slope*depth+intercept
+
+
+def line_jac(depth,slope,intercept):
+    return [depth+0*slope,1+0*depth*slope]
+
+
+shapes={'gaussian':(gaussian,gaussian_jac,3),'sigmoid':(sigmoid,sigmoid_jac,3),
+        'exponential':(exponential,exponential_jac,2),'line':(line,line_jac,2)}
+
+#grid of values of the arguments of each shape that it is not linear in (by
+#position), searched by grid_start; the shapes are linear in the others. Sharp
+#steps only change the fit when they cross a depth level, so their depths are
+#searched between the levels
+shape_grids={'gaussian':{1:np.arange(0,201,10),2:np.geomspace(1,5000,8)},
+             'sigmoid':{1:np.arange(12.5,250,5),2:np.concatenate([-np.geomspace(1e-3,10,7),np.geomspace(1e-3,10,7)])},
+             'exponential':{1:np.geomspace(2,250,14)},'line':{}}
+
+#the six fits of the notebook: the shapes added together and, for each
+#parameter, its name, initial guess (see initial_guesses) and bounds
+models=[{'name':'Gaussian','shapes':['gaussian'],
+         'params':[('amplitude','amp',0,50),('mean_depth','peak',0,200),('width','width',1,5000)]},
+        {'name':'Sigmoid','shapes':['sigmoid'],
+         'params':[('surface','fsurf',0,50),('zhalf','zhalf',10,250),('slope','slope',-np.inf,np.inf)]},
+        {'name':'Exponential','shapes':['exponential'],
+         'params':[('surface','amp',0.04,50),('zhalf','zhalf',0,250)]},
+        {'name':'Gaussian + Line','shapes':['gaussian','line'],
+         'params':[('amplitude','amp',0,50),('mean_depth','peak',0,200),('width','width',1,5000),
+                   ('slope','line_slope',-0.25,0.1),('intercept','fsurf',0,50)]},
+        {'name':'Gaussian + Sigmoid','shapes':['gaussian','sigmoid'],
+         'params':[('amplitude','half_amp',0,50),('mean_depth','peak',0,200),('width','width',1,5000),
+                   ('surface','fsurf',0,50),('zhalf','zhalf',10,250),('slope','slope',-np.inf,np.inf)]},
+        {'name':'Gaussian + Exponential','shapes':['gaussian','exponential'],
+         'params':[('amplitude','half_amp',0,50),('mean_depth','peak',0,200),('width','width',1,5000),
+                   ('surface','fsurf',0,50),('zhalf','zhalf',0,100)]}]
+
+#first column of each model in params (24 columns in all)
+columns=np.cumsum([0]+[len(m['params']) for m in models])
+
+
+def initial_guesses(chla,depth):
+    '''Initial guesses of the notebook for each profile (rows of chla), from
+    profile_diagnostics_public.py: mean of the top 7 values (fsurf), first
+    depth below half of the surface value (zhalf, 200 if there is none), depth
+    of the maximum (peak) and the maximum (amp).'''
+    chla=np.asarray(chla,dtype=float)
+    zhalf=half_surface_depth(chla,depth)
+    peak,amp=chl_max(chla,depth)[:2]
+    return {'fsurf':surface_mean(chla),'zhalf':np.where(np.isnan(zhalf),200.,zhalf),'peak':peak,
+            'amp':amp,'half_amp':amp/2,'width':200.+0*amp,'slope':-1.+0*amp,'line_slope':-0.0001+0*amp}
+
+
+def initial_params(chla,depth):
+    #(profiles, 24) array of the initial guesses, as the columns of params
+    guesses=initial_guesses(chla,depth)
+    return np.column_stack([guesses[p[1]] for m in models for p in m['params']])
+
+
+def model_value(model,depth,x):
+    #(profiles, depths) values of a model with parameters x (profiles, parameters)
+    value=0.
+    k=0
+    for shape in model['shapes']:
+        f,jac,nargs=shapes[shape]
+        value=value+f(depth[None,:],*[x[:,i:i+1] for i in range(k,k+nargs)])
+        k+=nargs
+    return value
+
+
+def model_jacobian(model,depth,x):
+    #(profiles, depths, parameters) derivatives of the model values
+    jacs=[]
+    k=0
+    for shape in model['shapes']:
+        f,jac,nargs=shapes[shape]
+        jacs+=jac(depth[None,:],*[x[:,i:i+1] for i in range(k,k+nargs)])
+        k+=nargs
+    return np.stack(jacs,axis=2)
+
+
+def model_curves(depth,params):
+    '''(6, depths) curves of the six models for one row of params (e.g. to
+    plot the best fits, or the initial fits from initial_params).'''
+    depth=np.asarray(depth,dtype=float)
+    params=np.asarray(params,dtype=float)
+    return np.array([model_value(m,depth,params[None,columns[i]:columns[i+1]])[0]
+                     for i,m in enumerate(models)])
+
+
+def bounds(model):
+    low=np.array([p[2] for p in model['params']],dtype=float)
+    high=np.array([p[3] for p in model['params']],dtype=float)
+    return low,high
+
+
+def grid_start(model,depth,y,block=256):
+    '''Starting parameters for each profile (rows of y) from a grid search:
+    for every combination of the grid values of the arguments the model is
+    not linear in (shape_grids, within the bounds), the linear ones (the
+    amplitudes, and the line) are solved for by least squares and clipped to
+    their bounds, and the combination with the lowest chi-square is kept.
+    Starting the fits from here as well as from the notebook's guesses keeps
+    them out of most of the poor local minima.'''
+    low,high=bounds(model)
+    linear=[]
+    grids=[]
+    bases=[]
+    k=0
+    for shape in model['shapes']:
+        f,jac,nargs=shapes[shape]
+        lin=[i for i in range(nargs) if i not in shape_grids[shape]]
+        values=[np.unique(np.clip(v,low[k+i],high[k+i])) for i,v in shape_grids[shape].items()]
+        combos=np.array(np.meshgrid(*values,indexing='ij')).reshape(len(values),-1).T if values else np.zeros((1,0))
+        #basis function of each linear argument for each combination
+        basis=[]
+        for j in lin:
+            args=np.zeros((len(combos),nargs))
+            args[:,j]=1
+            args[:,list(shape_grids[shape])]=combos
+            basis.append(f(depth[None,:],*[args[:,i:i+1] for i in range(nargs)])+0*depth[None,:])
+        linear+=[k+j for j in lin]
+        grids.append([k+i for i in shape_grids[shape]])
+        bases.append((combos,np.stack(basis,axis=1)))
+        k+=nargs
+    #all combinations of the grid points of the shapes
+    count=[len(c) for c,b in bases]
+    pick=np.array(np.meshgrid(*[np.arange(c) for c in count],indexing='ij')).reshape(len(count),-1)
+    combos=np.concatenate([bases[i][0][pick[i]] for i in range(len(bases))],axis=1)
+    basis=np.concatenate([bases[i][1][pick[i]] for i in range(len(bases))],axis=1)
+    nonlinear=[i for g in grids for i in g]
+
+    n=len(y)
+    yy=(y**2).sum(1)
+    best=np.inf*np.ones(n)
+    x=np.zeros((n,len(low)))
+    rows=np.arange(n)
+    for b in range(0,len(combos),block):
+        B=basis[b:b+block]
+        G=B@B.transpose(0,2,1)
+        By=(y@B.reshape(-1,len(depth)).T).reshape(n,len(B),-1)
+        coef=(By[:,:,None,:]@np.linalg.pinv(G)[None])[:,:,0,:]
+        coef=np.clip(coef,low[linear],high[linear])
+        cost=yy[:,None]-2*(coef*By).sum(2)+((coef[:,:,None,:]@G[None])[:,:,0,:]*coef).sum(2)
+        i=cost.argmin(1)
+        better=cost[rows,i]<best
+        best[better]=cost[rows,i][better]
+        x[np.ix_(better,linear)]=coef[rows,i][better]
+        x[np.ix_(better,nonlinear)]=combos[b+i[better]]
+    #just inside the bounds, where the internal variables can still move
+    span=np.where(np.isfinite(high-low),high-low,0)
+    return np.clip(x,low+1e-3*span,high-1e-3*span)
+
+
+def to_internal(x,low,high):
+    #as lmfit: bounded parameters are fitted as arcsin(2*(x-min)/(max-min)-1)
+    both=np.isfinite(low)&np.isfinite(high)
+    x=np.clip(x,low,high)
+    t=x.copy()
+    t[:,both]=np.arcsin(np.clip(2*(x[:,both]-low[both])/(high[both]-low[both])-1,-1,1))
+    return t
+
+
+def from_internal(t,low,high):
+    #parameters and their derivatives with respect to the internal variables
+    both=np.isfinite(low)&np.isfinite(high)
+    x=t.copy()
+    dx=np.ones_like(t)
+    x[:,both]=low[both]+(np.sin(t[:,both])+1)*(high[both]-low[both])/2
+    dx[:,both]=np.cos(t[:,both])*(high[both]-low[both])/2
+    return x,dx
+
+
+def aic_value(chisq,n,k):
+    #as lmfit: n*log(chisq/n)+2*parameters
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return n*np.log(np.maximum(chisq,1e-250)/n)+2*k
+
+
+def fit_model(model,depth,y,x0,max_iter=200,ftol=1e-10,xtol=1e-10):
+    '''Least squares fits of model to each profile (rows of y) from the
+    initial parameters x0 by Levenberg-Marquardt, all profiles at once.
+    Returns the parameters, chi-square (sum of squared residuals), AIC and
+    whether each fit converged within max_iter steps.'''
+    low,high=bounds(model)
+    n,k=x0.shape
+    t=to_internal(x0,low,high)
+    x,dx=from_internal(t,low,high)
+    with np.errstate(all='ignore'):
+        cost=((model_value(model,depth,x)-y)**2).sum(1)
+    cost[~np.isfinite(cost)]=np.inf
+    lam=1e-3*np.ones(n)
+    #as MINPACK, each parameter is damped by the largest curvature it has had,
+    #so a parameter that reaches a bound cannot take huge steps
+    scale=1e-12*np.ones((n,k))
+    #the normal equations are only recomputed after a step is taken; a
+    #rejected step only raises the damping
+    A0=np.zeros((n,k,k))
+    g=np.zeros((n,k))
+    stale=np.ones(n,dtype=bool)
+    active=np.ones(n,dtype=bool)
+    for it in range(max_iter):
+        idx=np.flatnonzero(active)
+        if len(idx)==0:
+            break
+        with np.errstate(all='ignore'):
+            s=idx[stale[idx]]
+            if len(s):
+                xi,dxi=from_internal(t[s],low,high)
+                r=model_value(model,depth,xi)-y[s]
+                J=model_jacobian(model,depth,xi)*dxi[:,None,:]
+                J[~np.isfinite(J)]=0.
+                r[~np.isfinite(r)]=0.
+                Jt=J.transpose(0,2,1)
+                g[s]=(Jt@r[:,:,None])[:,:,0]
+                A0[s]=Jt@J
+                scale[s]=np.maximum(scale[s],np.diagonal(A0[s],axis1=1,axis2=2))
+                stale[s]=False
+            damping=np.maximum(scale[idx],1e-12*scale[idx].max(1,keepdims=True))
+            A=A0[idx]+(lam[idx,None]*damping)[:,:,None]*np.eye(k)[None]
+            try:
+                step=-np.linalg.solve(A,g[idx][:,:,None])[:,:,0]
+            except np.linalg.LinAlgError:
+                step=-(np.linalg.pinv(A)@g[idx][:,:,None])[:,:,0]
+            t_new=t[idx]+step
+            x_new,dx_new=from_internal(t_new,low,high)
+            c_new=((model_value(model,depth,x_new)-y[idx])**2).sum(1)
+        better=np.isfinite(c_new)&(c_new<cost[idx])
+        #as MINPACK, stop when a step changes the cost or the parameters by
+        #less than ftol or xtol relative to their size
+        small=better&((cost[idx]-c_new<=ftol*cost[idx])|
+                      (np.abs(step).max(1)<=xtol*(np.abs(t[idx]).max(1)+xtol)))
+        t[idx[better]]=t_new[better]
+        cost[idx[better]]=c_new[better]
+        stale[idx[better]]=True
+        lam[idx]=np.where(better,np.maximum(lam[idx]*0.1,1e-12),lam[idx]*10)
+        #stop when the cost no longer goes down, or no step reduces it
+        done=small|(lam[idx]>1e10)|(np.abs(g[idx]).max(1)<=1e-15*np.maximum(cost[idx],1e-300))
+        active[idx[done]]=False
+    x,dx=from_internal(t,low,high)
+    chisq=np.where(np.isfinite(cost),cost,np.nan)
+    return x,chisq,aic_value(chisq,y.shape[1],k),~active
+
+
+def fit_minpack(model,depth,y,x0):
+    '''Fits of model to each profile (rows of y) one at a time with MINPACK
+    (scipy.optimize.leastsq) on the same internal variables and with the same
+    settings (finite-difference derivatives, tolerances and number of
+    evaluations) as lmfit, so that they end where the notebook's fits do.
+    Returns the parameters, chi-square and AIC, as fit_model.'''
+    from scipy.optimize import leastsq
+    low,high=bounds(model)
+    n,k=x0.shape
+    t0=to_internal(x0,low,high)
+    x=np.nan*np.ones((n,k))
+    chisq=np.nan*np.ones(n)
+    for i in range(n):
+        def residual(t):
+            return model_value(model,depth,from_internal(t[None],low,high)[0])[0]-y[i]
+        #as lmfit, a fit that runs out of evaluations keeps where it got to
+        with np.errstate(all='ignore'),warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning)
+            t=leastsq(residual,t0[i],ftol=1.5e-8,xtol=1.5e-8,gtol=0.,maxfev=2000*(k+1),
+                      epsfcn=1.e-10,factor=100)[0]
+            x[i]=from_internal(t[None],low,high)[0][0]
+            chisq[i]=(residual(t)**2).sum()
+    chisq[~np.isfinite(chisq)]=np.nan
+    return x,chisq,aic_value(chisq,y.shape[1],k)
+
+
+def start_points(i,depth,y,x0,fits):
+    '''Starting parameters for the fits of model i: x0 (the notebook's
+    guesses, or the warm start) and grid_start. For the composite models,
+    whose grid is too large to search at once, the fits of the single shapes
+    (fits, by model number) added together, and each of those with the
+    other shape instead searched on what is left of the profile.'''
+    m=models[i]
+    single=[[n for n,s in enumerate(models) if s['shapes']==[shape]] for shape in m['shapes']]
+    if len(m['shapes'])==1 or not all(single):
+        return [x0,grid_start(m,depth,y)]
+    single=[n[0] for n in single]
+    starts=[x0,np.column_stack([fits[n] for n in single])]
+    for n in single:
+        rest=sum(model_value(models[s],depth,fits[s]) for s in single if s!=n)
+        starts.append(np.column_stack([grid_start(models[n],depth,y-rest) if s==n else fits[s] for s in single]))
+    return starts
+
+
+def fit_chunk(chla,depth,start=None,max_iter=200,refit='flagged'):
+    '''params, AIC and chisq of the six models for a chunk of profiles. start
+    is an optional (profiles, 24) array of starting parameters (nan where the
+    initial guesses should be used). Each model is fitted from each of its
+    start_points, keeping the fit with the lowest chi-square. With
+    refit='flagged', fits that did not converge or ended above the
+    chi-square of the initial guesses are then refitted from the initial
+    guesses with fit_minpack, keeping the better of the two (refit='all'
+    refits every fit, refit=None none).'''
+    chla=np.asarray(chla,dtype=float)
+    depth=np.asarray(depth,dtype=float)
+    n=len(chla)
+    params=np.nan*np.ones((n,columns[-1]))
+    AIC=np.nan*np.ones((n,len(models)))
+    chisq=np.nan*np.ones((n,len(models)))
+    #profiles with missing values are not fitted (lmfit raises an error for them)
+    good=np.flatnonzero(np.isfinite(chla).all(1))
+    if len(good)==0:
+        return params,AIC,chisq
+    y=chla[good]
+    guesses=initial_params(y,depth)
+    x0=guesses
+    if start is not None:
+        start=np.asarray(start,dtype=float)[good]
+        x0=np.where(np.isfinite(start),start,x0)
+    fits={}
+    for i,m in enumerate(models):
+        cols=slice(columns[i],columns[i+1])
+        x=c=None
+        for s in start_points(i,depth,y,x0[:,cols],fits):
+            xs,cs,as_,cv=fit_model(m,depth,y,s,max_iter)
+            if x is None:
+                x,c,a,converged=xs,cs,as_,cv
+                continue
+            better=np.isfinite(cs)&~(cs>=c)
+            x[better],c[better],a[better],converged[better]=xs[better],cs[better],as_[better],cv[better]
+        fits[i]=x
+        if refit=='all':
+            redo=np.ones(len(y),dtype=bool)
+        elif refit=='flagged':
+            with np.errstate(all='ignore'):
+                c0=((model_value(m,depth,guesses[:,cols])-y)**2).sum(1)
+            redo=~converged|~np.isfinite(c)|(c>c0)
+        else:
+            redo=np.zeros(len(y),dtype=bool)
+        redo=np.flatnonzero(redo)
+        if len(redo)>0:
+            xm,cm,am=fit_minpack(m,depth,y[redo],guesses[redo,cols])
+            #keep the MINPACK fit where it is better (or the batched one failed)
+            better=np.isfinite(cm)&~(cm>=c[redo])
+            x[redo[better]]=xm[better]
+            c[redo[better]]=cm[better]
+            a[redo[better]]=am[better]
+        params[good,cols]=x
+        chisq[good,i]=c
+        AIC[good,i]=a
+    return params,AIC,chisq
+
+
+def fit_profiles(chla,depth,labels=None,cluster_params=None,workers=1,chunksize=2000,max_iter=200,
+                 refit='flagged'):
+    '''Fit the six models to every profile (rows of chla, on the depths
+    depth). With cluster_params (the params of the fits to the cluster-average
+    profiles, one row per cluster) and labels (the cluster of each profile,
+    e.g. gmm_new_labels), each profile starts from the fit of its cluster
+    (warm start; the composite fits can then end in a different local
+    minimum than from the initial guesses). The chunks of chunksize profiles
+    are fitted on workers processes; see fit_chunk for refit. Returns params
+    (profiles, 24), AIC and chisq (profiles, 6).'''
+    chla=np.asarray(chla,dtype=float)
+    depth=np.asarray(depth,dtype=float)
+    start=None
+    if cluster_params is not None:
+        labels=np.asarray(labels,dtype=float)
+        start=np.nan*np.ones((len(chla),columns[-1]))
+        known=np.isfinite(labels)
+        start[known]=np.asarray(cluster_params,dtype=float)[labels[known].astype(int)]
+    starts=range(0,len(chla),chunksize)
+    args=[(chla[s:s+chunksize],depth,None if start is None else start[s:s+chunksize],max_iter,refit)
+          for s in starts]
+    if workers==1:
+        results=[fit_chunk(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results=list(pool.map(fit_chunk,*zip(*args)))
+    if not results:
+        return fit_chunk(chla,depth,refit=refit)
+    params,AIC,chisq=[np.concatenate(r) for r in zip(*results)]
+    return params,AIC,chisq
+
+
+def fit_lmfit(y,depth,guesses):
+    '''The lmfit fits of the notebook for one profile (for comparison with
+    fit_chunk); guesses is one row of initial_params.'''
+    from lmfit import Parameters, minimize
+    params=np.nan*np.ones(columns[-1])
+    AIC=np.nan*np.ones(len(models))
+    chisq=np.nan*np.ones(len(models))
+    for i,m in enumerate(models):
+        pars=Parameters()
+        for j,(name,guess,low,high) in enumerate(m['params']):
+            pars.add('p%d' %j,value=guesses[columns[i]+j],min=low,max=high)
+        try:
+            result=minimize(lambda p: model_value(m,depth,np.array([[p['p%d' %j].value
+                            for j in range(len(m['params']))]]))[0]-y,pars)
+        except ValueError:
+            continue
+        params[columns[i]:columns[i+1]]=[result.params['p%d' %j].value for j in range(len(m['params']))]
+        AIC[i]=result.aic
+        chisq[i]=result.chisqr
+    return params,AIC,chisq
+
+
+def compare_with_lmfit(chla,depth,sample=200,seed=0,tolerance=0.01,refit='flagged'):
+    '''Fit a random sample of profiles with lmfit (one profile and model at a
+    time, as in the notebook) and with fit_chunk, and report the times and how
+    often the two give the same best model (lowest AIC), the same chi-square
+    (within tolerance, relative), and a chi-square no worse or better than
+    lmfit's (by more than tolerance).'''
+    chla=np.asarray(chla,dtype=float)
+    depth=np.asarray(depth,dtype=float)
+    rng=np.random.default_rng(seed)
+    rows=np.sort(rng.choice(len(chla),min(sample,len(chla)),replace=False))
+    guesses=initial_params(chla[rows],depth)
+    start=time.perf_counter()
+    lm=[fit_lmfit(chla[r],depth,g) for r,g in zip(rows,guesses)]
+    lm_time=time.perf_counter()-start
+    start=time.perf_counter()
+    params,AIC,chisq=fit_chunk(chla[rows],depth,refit=refit)
+    batch_time=time.perf_counter()-start
+    lm_AIC=np.array([r[1] for r in lm])
+    lm_chisq=np.array([r[2] for r in lm])
+    fitted=np.isfinite(lm_AIC).all(1)&np.isfinite(AIC).all(1)
+    same_best=np.mean(np.nanargmin(lm_AIC[fitted],1)==np.nanargmin(AIC[fitted],1))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        close=np.abs(chisq-lm_chisq)<=tolerance*np.maximum(lm_chisq,1e-12)
+        not_worse=chisq<=lm_chisq*(1+tolerance)+1e-12
+        better=chisq<lm_chisq*(1-tolerance)
+    print('lmfit: %.3f s, batched: %.3f s (%.0fx) for %d profiles'
+          %(lm_time,batch_time,lm_time/batch_time,len(rows)))
+    print('Same best model: %.1f%% of profiles' %(100*same_best))
+    print('Same chi-square (within %g%%): %s' %(100*tolerance,np.round(100*close[fitted].mean(0),1)))
+    print('Chi-square no worse than lmfit: %s' %np.round(100*not_worse[fitted].mean(0),1))
+    print('Chi-square better than lmfit: %s' %np.round(100*better[fitted].mean(0),1))
+    return {'lmfit_time':lm_time,'batch_time':batch_time,'same_best':same_best,
+            'same_chisq':close[fitted].mean(0),'not_worse':not_worse[fitted].mean(0),'fitted':int(fitted.sum()),
+            'worse':[(int(rows[n]),models[i]['name']) for n,i in zip(*np.nonzero(fitted[:,None]&~not_worse))],
+            'better':[(int(rows[n]),models[i]['name']) for n,i in zip(*np.nonzero(fitted[:,None]&better))]}
+
+
+def check_with_lmfit(chla,depth,sample=200,seed=0,tolerance=0.01,refit='flagged',max_worse=0.02):
+    '''compare_with_lmfit, failing (AssertionError) if, for any model, more
+    than max_worse of the fits have a chi-square worse than lmfit's by more
+    than tolerance (relative), or fewer are better than lmfit's than worse.
+    With refit='all', no fit may be worse.'''
+    result=compare_with_lmfit(chla,depth,sample,seed,tolerance,refit)
+    worse=np.array([sum(m==w for r,w in result['worse']) for m in [m['name'] for m in models]])
+    better=np.array([sum(m==b for r,b in result['better']) for m in [m['name'] for m in models]])
+    allowed=0 if refit=='all' else max_worse*result['fitted']
+    assert ((worse<=allowed)&((worse==0)|(better>=worse))).all(), \
+        'fits worse than lmfit (profile, model): %s' %result['worse']
+    return True
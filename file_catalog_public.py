@@ -0,0 +1,100 @@
+'''This code keeps a catalog of the profile files in the local copy of the
+GDAC synthetic profiles, used by "bgc_argo_data_process_public.py" to build
+its list of files. The directory is scanned once and the float number, cycle
+number, data mode (SD = delayed mode, SR = real time) and direction (a "D"
+suffix marks a descending profile) are parsed from each file name and stored
+in a small SQLite database next to the data. Later runs only rescan the
+directory if it has changed, and only re-read the entries whose size or
+modification time has changed; a file rewritten in place does not change the
+directory, so use full=True (e.g. after a sync that overwrote files) to
+check every file. Entries are kept per data directory, so one catalog can
+serve several of them. Picking the best file for each float and cycle (delayed mode
+if it is available) is then a single pass over the catalog. This code was
+written by PhD student Rosalind Echols.
+'''
+
+import os
+import re
+import sqlite3
+
+#e.g. SD5904855_122.nc, SR5904855_122D.nc
+name_pattern=re.compile(r'^S([DR])(\d+)_(\d+)(D?)\.nc$')
+
+
+def parse_filename(name):
+    #returns (float number, cycle number, mode, descending) or None
+    match=name_pattern.match(name)
+    if match is None:
+        return None
+    mode,number,cycle,descending=match.groups()
+    return number,int(cycle),'S'+mode,descending=='D'
+
+
+def open_catalog(catalog_file):
+    conn=sqlite3.connect(catalog_file)
+    #catalogs from before the path column are rebuilt by the next refresh
+    columns=[row[1] for row in conn.execute('PRAGMA table_info(files)')]
+    if columns and 'path' not in columns:
+        conn.execute('DROP TABLE files')
+        conn.execute('DROP TABLE IF EXISTS scans')
+    conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT, name TEXT, float TEXT, cycle INTEGER, '
+                 'mode TEXT, descending INTEGER, mtime REAL, size INTEGER, PRIMARY KEY (path, name))')
+    conn.execute('CREATE INDEX IF NOT EXISTS float_cycle ON files (path, float, cycle)')
+    conn.execute('CREATE TABLE IF NOT EXISTS scans (path TEXT PRIMARY KEY, mtime REAL)')
+    conn.commit()
+    return conn
+
+
+def refresh_catalog(conn,path,full=False):
+    '''Bring the catalog up to date with the files in path. Unless full is
+    True, the directory is only listed if its modification time has changed
+    since the last scan. Files whose size or modification time has changed
+    are read again. Returns the numbers of added, removed and changed files.'''
+    dir_mtime=os.stat(path).st_mtime
+    last=conn.execute('SELECT mtime FROM scans WHERE path=?',(path,)).fetchone()
+    if not full and last is not None and last[0]==dir_mtime:
+        return 0,0,0
+
+    known=dict((name,(mtime,size)) for name,mtime,size in
+               conn.execute('SELECT name, mtime, size FROM files WHERE path=?',(path,)))
+    seen=set()
+    new_rows=[]
+    changed=0
+    for entry in os.scandir(path):
+        info=parse_filename(entry.name)
+        if info is None:
+            continue
+        seen.add(entry.name)
+        stat=entry.stat()
+        if entry.name in known and known[entry.name]==(stat.st_mtime,stat.st_size):
+            continue
+        if entry.name in known:
+            changed+=1
+        new_rows.append((path,entry.name,info[0],info[1],info[2],int(info[3]),stat.st_mtime,stat.st_size))
+    removed=[(path,name) for name in known if name not in seen]
+
+    conn.executemany('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)',new_rows)
+    conn.executemany('DELETE FROM files WHERE path=? AND name=?',removed)
+    conn.execute('INSERT OR REPLACE INTO scans VALUES (?,?)',(path,dir_mtime))
+    conn.commit()
+
+    return len(new_rows)-changed,len(removed),changed
+
+
+def best_files(conn,path,float_numbers=None,descending=False):
+    '''One file per float and cycle, using the delayed mode (SD) file when both
+    delayed mode and real time files are available. Descending profiles are
+    left out unless descending is True. If float_numbers is given, only those
+    floats are returned.'''
+    if float_numbers is not None:
+        float_numbers=set(float_numbers)
+    best={}
+    query='SELECT name, float, cycle, mode FROM files WHERE path=? AND descending=?'
+    for name,number,cycle,mode in conn.execute(query,(path,int(descending))):
+        if float_numbers is not None and number not in float_numbers:
+            continue
+        key=(number,cycle)
+        if key not in best or mode=='SD':
+            best[key]=name
+
+    return [path+best[key] for key in sorted(best)]
@@ -0,0 +1,220 @@
+'''This is a download engine for the Argo GDAC FTP server, used by
+"bgc_argo_download_public.py" in place of a single serial FTP session. A
+bounded pool of worker threads each holds its own FTP connection, so
+throughput scales with the number of connections. Files are written to a
+".part" file, resumed from where they stopped (REST offset) if a connection
+drops, and renamed into place only once complete, so an interrupted run loses
+at most the files that were in flight. The size and modification time (MDTM)
+of the remote file are kept next to the ".part" file, and a transfer is only
+resumed if the remote file has not changed since, so two versions of a file
+are never joined together. The engine only needs an FTP host and
+port, so it can be pointed at a local stand-in server (e.g. pyftpdlib) for
+testing. This code was written by PhD student Rosalind Echols.
+'''
+
+import os
+import time
+import queue
+import threading
+import ftplib
+from ftplib import FTP
+from tqdm import tqdm
+
+GDAC_HOST='ftp.ifremer.fr'
+GDAC_DAC='/ifremer/argo/dac'
+
+
+def connect(host=GDAC_HOST,port=21,user='',passwd='',timeout=60,cwd=None):
+    #open an FTP session in binary mode; an empty user logs in anonymously
+    ftp=FTP()
+    ftp.connect(host,port,timeout=timeout)
+    ftp.login(user,passwd)
+    ftp.voidcmd('TYPE I')
+    if cwd:
+        ftp.cwd(cwd)
+    return ftp
+
+
+def remote_version(ftp,remote):
+    #size and modification time of a remote file (None for what the server
+    #does not support)
+    try:
+        size=ftp.size(remote)
+    except ftplib.error_perm:
+        size=None
+    try:
+        mdtm=ftp.voidcmd('MDTM '+remote).split()[-1]
+    except ftplib.error_perm:
+        mdtm=None
+    return size,mdtm
+
+
+def fetch_file(ftp,remote,local,callback=None,blocksize=65536,verify=None):
+    '''Download a single file, resuming from an existing "local.part" file if
+    there is one, and rename it to "local" once the transfer is complete.
+    A ".part" file is only resumed if the size and modification time of the
+    remote file are the ones saved when it was started (in "local.part.version").
+    verify(remote,part_file), if given, checks the finished transfer before
+    it replaces local. Returns the number of bytes transferred during this call.'''
+    part=local+'.part'
+    version_file=part+'.version'
+
+    #the size is used to skip finished transfers and to check for truncation;
+    #not all servers support SIZE, in which case we just trust the transfer
+    size,mdtm=remote_version(ftp,remote)
+    version='%s %s' %(size,mdtm)
+    offset=os.path.getsize(part) if os.path.exists(part) else 0
+    if offset>0:
+        saved=None
+        if os.path.exists(version_file):
+            with open(version_file) as fp:
+                saved=fp.read().strip()
+        #without a size and a time to compare, a partial file can't be trusted
+        if saved!=version or (size is None and mdtm is None) or (size is not None and offset>size):
+            offset=0
+    if offset==0:
+        with open(version_file,'w') as fp:
+            fp.write(version)
+
+    transferred=[0]
+    def write(block):
+        fp.write(block)
+        transferred[0]+=len(block)
+        if callback is not None:
+            callback(len(block))
+
+    if size is None or offset<size:
+        try:
+            with open(part,'ab' if offset>0 else 'wb') as fp:
+                ftp.retrbinary('RETR '+remote,write,blocksize,rest=offset if offset>0 else None)
+        except ftplib.error_perm:
+            #don't leave empty placeholders behind for files that don't exist
+            if os.path.getsize(part)==0:
+                os.remove(part)
+                os.remove(version_file)
+            raise
+
+    if size is not None and os.path.getsize(part)!=size:
+        raise OSError('incomplete transfer of %s (%d of %d bytes)' %(remote,os.path.getsize(part),size))
+    if verify is not None and not verify(remote,part):
+        #start over on the next attempt
+        os.remove(part)
+        os.remove(version_file)
+        raise ftplib.error_temp('checksum mismatch for %s' %remote)
+    os.replace(part,local)
+    os.remove(version_file)
+
+    return transferred[0]
+
+
+def _close(ftp):
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        ftp.close()
+
+
+def _worker(jobs,conn_args,retries,backoff,state,on_complete,verify):
+    #each worker keeps one connection open for as many files as it can, and
+    #only reconnects after an error
+    ftp=None
+    while True:
+        job=jobs.get()
+        if job is None:
+            break
+        remote,local=job
+        for attempt in range(retries+1):
+            try:
+                if ftp is None:
+                    ftp=connect(**conn_args)
+                fetch_file(ftp,remote,local,callback=state['add_bytes'],verify=verify)
+                state['finish'](remote,local,None)
+                if on_complete is not None:
+                    with state['lock']:
+                        on_complete(remote,local)
+                break
+            except ftplib.error_perm as err:
+                #permanent errors (e.g. 550 file not found) will not go away
+                #with a retry
+                state['finish'](remote,local,err)
+                break
+            except ftplib.all_errors as err:
+                if ftp is not None:
+                    ftp.close()
+                    ftp=None
+                if attempt==retries:
+                    state['finish'](remote,local,err)
+                else:
+                    time.sleep(backoff*2**attempt)
+    if ftp is not None:
+        _close(ftp)
+
+
+def download_files(remote_files,local_dir,host=GDAC_HOST,root=GDAC_DAC,port=21,user='',
+                   passwd='',connections=4,retries=5,backoff=2.,timeout=60,
+                   overwrite=False,on_complete=None,progress=True,verify=None):
+    '''Download a list of files (paths relative to root, as given in the GDAC
+    index files) into local_dir using a pool of FTP connections.
+
+    Files that already exist in local_dir are skipped unless overwrite is True.
+    Failed transfers are retried with exponential backoff (backoff*2**attempt
+    seconds). on_complete(remote,local) is called, one at a time, after each
+    successful download, which lets the caller record progress as it goes.
+    verify(remote,part_file) checks each transfer (e.g. against a checksum);
+    files that fail it are downloaded again, as for a dropped connection.
+
+    Returns a dictionary with the completed and failed files, the number of
+    bytes transferred and the elapsed time.'''
+    jobs=queue.Queue()
+    total=0
+    skipped=[]
+    for remote in remote_files:
+        local=os.path.join(local_dir,os.path.basename(remote))
+        if not overwrite and os.path.exists(local):
+            skipped.append(remote)
+            continue
+        jobs.put((remote,local))
+        total+=1
+
+    connections=max(1,min(connections,total))
+    for n in range(connections):
+        jobs.put(None)
+
+    lock=threading.Lock()
+    summary={'done':[],'failed':[],'skipped':skipped,'bytes':0,'seconds':0.}
+    bar=tqdm(total=total,unit='file',disable=not progress)
+    start=time.time()
+
+    def add_bytes(nbytes):
+        with lock:
+            summary['bytes']+=nbytes
+
+    def finish(remote,local,err):
+        with lock:
+            if err is None:
+                summary['done'].append(remote)
+            else:
+                summary['failed'].append((remote,str(err)))
+            elapsed=max(time.time()-start,1e-9)
+            bar.update(1)
+            bar.set_postfix({'files/s':'%.1f' %(len(summary['done'])/elapsed),
+                             'MB/s':'%.2f' %(summary['bytes']/elapsed/1e6)},refresh=False)
+
+    state={'lock':lock,'add_bytes':add_bytes,'finish':finish}
+    conn_args={'host':host,'port':port,'user':user,'passwd':passwd,'timeout':timeout,'cwd':root}
+
+    threads=[threading.Thread(target=_worker,args=(jobs,conn_args,retries,backoff,state,on_complete,verify),
+                              daemon=True) for n in range(connections if total>0 else 0)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    bar.close()
+
+    summary['seconds']=time.time()-start
+    elapsed=max(summary['seconds'],1e-9)
+    print('Downloaded %d files (%d failed, %d already present) in %.1f s: %.1f files/s, %.2f MB/s'
+          %(len(summary['done']),len(summary['failed']),len(skipped),summary['seconds'],
+            len(summary['done'])/elapsed,summary['bytes']/elapsed/1e6))
+
+    return summary
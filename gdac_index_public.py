@@ -0,0 +1,211 @@
+'''This code keeps a local mirror of the GDAC synthetic profiles in step with
+the profile index (argo_synthetic-profile_index.txt). It is used by
+"bgc_argo_download_public.py" when delta_sync is set to True. Rather than only
+comparing file names, it keeps a manifest of every downloaded file (path,
+date_update, size and checksum) in a small SQLite database, and compares it
+with the date_update column of the index, so profiles that the DACs have
+reprocessed are downloaded again and profiles that have been removed from the
+GDAC are removed locally. Comparing the index and the manifest is a single
+pass over the index with dictionary lookups, so a daily sync only has to
+transfer the profiles that changed. When the index has a checksum column
+(md5), each downloaded file is checked against it before it is recorded in
+the manifest, and downloaded again if it does not match. This code was written by PhD student
+Rosalind Echols.
+'''
+
+import os
+import hashlib
+import sqlite3
+
+from gdac_ftp_public import download_files
+
+
+def read_index(index_file):
+    '''Stream (file, date_update) pairs from a GDAC profile index file without
+    loading the whole file into memory.'''
+    with open(index_file) as lines:
+        columns=None
+        for line in lines:
+            if line.startswith('#') or not line.strip():
+                continue
+            row=line.rstrip('\n').split(',')
+            if columns is None:
+                #first non-comment line is the header
+                columns=row
+                file_col=columns.index('file')
+                date_col=columns.index('date_update')
+                continue
+            yield row[file_col],row[date_col]
+
+
+def index_checksums(index_file,paths):
+    '''Dictionary of path: md5 from the checksum column ('md5' or 'checksum')
+    of an index file, for the given paths only. Empty if the index has no
+    checksum column.'''
+    checksums={}
+    with open(index_file) as lines:
+        columns=None
+        for line in lines:
+            if line.startswith('#') or not line.strip():
+                continue
+            row=line.rstrip('\n').split(',')
+            if columns is None:
+                columns=row
+                names=[c for c in ['md5','checksum'] if c in columns]
+                if not names:
+                    return checksums
+                file_col=columns.index('file')
+                sum_col=columns.index(names[0])
+                continue
+            if row[file_col] in paths and row[sum_col]:
+                checksums[row[file_col]]=row[sum_col].strip().lower()
+    return checksums
+
+
+def read_greylist(greylist_file):
+    #float numbers (PLATFORM_CODE) of all greylisted floats
+    grey=set()
+    with open(greylist_file) as lines:
+        next(lines)
+        for line in lines:
+            if line.strip():
+                grey.add(line.split(',')[0].strip())
+    return grey
+
+
+def open_manifest(manifest_file):
+    #the manifest is used from the download threads, one call at a time
+    conn=sqlite3.connect(manifest_file,check_same_thread=False)
+    conn.execute('CREATE TABLE IF NOT EXISTS manifest (path TEXT PRIMARY KEY, '
+                 'date_update TEXT, size INTEGER, checksum TEXT)')
+    conn.commit()
+    return conn
+
+
+def load_manifest(conn):
+    #dictionary of path: date_update for everything that has been downloaded
+    return dict(conn.execute('SELECT path, date_update FROM manifest'))
+
+
+def file_checksum(file_path,blocksize=1<<20):
+    md5=hashlib.md5()
+    with open(file_path,'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize),b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def record_file(conn,path,date_update,local_file,commit=True,checksum=None):
+    if checksum is None:
+        checksum=file_checksum(local_file)
+    conn.execute('INSERT OR REPLACE INTO manifest VALUES (?,?,?,?)',
+                 (path,date_update,os.path.getsize(local_file),checksum))
+    if commit:
+        conn.commit()
+
+
+def compute_delta(index_rows,manifest,grey=()):
+    '''Compare the index with the manifest in a single pass. Returns the lists
+    of paths to add (not yet downloaded), update (date_update has changed) and
+    delete (downloaded, but no longer in the index), plus a dictionary of
+    path: date_update for the index. Greylisted floats are never added or
+    updated, but files that were already downloaded for them are kept.'''
+    adds=[]
+    updates=[]
+    dates={}
+    for path,date_update in index_rows:
+        dates[path]=date_update
+        if path.split('/')[1] in grey:
+            continue
+        if path not in manifest:
+            adds.append(path)
+        elif manifest[path]!=date_update:
+            updates.append(path)
+    deletes=[path for path in manifest if path not in dates]
+
+    return adds,updates,deletes,dates
+
+
+def bootstrap_manifest(conn,namefile,index_file,local_dir):
+    '''Fill an empty manifest from an existing synthetic_namefile.txt, so that
+    switching to delta syncs does not download the whole archive again. Files
+    are assumed to be current with the index.'''
+    with open(namefile) as names:
+        done=set(n.strip() for n in names if n.strip())
+    count=0
+    for path,date_update in read_index(index_file):
+        if path not in done:
+            continue
+        local_file=os.path.join(local_dir,os.path.basename(path))
+        if os.path.isfile(local_file):
+            record_file(conn,path,date_update,local_file,commit=False)
+            count+=1
+    conn.commit()
+    return count
+
+
+def prune_namefile(namefile,paths):
+    '''Remove paths from a synthetic_namefile.txt (the list of downloaded files
+    of a full download), so a later full download does not take them as
+    already downloaded. The file is rewritten and then moved into place.
+    Returns the number of lines removed.'''
+    paths=set(paths)
+    with open(namefile) as names:
+        lines=[n for n in names if n.strip()]
+    keep=[n for n in lines if n.strip() not in paths]
+    with open(namefile+'.part','w') as names:
+        names.writelines(keep)
+    os.replace(namefile+'.part',namefile)
+    return len(lines)-len(keep)
+
+
+def delta_sync(local_dir,index_file,greylist_file,manifest_file,delete=True,namefile=None,**kwargs):
+    '''Bring local_dir in step with the index: download new and updated
+    profiles, record them in the manifest, and (optionally) delete local
+    profiles that are no longer on the GDAC, also removing them from namefile
+    (synthetic_namefile.txt) if it is given. Files are checked against the
+    md5 of the index, if it has one, before they are recorded; files that do
+    not match are downloaded again (and left out of the manifest if they
+    still do not match). Additional keyword arguments are passed to
+    gdac_ftp_public.download_files.'''
+    conn=open_manifest(manifest_file)
+    grey=read_greylist(greylist_file)
+    adds,updates,deletes,dates=compute_delta(read_index(index_file),load_manifest(conn),grey)
+    print('New profiles: %d, updated profiles: %d, removed profiles: %d' %(len(adds),len(updates),len(deletes)))
+
+    checksums=index_checksums(index_file,set(adds+updates))
+    verified={}
+    def verify(remote,part_file):
+        #called from the download threads, before the file replaces the old one
+        if remote not in checksums:
+            return True
+        checksum=file_checksum(part_file)
+        verified[remote]=checksum
+        return checksum==checksums[remote]
+
+    pending=[0]
+    def record(remote,local):
+        #on_complete calls are serialized by the download engine
+        record_file(conn,remote,dates[remote],local,commit=False,checksum=verified.get(remote))
+        pending[0]+=1
+        if pending[0]%100==0:
+            conn.commit()
+
+    summary=download_files(adds+updates,local_dir,overwrite=True,on_complete=record,verify=verify,**kwargs)
+    conn.commit()
+
+    if delete:
+        for path in deletes:
+            local_file=os.path.join(local_dir,os.path.basename(path))
+            if os.path.isfile(local_file):
+                os.remove(local_file)
+        conn.executemany('DELETE FROM manifest WHERE path=?',[(p,) for p in deletes])
+        conn.commit()
+        if namefile is not None and os.path.isfile(namefile) and deletes:
+            prune_namefile(namefile,deletes)
+    conn.close()
+
+    summary['added']=adds
+    summary['updated']=updates
+    summary['deleted']=deletes if delete else []
+    return summary
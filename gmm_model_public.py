@@ -0,0 +1,127 @@
+'''This code saves the fitted PCA and GMM from "GMM_Public.ipynb" (or from
+train_incremental in "gmm_training_public.py") as a model file, so that new
+profiles can be assigned to the clusters without refitting, and with the same
+cluster numbers every time. The model holds everything needed to go from an
+interpolated chlorophyll profile to a cluster: the offset added before taking
+the log (test_data in the notebook), the PCA mean and components, the GMM
+weights, means and covariances, and the resequencing of the clusters from
+sort_chl_profs. It is written as a single .npz file with a JSON header that
+records the format version, a model id (a hash of the parameters), the depth
+grid and the package versions. classify_profiles scores a batch of profiles
+(an array, or the profile dictionaries from process_files) with a vectorized
+transform and predict_proba, and classify_file does the same for a processed
+file in chunks. This code was written by PhD student Rosalind Echols.
+'''
+
+import json
+import time
+import hashlib
+import numpy as np
+import netCDF4
+import sklearn
+
+from gmm_training_public import profile_chunks, pca_transform, gmm_from_params
+from cluster_stats_public import relabel
+
+format_version=1
+
+
+def make_model(offset,pca,gmm,new_groups,depths,notes=''):
+    '''Model dictionary from the offset (test_data=data+offset), the PCA and
+    GMM (sklearn objects or the dictionaries of gmm_training_public) and
+    new_groups from sort_chl_profs.'''
+    if hasattr(pca,'components_'):
+        pca={'mean':pca.mean_,'components':pca.components_}
+    if hasattr(gmm,'means_'):
+        if gmm.covariance_type!='full':
+            raise ValueError('only full covariance GMMs can be saved')
+        gmm={'weights':gmm.weights_,'means':gmm.means_,'covariances':gmm.covariances_}
+    arrays={'pca_mean':np.asarray(pca['mean'],dtype=float),
+            'pca_components':np.asarray(pca['components'],dtype=float),
+            'gmm_weights':np.asarray(gmm['weights'],dtype=float),
+            'gmm_means':np.asarray(gmm['means'],dtype=float),
+            'gmm_covariances':np.asarray(gmm['covariances'],dtype=float),
+            'new_groups':np.asarray(new_groups,dtype=int),
+            'depths':np.asarray(depths,dtype=float),
+            'offset':np.array(float(offset))}
+    md5=hashlib.md5()
+    for name in sorted(arrays):
+        md5.update(name.encode())
+        md5.update(np.ascontiguousarray(arrays[name]).tobytes())
+    arrays['info']={'format_version':format_version,'model_id':md5.hexdigest()[:12],
+                    'created':time.strftime('%Y-%m-%dT%H:%M:%S'),'sklearn':sklearn.__version__,
+                    'numpy':np.__version__,'n_pcs':len(arrays['pca_components']),
+                    'n_clusters':len(arrays['gmm_weights']),'notes':notes}
+    return arrays
+
+
+def save_model(model,model_file):
+    #write a model to an .npz file (the header is stored as a JSON string)
+    arrays=dict((k,v) for k,v in model.items() if k not in ['info','gmm'])
+    np.savez(model_file,info=np.array(json.dumps(model['info'])),**arrays)
+    return model['info']['model_id']
+
+
+def load_model(model_file):
+    '''Read a model file written by save_model, with the fitted GMM ready for
+    classify_profiles.'''
+    with np.load(model_file,allow_pickle=False) as f:
+        model=dict((k,f[k]) for k in f.files)
+    model['info']=json.loads(str(model['info']))
+    if model['info']['format_version']>format_version:
+        raise ValueError('%s was written by a newer version (format %d)'
+                         %(model_file,model['info']['format_version']))
+    model['gmm']=gmm_from_params({'weights':model['gmm_weights'],'means':model['gmm_means'],
+                                  'covariances':model['gmm_covariances']})
+    return model
+
+
+def classify_profiles(model,profiles):
+    '''Cluster (numbered as after sort_chl_profs) and cluster probabilities
+    (columns in the same numbering) of each profile. profiles is a (profiles,
+    depths) array of chlorophyll on the model's depth grid, or a list of the
+    profile dictionaries from process_files. Profiles with chlorophyll below
+    the range the model was trained on (or missing values) get a nan log and
+    are given label -1 and nan probabilities.'''
+    if isinstance(profiles,list):
+        profiles=np.array([p['CHLA'] for p in profiles]).reshape(len(profiles),-1)
+    profiles=np.asarray(profiles,dtype=float)
+    if profiles.shape[1]!=len(model['depths']):
+        raise ValueError('profiles have %d depths, the model %d' %(profiles.shape[1],len(model['depths'])))
+    if 'gmm' not in model:
+        model['gmm']=gmm_from_params({'weights':model['gmm_weights'],'means':model['gmm_means'],
+                                      'covariances':model['gmm_covariances']})
+    pca={'mean':model['pca_mean'],'components':model['pca_components']}
+    with np.errstate(invalid='ignore',divide='ignore'):
+        log=np.log(profiles+model['offset'])
+    bad=~np.isfinite(log).all(1)
+    training=pca_transform(pca,np.where(bad[:,None],0.,log))
+    probs=model['gmm'].predict_proba(training)
+    labels=relabel(probs.argmax(1),model['new_groups'])
+    probs=probs[:,model['new_groups']]
+    labels[bad]=-1
+    probs[bad]=np.nan
+    return labels,probs
+
+
+def classify_file(model,sfpath,labels_file=None,chunk=20000):
+    '''Classify all of the profiles in a processed file, chunk by chunk.
+    Returns the labels and probabilities, and writes them (with the model
+    id) to labels_file if it is given; as in classify_profiles, profiles that
+    cannot be classified are given label -1.'''
+    labels,probs=[],[]
+    for start,x in profile_chunks(sfpath,'CHLA',chunk):
+        l,p=classify_profiles(model,x)
+        labels.append(l)
+        probs.append(p)
+    labels=np.concatenate(labels) if labels else np.zeros(0,dtype=int)
+    probs=np.concatenate(probs) if probs else np.zeros((0,len(model['gmm_weights'])))
+    if labels_file is not None:
+        with netCDF4.Dataset(labels_file,'w') as nc:
+            nc.createDimension('time',len(labels))
+            nc.createDimension('cluster',probs.shape[1])
+            nc.createVariable('GMM_LABEL','i2',('time',))[:]=labels
+            nc.createVariable('GMM_PROB','f4',('time','cluster'),zlib=True)[:]=probs
+            nc.model_id=model['info']['model_id']
+            nc.source=sfpath
+    return labels,probs
@@ -0,0 +1,216 @@
+'''This code computes the Bayesian and Akaike Information Criteria (BIC and
+AIC) used in "GMM_Public.ipynb" to choose the number of clusters, by fitting
+a Gaussian Mixture Model with each number of clusters to each of the test
+subsets (tlist). The (subset, number of clusters) fits are independent, so they
+are run on a pool of worker processes, and each result is stored in a small
+SQLite database under a key made from the subset data (in PC space, so the
+number of PCs is part of the key) and the number of clusters; re-running the
+sweep, e.g. with a different number of PCs or more clusters, only fits the
+cells that have not been fitted before. Optionally, each fit can start from
+the fit with one cluster fewer, with its widest cluster split in two
+(warm_start), instead of from k-means, and the sweep can stop once the mean
+BIC has clearly passed its minimum (stop_after). This code was written by PhD
+student Rosalind Echols.
+'''
+
+import pickle
+import hashlib
+import sqlite3
+import numpy as np
+import sklearn
+from sklearn.mixture import GaussianMixture
+from concurrent.futures import ProcessPoolExecutor
+
+#training data and test subsets of this process (set once per worker by
+#init_worker, so they are not sent with every fit)
+worker_data={}
+
+
+def init_worker(training,tlist):
+    worker_data['training']=training
+    worker_data['tlist']=tlist
+
+
+def subset_key(subset,*options):
+    #hash of a subset of the training data (in PC space) and the fit options
+    md5=hashlib.md5()
+    subset=np.ascontiguousarray(subset,dtype=float)
+    md5.update(repr(subset.shape).encode())
+    md5.update(subset.tobytes())
+    md5.update(repr(options+(sklearn.__version__,)).encode())
+    return md5.hexdigest()
+
+
+def open_fit_cache(cache_file):
+    '''Open (or create) the cache of fit results. Returns a dictionary with the
+    database connection and hit/miss counters.'''
+    conn=sqlite3.connect(cache_file)
+    conn.execute('CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, data BLOB)')
+    conn.commit()
+    return {'conn':conn,'hits':0,'misses':0}
+
+
+def cached_fit(cache,key):
+    #fit result stored under key, or None
+    if cache is None:
+        return None
+    row=cache['conn'].execute('SELECT data FROM fits WHERE key=?',(key,)).fetchone()
+    if row is None:
+        cache['misses']+=1
+        return None
+    cache['hits']+=1
+    return pickle.loads(row[0])
+
+
+def store_fit(cache,key,result):
+    if cache is not None:
+        cache['conn'].execute('INSERT OR REPLACE INTO fits VALUES (?,?)',
+                              (key,pickle.dumps(result,protocol=pickle.HIGHEST_PROTOCOL)))
+
+
+def close_fit_cache(cache):
+    if cache is not None:
+        cache['conn'].commit()
+        print('Fit cache: %d hits, %d misses' %(cache['hits'],cache['misses']))
+        cache['conn'].close()
+
+
+def component_covariances(fit,covariance_type):
+    #(clusters, features, features) covariance matrices of a fit
+    cov=fit['covariances']
+    k,d=fit['means'].shape
+    if covariance_type=='full':
+        return cov
+    elif covariance_type=='tied':
+        return np.repeat(cov[None],k,axis=0)
+    elif covariance_type=='diag':
+        return np.array([np.diag(c) for c in cov])
+    return cov[:,None,None]*np.eye(d)[None]
+
+
+def grow_init(fit,n,covariance_type):
+    '''Starting parameters for a fit with n clusters from a fit with fewer:
+    the widest cluster (largest weight times standard deviation along its
+    main axis) is split in two along that axis, until there are n clusters.'''
+    weights=list(fit['weights'])
+    means=list(fit['means'])
+    precisions=list(fit['precisions']) if covariance_type!='tied' else None
+    cov=list(component_covariances(fit,covariance_type))
+    while len(weights)<n:
+        spread=[np.linalg.eigh(c) for c in cov]
+        k=int(np.argmax([w*np.sqrt(e[0][-1]) for w,e in zip(weights,spread)]))
+        shift=np.sqrt(spread[k][0][-1])*spread[k][1][:,-1]
+        weights[k]/=2
+        weights.append(weights[k])
+        means.append(means[k]+shift)
+        means[k]=means[k]-shift
+        cov.append(cov[k])
+        if precisions is not None:
+            precisions.append(precisions[k])
+    init={'weights_init':np.array(weights),'means_init':np.array(means)}
+    init['precisions_init']=np.array(precisions) if precisions is not None else fit['precisions']
+    return init
+
+
+def fit_cell(subset,n,covariance_type='full',random_state=0,init=None):
+    '''Fit a GMM with n clusters to subset (starting from the parameters of a
+    smaller fit if init is given) and return its BIC, AIC and parameters.'''
+    options=grow_init(init,n,covariance_type) if init is not None else {}
+    gmm=GaussianMixture(n,covariance_type=covariance_type,random_state=random_state,**options).fit(subset)
+    return {'bic':gmm.bic(subset),'aic':gmm.aic(subset),'converged':bool(gmm.converged_),
+            'n_iter':int(gmm.n_iter_),'weights':gmm.weights_,'means':gmm.means_,
+            'covariances':gmm.covariances_,'precisions':gmm.precisions_}
+
+
+def fit_chain(i,ns,covariance_type,random_state,warm_start,init=None):
+    #fits of test subset i for each number of clusters in ns, each starting
+    #from the one before it if warm_start
+    subset=worker_data['training'][worker_data['tlist'][i]]
+    results=[]
+    for n in ns:
+        if not warm_start or (init is not None and len(init['weights'])>=n):
+            init=None
+        init=fit_cell(subset,n,covariance_type,random_state,init)
+        results.append(init)
+    return results
+
+
+def passed_minimum(BIC,stop_after):
+    '''True if the mean BIC (over the subsets) of each of the last stop_after
+    numbers of clusters is more than one standard deviation above the
+    minimum mean BIC.'''
+    mean=np.mean(BIC,axis=0)
+    best=int(np.argmin(mean))
+    after=mean[best+1:]
+    return len(after)>=stop_after and (after[-stop_after:]>mean[best]+np.std(BIC[:,best])).all()
+
+
+def bic_sweep(training,tlist,n_components=range(1,51),pcs=None,workers=1,cache_file=None,
+              warm_start=False,stop_after=None,block=5,covariance_type='full',random_state=0):
+    '''BIC and AIC of GMM fits with each number of clusters in n_components
+    (in increasing order) to each test subset of training (rows of tlist),
+    as (len(tlist), number of clusters fitted) arrays. The numbers of
+    clusters are fitted block at a time; with stop_after, the sweep stops
+    after the block in which the mean BIC has been clearly above its minimum
+    for stop_after numbers of clusters (see passed_minimum), so fewer columns
+    than len(n_components) may be returned. pcs is only used in messages (the
+    cache key already depends on the data).'''
+    n_components=[int(n) for n in n_components]
+    options=(covariance_type,random_state,warm_start)
+    keys=[subset_key(training[t],*options) for t in tlist]
+    cache=open_fit_cache(cache_file) if cache_file is not None else None
+    BIC=np.nan*np.ones((len(tlist),len(n_components)))
+    AIC=np.nan*np.ones((len(tlist),len(n_components)))
+    #last fit of each subset (the starting point for warm starts)
+    last=[None]*len(tlist)
+
+    if workers==1:
+        init_worker(training,tlist)
+        pool=None
+    else:
+        pool=ProcessPoolExecutor(max_workers=workers,initializer=init_worker,initargs=(training,tlist))
+    done=0
+    for start in range(0,len(n_components),block):
+        ns=n_components[start:start+block]
+        print('Testing %d to %d clusters%s' %(ns[0],ns[-1],' with %d PCs' %pcs if pcs else ''))
+        #without warm starts every (subset, clusters) cell is a separate task;
+        #with warm starts, each subset's clusters are fitted in order
+        tasks=[]
+        for i in range(len(tlist)):
+            results=[cached_fit(cache,'%s:%d' %(keys[i],n)) for n in ns]
+            for j,result in enumerate(results):
+                if result is not None:
+                    BIC[i,start+j],AIC[i,start+j]=result['bic'],result['aic']
+            missing=[j for j,result in enumerate(results) if result is None]
+            if warm_start and missing:
+                missing=list(range(missing[0],len(ns)))
+                if missing[0]>0:
+                    last[i]=results[missing[0]-1]
+                tasks.append((i,missing))
+            else:
+                tasks+=[(i,[j]) for j in missing]
+                if not missing:
+                    last[i]=results[-1]
+
+        args=[(i,[ns[j] for j in js],covariance_type,random_state,warm_start,last[i]) for i,js in tasks]
+        if pool is None:
+            outputs=(fit_chain(*a) for a in args)
+        else:
+            outputs=pool.map(fit_chain,*zip(*args)) if args else []
+        for (i,js),results in zip(tasks,outputs):
+            for j,result in zip(js,results):
+                BIC[i,start+j],AIC[i,start+j]=result['bic'],result['aic']
+                store_fit(cache,'%s:%d' %(keys[i],ns[j]),result)
+            last[i]=results[-1]
+        if cache is not None:
+            cache['conn'].commit()
+        done=start+len(ns)
+        if stop_after is not None and passed_minimum(BIC[:,:done],stop_after):
+            print('Mean BIC has passed its minimum at %d clusters; stopping'
+                  %n_components[int(np.argmin(np.mean(BIC[:,:done],axis=0)))])
+            break
+
+    if pool is not None:
+        pool.shutdown()
+    close_fit_cache(cache)
+    return BIC[:,:done],AIC[:,:done]
@@ -0,0 +1,199 @@
+'''This code trains the PCA and the Gaussian Mixture Model of
+"GMM_Public.ipynb" on the processed profiles without loading them all into
+memory, so the model can be retrained as the BGC Argo archive grows. Profiles
+are read from the output of "bgc_argo_data_process_public.py" chunk by chunk:
+a first pass finds the offset that makes the chlorophyll positive (as for
+test_data in the notebook), the PCA is fitted with sklearn's IncrementalPCA
+(keeping enough components for the same fraction of the variance as
+PCA(0.99)), and the GMM is fitted with stepwise (online) EM on shuffled
+minibatches, starting from a previous model when there is one, so only the
+new information has to be learned. mean_drift compares the cluster means with
+those of another fit (e.g. a full batch fit of a sample of the data). This
+code was written by PhD student Rosalind Echols.
+'''
+
+import numpy as np
+import netCDF4
+from scipy import linalg
+from scipy.optimize import linear_sum_assignment
+from sklearn.decomposition import IncrementalPCA
+from sklearn.mixture import GaussianMixture
+
+
+def profile_chunks(sfpath,variable='CHLA',chunk=20000,order=None):
+    '''Yield (start, profiles) for blocks of chunk profiles of variable from a
+    processed file, in the given order of blocks (all blocks in order by
+    default). Only one block is in memory at a time.'''
+    with netCDF4.Dataset(sfpath) as nc:
+        var=nc[variable]
+        var.set_auto_mask(False)
+        n=var.shape[0]
+        starts=np.arange(0,n,chunk)
+        for start in (starts if order is None else starts[order]):
+            yield start,np.asarray(var[start:start+chunk],dtype=float)
+
+
+def chla_offset(sfpath,variable='CHLA',chunk=20000):
+    #value added to the data so that its minimum is 0.01 (test_data in the
+    #notebook is data+offset)
+    low=np.inf
+    for start,x in profile_chunks(sfpath,variable,chunk):
+        low=min(low,np.nanmin(x))
+    return 0.01-low
+
+
+def fit_pca_incremental(sfpath,offset,variance=0.99,n_components=None,variable='CHLA',chunk=20000):
+    '''PCA of the log of the (offset) profiles, fitted chunk by chunk. Unless
+    n_components is given, the components that explain the fraction variance
+    of the variance are kept, as PCA(variance) does. Returns a dictionary with
+    the mean, the components and their explained variance (and ratio).'''
+    ipca=IncrementalPCA()
+    for start,x in profile_chunks(sfpath,variable,chunk):
+        ipca.partial_fit(np.log(x+offset))
+    ratio=ipca.explained_variance_ratio_
+    if n_components is None:
+        n_components=int(np.searchsorted(np.cumsum(ratio),variance)+1)
+    return {'mean':ipca.mean_,'components':ipca.components_[:n_components],
+            'explained_variance':ipca.explained_variance_[:n_components],
+            'explained_variance_ratio':ratio[:n_components],'n_samples':int(ipca.n_samples_seen_)}
+
+
+def pca_transform(pca,log_profiles):
+    #principal components of log profiles (as pca.transform)
+    return (log_profiles-pca['mean'])@pca['components'].T
+
+
+def precisions_cholesky(covariances):
+    #as sklearn: Cholesky factors of the precision matrices of full covariances
+    d=covariances.shape[1]
+    return np.array([linalg.solve_triangular(linalg.cholesky(c,lower=True),np.eye(d),lower=True).T
+                     for c in covariances])
+
+
+def gmm_from_params(params):
+    '''GaussianMixture (full covariances) with the given weights, means and
+    covariances, ready for predict and predict_proba.'''
+    gmm=GaussianMixture(len(params['weights']),covariance_type='full')
+    gmm.weights_=params['weights']
+    gmm.means_=params['means']
+    gmm.covariances_=params['covariances']
+    gmm.precisions_cholesky_=precisions_cholesky(params['covariances'])
+    gmm.precisions_=np.array([p@p.T for p in gmm.precisions_cholesky_])
+    gmm.converged_=True
+    gmm.n_iter_=0
+    gmm.lower_bound_=-np.inf
+    return gmm
+
+
+def fit_gmm_minibatch(sfpath,pca,offset,n_components=21,init=None,batch=2000,epochs=2,kappa=0.6,
+                      t0=10.,reg_covar=1e-6,random_state=0,variable='CHLA',chunk=20000):
+    '''Fit a GMM to the principal components of the profiles with stepwise
+    EM: for each minibatch of batch profiles, the expected sufficient
+    statistics (weights, sums and sums of squares) are moved towards those of
+    the minibatch by a step (t+t0)**-kappa, and the parameters are updated
+    from them. Chunks are read in a random order and shuffled, so minibatches
+    are not dominated by a single float. init is a previous fit (a parameter
+    dictionary) to start from; otherwise the first chunk is fitted in full
+    to start. Returns the parameters as a dictionary.'''
+    rng=np.random.default_rng(random_state)
+    if init is None:
+        start,x=next(profile_chunks(sfpath,variable,chunk,order=None))
+        y=pca_transform(pca,np.log(x+offset))
+        gmm=GaussianMixture(n_components,covariance_type='full',random_state=random_state,
+                            reg_covar=reg_covar).fit(y)
+        init={'weights':gmm.weights_,'means':gmm.means_,'covariances':gmm.covariances_}
+    d=init['means'].shape[1]
+    s0=init['weights'].copy()
+    s1=init['weights'][:,None]*init['means']
+    s2=init['weights'][:,None,None]*(init['covariances']+np.einsum('ki,kj->kij',init['means'],init['means']))
+    params=dict(init)
+    gmm=gmm_from_params(params)
+    step=0
+    with netCDF4.Dataset(sfpath) as nc:
+        n_chunks=int(np.ceil(nc[variable].shape[0]/chunk))
+    for epoch in range(epochs):
+        for start,x in profile_chunks(sfpath,variable,chunk,order=rng.permutation(n_chunks)):
+            y=pca_transform(pca,np.log(x+offset))[rng.permutation(len(x))]
+            for b in range(0,len(y),batch):
+                yb=y[b:b+batch]
+                resp=gmm.predict_proba(yb)
+                rho=(step+t0)**-kappa
+                s0=(1-rho)*s0+rho*resp.mean(0)
+                s1=(1-rho)*s1+rho*resp.T@yb/len(yb)
+                s2=(1-rho)*s2+rho*np.einsum('nk,ni,nj->kij',resp,yb,yb)/len(yb)
+                means=s1/s0[:,None]
+                covariances=s2/s0[:,None,None]-np.einsum('ki,kj->kij',means,means)+reg_covar*np.eye(d)
+                params={'weights':s0/s0.sum(),'means':means,'covariances':covariances}
+                gmm=gmm_from_params(params)
+                step+=1
+    params['steps']=step
+    return params
+
+
+def mean_drift(params,reference,pca=None):
+    '''Differences between the cluster means of two fits with the same number
+    of clusters, after pairing each cluster with the closest one of the
+    reference (Hungarian assignment on the distances between means). Returns
+    the pairs, the distance in PC space for each pair and, if pca is given,
+    the root mean square difference of the mean log profiles.'''
+    distance=np.linalg.norm(params['means'][:,None]-reference['means'][None],axis=2)
+    rows,pairs=linear_sum_assignment(distance)
+    drift={'pairs':pairs,'pc_distance':distance[rows,pairs]}
+    if pca is not None:
+        profiles=params['means']@pca['components']
+        ref_profiles=reference['means'][pairs]@pca['components']
+        drift['log_profile_rms']=np.sqrt(np.mean((profiles-ref_profiles)**2,axis=1))
+    print('Cluster mean drift (PC space): mean %.4f, max %.4f'
+          %(drift['pc_distance'].mean(),drift['pc_distance'].max()))
+    return drift
+
+
+def compare_with_batch(sfpath,model,sample=None,random_state=0,chunk=20000):
+    '''Fit a GMM in full (batch EM, as in the notebook) to the principal
+    components of the profiles in sfpath, or of a random fraction of them
+    if sample (a number of profiles) is given, using the PCA of model, and
+    report the drift of the cluster means of model from it. Batch EM can
+    also end in a different local optimum, so a large drift is worth
+    checking with another random_state.'''
+    rng=np.random.default_rng(random_state)
+    with netCDF4.Dataset(sfpath) as nc:
+        n=nc['CHLA'].shape[0]
+    keep=1. if sample is None else min(1.,sample/n)
+    y=[]
+    for start,x in profile_chunks(sfpath,chunk=chunk):
+        if keep<1:
+            x=x[rng.random(len(x))<keep]
+        y.append(pca_transform(model['pca'],np.log(x+model['offset'])))
+    gmm=GaussianMixture(len(model['gmm']['weights']),covariance_type='full',
+                        random_state=random_state).fit(np.concatenate(y))
+    reference={'weights':gmm.weights_,'means':gmm.means_,'covariances':gmm.covariances_}
+    return mean_drift(model['gmm'],reference,model['pca'])
+
+
+def train_incremental(sfpath,n_components=21,previous=None,variance=0.99,batch=2000,epochs=2,
+                      chunk=20000,random_state=0,reg_covar=1e-6):
+    '''Train the PCA and GMM on all of the profiles in sfpath in bounded
+    memory. previous is an earlier result of train_incremental; its GMM
+    (moved to the new PCA basis) is the starting point if it has the same
+    number of clusters. Returns a dictionary with the offset, the PCA and the
+    GMM parameters.'''
+    offset=chla_offset(sfpath,chunk=chunk)
+    pca=fit_pca_incremental(sfpath,offset,variance,chunk=chunk)
+    init=None
+    if previous is not None and len(previous['gmm']['weights'])==n_components:
+        #express the previous clusters in the new PCA basis
+        old=previous['pca']
+        rotation=old['components']@pca['components'].T
+        shift=(old['mean']-pca['mean'])@pca['components'].T
+        #the previous clusters are flat in the directions the old PCA did not
+        #keep (e.g. when the new one keeps more components), so they are given
+        #the variance of the data there
+        d=len(pca['components'])
+        rest=np.eye(d)-rotation.T@rotation
+        init={'weights':previous['gmm']['weights'],
+              'means':previous['gmm']['means']@rotation+shift,
+              'covariances':rotation.T@previous['gmm']['covariances']@rotation
+              +rest@np.diag(pca['explained_variance'])@rest+reg_covar*np.eye(d)}
+    gmm=fit_gmm_minibatch(sfpath,pca,offset,n_components,init,batch,epochs,reg_covar=reg_covar,
+                          chunk=chunk,random_state=random_state)
+    return {'offset':offset,'pca':pca,'gmm':gmm}
@@ -1,95 +1,267 @@
-'''This code determines whether a given float profile occurred during the day or 
+'''This code determines whether a given float profile occurred during the day or
 night by incorporating position and date information into an astronomical model.
 Please note that in order to use the code below, your data must have the same
 variable names for latitude, longitude, and date, and the date must be in
 Julian day. This code was written by PhD student Rosalind Echols by adapting
 demo code from the Skyfield toolbox documation (https://rhodesmill.org/skyfield/).
+
+With fast=True, is_it_night instead computes the elevation of the sun for all
+of the profiles at once from the NOAA solar position equations (based on
+Meeus, Astronomical Algorithms), which are accurate to about 0.01 degrees, and
+uses the same definition of night as Skyfield (the center of the sun more than
+0.8333 degrees below the horizon). Polar day and night need no special
+treatment. The two methods only disagree for profiles within a minute or two
+of sunrise or sunset; check_agreement and benchmark_night compare them.
+Skyfield, pandas and xarray are only imported where they are needed, so the
+fast method does not have to load them.
 '''
 
 
-from skyfield import api
-from skyfield import almanac
+import os
+import time
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import pandas as pd
-import xarray as xr
-
-
-def is_it_night(data,subset,ts,e):
-    #determines whether it is nighttime at a particular location and time
-    
-    #format latitude and longitude
-    night_time=[]
-    day_time=[]
-    
-    for n in range(0,len(data['LATITUDE'][subset])):
-        if n%1000==0:
-            print('File #', n)
-    #format latitude and longitude
-        if data['LATITUDE'][subset][n]<0:
-            lat = '%1.2f S' %data['LATITUDE'][subset][n]
-        else:
-            lat = '%1.2f N' %data['LATITUDE'][subset][n]
-            
-        if data['LONGITUDE'][subset][n]<0:
-            lon = '%1.2f W' %data['LONGITUDE'][subset][n]
-        else:
-            lon = '%1.2f E' %data['LONGITUDE'][subset][n]
-        
-        location = api.Topos(lat,lon)
-        
-        #format time
-        year = pd.to_datetime(data['JULD'].values[subset])[n].year
-        month = pd.to_datetime(data['JULD'].values[subset])[n].month
-        day = pd.to_datetime(data['JULD'].values[subset])[n].day
-        hour = pd.to_datetime(data['JULD'].values[subset])[n].hour
-        minute = pd.to_datetime(data['JULD'].values[subset])[n].minute
-        
-        #define window for searching for either a sunset or sunrise
-        t0,t1=ts.utc(year,month,day,[hour-12,hour+12])
-        #define UTC time of profile
-        t2=ts.utc(year,month,day,hour,minute)
-        
-        #t=array of times; y = 0 for sun set, 1 for sun rise: look for a sunset
-        #or sunrise within the window provided
-        t, y = almanac.find_discrete(t0, t1, almanac.sunrise_sunset(e, location))
-        #print(t.utc_iso())
-       # print(y)
-    
-        count_polar_night=0
-        count_polar_day=0
-        #first figure out if sunrise/sunset is irrelevant (i.e. poles at certain
-        #times of year, then determine day/night)
-        if len(t)<=1:
-            f=almanac.sunrise_sunset(e, location)
-            t, y = almanac.find_discrete(t0, t1, f)
-            if f(t2)==True:
-                day_time.append(n)
-                count_polar_day+=1
-            else:
-                night_time.append(n)
-                count_polar_night+=1
-        
-        #if sunrise/sunset exists, figure out whether the profile occurred
-        #before or sunset (sunrise). This depends on whether the t array is
-        #ordered [0,1] or [1,0] and whether t2 (the actual profile time) is
-        #before or after a 0 or 1. 
-        else:
-            if t.utc_iso()[0]<t2.utc_iso()<t.utc_iso()[1] and y[0]==1:
-                day_time.append(n)
-            elif t.utc_iso()[0]<t2.utc_iso()<t.utc_iso()[1] and y[0]==0:
-                night_time.append(n)
-            elif t2.utc_iso()>t.utc_iso()[1] and y[0]==0:
-                day_time.append(n)
-            elif t2.utc_iso()>t.utc_iso()[1] and y[0]==1:
-                night_time.append(n)
-            elif t2.utc_iso()<t.utc_iso()[0] and y[0]==1:
-                night_time.append(n)
+
+#the sun is up when its center is above this elevation (degrees), as in
+#almanac.sunrise_sunset
+sun_up_elevation=-0.8333
+
+
+def julian_day(juld):
+    #Julian day from datetime64 values (UTC)
+    days=(np.asarray(juld,dtype='datetime64[ns]')-np.datetime64('1950-01-01'))/np.timedelta64(1,'D')
+    return days+2433282.5
+
+
+def solar_elevation(lat,lon,juld):
+    '''Elevation of the center of the sun (degrees, without refraction) at
+    latitude lat and longitude lon (degrees) and UTC time juld (datetime64),
+    for arrays of any (matching) shape.'''
+    jd=julian_day(juld)
+    T=(jd-2451545.)/36525.
+    #mean longitude and anomaly of the sun, eccentricity of the earth's orbit
+    L0=np.mod(280.46646+T*(36000.76983+T*0.0003032),360.)
+    M=np.radians(357.52911+T*(35999.05029-0.0001537*T))
+    ecc=0.016708634-T*(0.000042037+0.0000001267*T)
+    center=(np.sin(M)*(1.914602-T*(0.004817+0.000014*T))+np.sin(2*M)*(0.019993-0.000101*T)
+            +np.sin(3*M)*0.000289)
+    omega=np.radians(125.04-1934.136*T)
+    apparent_long=np.radians(L0+center-0.00569-0.00478*np.sin(omega))
+    obliquity=np.radians(23.+(26.+(21.448-T*(46.815+T*(0.00059-T*0.001813)))/60.)/60.
+                         +0.00256*np.cos(omega))
+    declination=np.arcsin(np.sin(obliquity)*np.sin(apparent_long))
+
+    #equation of time (minutes) and hour angle from the UTC time of day
+    y=np.tan(obliquity/2)**2
+    L0=np.radians(L0)
+    eq_time=4*np.degrees(y*np.sin(2*L0)-2*ecc*np.sin(M)+4*ecc*y*np.sin(M)*np.cos(2*L0)
+                         -0.5*y**2*np.sin(4*L0)-1.25*ecc**2*np.sin(2*M))
+    minutes=np.mod(jd-0.5,1.)*1440.
+    hour_angle=np.radians((minutes+eq_time+4*np.asarray(lon,dtype=float))/4.-180.)
+
+    lat=np.radians(np.asarray(lat,dtype=float))
+    cos_zenith=(np.sin(lat)*np.sin(declination)+np.cos(lat)*np.cos(declination)*np.cos(hour_angle))
+    return 90.-np.degrees(np.arccos(np.clip(cos_zenith,-1.,1.)))
+
+
+def is_it_night_fast(data,subset):
+    #vectorized version of is_it_night: same index lists, from solar_elevation
+    lat=np.asarray(data['LATITUDE'])[subset]
+    lon=np.asarray(data['LONGITUDE'])[subset]
+    juld=np.asarray(data['JULD'])[subset]
+    night=solar_elevation(lat,lon,juld)<sun_up_elevation
+    return list(np.flatnonzero(night)),list(np.flatnonzero(~night))
+
+
+#timescale, ephemeris and sunrise/sunset cache of this process (set up once
+#per worker process by init_worker)
+sky={}
+
+
+def init_worker(ephemeris_path,cache_size=4096,ts=None,e=None):
+    #load the ephemeris (unless given) and start an empty cache of sun_events
+    from skyfield import api
+    sky['ts']=ts if ts is not None else api.load.timescale()
+    sky['e']=e if e is not None else api.load_file(ephemeris_path)
+    sky['events']=functools.lru_cache(maxsize=cache_size)(sun_events)
+
+
+def sun_events(lat,lon,year,month,day):
+    '''Times (TT) and kinds (1 sunrise, 0 sunset) of the sunrises and sunsets
+    from 12 h before to 12 h after the UTC date at a location, and whether the
+    sun is up at the start of that window. Cached (see init_worker) for each
+    location (rounded to 0.01 degrees, as for the skyfield Topos) and date.'''
+    from skyfield import api, almanac
+    ts,e=sky['ts'],sky['e']
+    location=api.Topos(latitude_degrees=lat,longitude_degrees=lon)
+    f=almanac.sunrise_sunset(e,location)
+    t0,t1=ts.utc(year,month,day,[-12,36])
+    t,y=almanac.find_discrete(t0,t1,f)
+    return t.tt,y,bool(f(t0))
+
+
+def night_chunk(lat,lon,juld):
+    '''Night (True) or day for each profile, from the sunrises and sunsets
+    around the UTC time of the profile (to the minute). Returns the flags and
+    the number of cache hits and misses.'''
+    import pandas as pd
+    ts,events=sky['ts'],sky['events']
+    times=pd.to_datetime(juld)
+    night=np.zeros(len(lat),dtype=bool)
+    before=events.cache_info()
+    for n in range(len(lat)):
+        tm=times[n]
+        t,y,up=events(round(float(lat[n]),2),round(float(lon[n]),2),tm.year,tm.month,tm.day)
+        #the sun is up if the last event before the profile was a sunrise (or,
+        #with no event since the start of the window, if it was up then)
+        k=np.searchsorted(t,ts.utc(tm.year,tm.month,tm.day,tm.hour,tm.minute).tt,side='right')
+        night[n]=not (y[k-1] if k>0 else up)
+    after=events.cache_info()
+    return night,after.hits-before.hits,after.misses-before.misses
+
+
+def is_it_night_exact(data,subset,ts,e,workers=1,chunksize=500,cache_size=4096):
+    '''Night (True) or day for each profile in subset from the skyfield
+    ephemeris. With workers>1, profiles are split between worker processes
+    that each load the ephemeris once. Profiles are sorted by date and
+    position first, so profiles that share a cache entry go to the same
+    worker.'''
+    lat=np.asarray(data['LATITUDE'])[subset]
+    lon=np.asarray(data['LONGITUDE'])[subset]
+    juld=np.asarray(data['JULD'],dtype='datetime64[ns]')[subset]
+    order=np.lexsort((np.round(lon,2),np.round(lat,2),juld.astype('datetime64[D]')))
+    #at least a few chunks per worker
+    chunksize=max(1,min(chunksize,len(order)//(4*workers)+1))
+    chunks=[order[n:n+chunksize] for n in range(0,len(order),chunksize)]
+    night=np.zeros(len(lat),dtype=bool)
+    hits=misses=0
+    if workers==1:
+        init_worker(e.path,cache_size,ts,e)
+        results=(night_chunk(lat[c],lon[c],juld[c]) for c in chunks)
+        pool=None
+    else:
+        pool=ProcessPoolExecutor(max_workers=workers,initializer=init_worker,initargs=(e.path,cache_size))
+        results=pool.map(night_chunk,[lat[c] for c in chunks],[lon[c] for c in chunks],[juld[c] for c in chunks])
+    for c,(flags,h,m) in zip(chunks,results):
+        night[c]=flags
+        hits+=h
+        misses+=m
+        print('Profiles done: ', hits+misses)
+    if pool is not None:
+        pool.shutdown()
+    print('Sunrise/sunset cache: %d hits, %d misses' %(hits,misses))
+    return night
+
+
+def is_it_night(data,subset,ts=None,e=None,fast=False,workers=1,cache_size=4096):
+    '''Determines whether it is nighttime at the location and time of each
+    profile in subset. Returns lists of the indices (in subset) of the night
+    time and day time profiles. With fast=True, or without a timescale and
+    ephemeris, the vectorized solar elevation is used instead of skyfield;
+    workers and cache_size are passed to is_it_night_exact.'''
+    if fast or ts is None or e is None:
+        return is_it_night_fast(data,subset)
+    night=is_it_night_exact(data,subset,ts,e,workers=workers,cache_size=cache_size)
+    return list(np.flatnonzero(night)),list(np.flatnonzero(~night))
+
+
+def night_flags(data,subset,ts=None,e=None,night_file=None,fast=False,workers=1):
+    '''is_it_night, keeping the results as a NIGHT variable in data (1 night,
+    0 day, -1 not computed) and, if night_file is given, in that netCDF file,
+    so that later runs only compute the profiles not done before. Stored flags
+    are matched to the profiles of data by time and position, so only new
+    profiles are computed when data grows, and are only used if they were
+    computed with the same method (fast or Skyfield).'''
+    import xarray as xr
+    method='fast' if fast else 'skyfield'
+    juld=np.asarray(data['JULD'],dtype='datetime64[ns]')
+    lat=np.asarray(data['LATITUDE'],dtype=float)
+    lon=np.asarray(data['LONGITUDE'],dtype=float)
+    flags=-np.ones(len(juld),dtype='i1')
+    if 'NIGHT' in data and getattr(data['NIGHT'],'attrs',{}).get('method')==method:
+        flags=np.asarray(data['NIGHT'],dtype='i1').copy()
+    elif night_file is not None and os.path.exists(night_file):
+        with xr.open_dataset(night_file) as stored:
+            if stored.attrs.get('method')!=method or 'LATITUDE' not in stored:
+                print('Stored NIGHT flags were computed another way; computing them again')
             else:
-                day_time.append(n)
-                
-     #can ask the program to provide how many profiles occurred during polar
-     #day or night
-   # print(count_polar_day,count_polar_night)
-   #returns lists of indices corresponding to night time and day time for the 
-   #original array
-    return night_time,day_time
\ No newline at end of file
+                done=dict(zip(zip(stored['JULD'].values.astype('i8'),stored['LATITUDE'].values,
+                                  stored['LONGITUDE'].values),stored['NIGHT'].values))
+                for n,key in enumerate(zip(juld.astype('i8'),lat,lon)):
+                    flags[n]=done.get(key,-1)
+
+    subset=np.arange(len(juld))[subset]
+    todo=subset[flags[subset]<0]
+    if len(todo)>0:
+        print('Computing NIGHT for %d profiles' %len(todo))
+        night_time=is_it_night(data,todo,ts,e,fast=fast,workers=workers)[0]
+        flags[todo]=0
+        flags[todo[night_time]]=1
+        if night_file is not None:
+            xr.Dataset({'NIGHT':('time',flags,{'flag_values':'-1 0 1',
+                                               'flag_meanings':'not_computed day night'}),
+                        'JULD':('time',juld),'LATITUDE':('time',lat),'LONGITUDE':('time',lon)},
+                       attrs={'method':method}).to_netcdf(night_file)
+    if isinstance(data,xr.Dataset):
+        data['NIGHT']=('time',flags,{'method':method})
+    else:
+        data['NIGHT']=flags
+
+    night=flags[subset]==1
+    return list(np.flatnonzero(night)),list(np.flatnonzero(~night))
+
+
+def check_agreement(data,subset,ts,e,margin=0.5):
+    '''Classify the profiles in subset with both methods and return the
+    indices (in subset) where they disagree. Disagreements are expected only
+    close to sunrise or sunset: the Skyfield method uses the time to the
+    minute, and the sun moves up to 0.25 degrees a minute. Profiles that
+    disagree with the sun more than margin degrees from the sunrise/sunset
+    elevation are printed.'''
+    night_exact=set(is_it_night(data,subset,ts,e)[0])
+    night_fast=set(is_it_night_fast(data,subset)[0])
+    disagree=sorted(night_exact^night_fast)
+    elevation=solar_elevation(np.asarray(data['LATITUDE'])[subset],np.asarray(data['LONGITUDE'])[subset],
+                              np.asarray(data['JULD'])[subset])
+    far=[n for n in disagree if abs(elevation[n]-sun_up_elevation)>margin]
+    print('%d of %d profiles classified differently, %d of them more than %g degrees from sunrise/sunset'
+          %(len(disagree),len(elevation),len(far),margin))
+    for n in far:
+        print('  profile %d: elevation %.3f, night (Skyfield) %s' %(n,elevation[n],n in night_exact))
+    return disagree
+
+
+def benchmark_night(data,subset,ts,e,sample=1000):
+    '''Time both methods on (up to) the first sample profiles of subset and
+    the fast method on all of them. Returns the times in seconds.'''
+    subset=np.asarray(subset)
+    times={}
+    start=time.perf_counter()
+    is_it_night(data,subset[:sample],ts,e)
+    times['skyfield_%d' %len(subset[:sample])]=time.perf_counter()-start
+    start=time.perf_counter()
+    is_it_night_fast(data,subset)
+    times['fast_%d' %len(subset)]=time.perf_counter()-start
+    for name,seconds in times.items():
+        print('%-16s %9.3f s' %(name,seconds))
+    return times
+
+
+def night_file_flags(data_file,night_file,ephemeris=None,workers=1):
+    '''night_flags for all of the profiles in data_file (a netCDF file with
+    LATITUDE, LONGITUDE and JULD, e.g. the output of GMM_Public.ipynb), kept in
+    night_file. Uses the skyfield ephemeris file ephemeris (e.g. de421.bsp) if
+    given, and the fast method otherwise. Returns the numbers of night and day
+    profiles.'''
+    import xarray as xr
+    ts=e=None
+    if ephemeris is not None:
+        from skyfield import api
+        ts=api.load.timescale()
+        e=api.load_file(ephemeris)
+    with xr.open_dataset(data_file) as ds:
+        data={'LATITUDE':ds['LATITUDE'].values,'LONGITUDE':ds['LONGITUDE'].values,'JULD':ds['JULD'].values}
+    night,day=night_flags(data,slice(None),ts,e,night_file=night_file,fast=ephemeris is None,workers=workers)
+    print('Night profiles: %d, day profiles: %d' %(len(night),len(day)))
+    return len(night),len(day)
@@ -0,0 +1,155 @@
+'''This code records where the time goes in "bgc_argo_data_process_public.py"
+and why profiles are dropped. A metrics dictionary holds the time spent in
+each stage of the processing (opening files, choosing variables, QC, the gsw
+depth/pressure conversions, interpolation, the post-interpolation check and
+writing the output), the number of profiles rejected by each QC code and by
+each of the other rejection branches, and the overall throughput. Worker
+processes fill their own metrics for each chunk of files, which are merged in
+the main process. The rejection branch of each file is also kept with its
+cached result (profile_cache_public.py), so runs that take results from the
+cache count them too. The result can be printed or saved as a JSON report, and
+the run can optionally be profiled with cProfile. This code was written by PhD
+student Rosalind Echols.
+'''
+
+import json
+import time
+import cProfile
+import contextlib
+
+stages=['open','select','qc','gsw','interp','post_check','write']
+
+
+def new_metrics():
+    return {'seconds':dict((s,0.) for s in stages),'calls':dict((s,0) for s in stages),
+            'rejected':{},'qc_codes':{},'outcomes':{},'skipped_files':{},'files':0,'profiles':0,
+            'start':time.time(),'wall':0.}
+
+
+@contextlib.contextmanager
+def timed(metrics,stage):
+    #time a block of code as part of stage; does nothing if metrics is None
+    if metrics is None:
+        yield
+        return
+    start=time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics['seconds'][stage]=metrics['seconds'].get(stage,0.)+time.perf_counter()-start
+        metrics['calls'][stage]=metrics['calls'].get(stage,0)+1
+
+
+def tally(metrics,key,reason,n=1):
+    #add n to the counter for reason in metrics[key] (e.g. 'rejected')
+    if metrics is not None:
+        metrics[key][reason]=metrics[key].get(reason,0)+n
+
+
+def skip(metrics,f,reason):
+    #count a file skipped before QC, and keep its reason (for the cache)
+    if metrics is not None:
+        tally(metrics,'rejected',reason)
+        metrics['skipped_files'][f]=reason
+
+
+def rejection_branch(qc,profile,reason=None):
+    '''Rejection branch of a result (qc, profile) of process_files, as
+    counted in metrics['rejected'], or None if it was accepted. reason is
+    the reason a file was skipped before QC (qc None).'''
+    if qc is None:
+        return reason if reason is not None else 'skipped_before_qc'
+    if qc!=0:
+        return 'qc_%d' %qc
+    if profile is None:
+        return 'post_check'
+    return None
+
+
+def merge(metrics,other):
+    '''Add the stage times and counters of other (e.g. from a worker process)
+    to metrics.'''
+    for key in ['seconds','calls','rejected','qc_codes','outcomes']:
+        for name,value in other[key].items():
+            metrics[key][name]=metrics[key].get(name,0)+value
+    return metrics
+
+
+def record_result(metrics,qc,profile):
+    '''Count the outcome of one file as it comes out of process_files:
+    skipped before QC (no CHLA data or a known bad file), rejected by QC
+    (counted by code), rejected by the post-interpolation check, or
+    accepted.'''
+    if metrics is None:
+        return
+    metrics['files']+=1
+    if qc is None:
+        tally(metrics,'outcomes','skipped_before_qc')
+        return
+    tally(metrics,'qc_codes',str(qc))
+    if qc!=0:
+        tally(metrics,'outcomes','qc_rejected')
+    elif profile is None:
+        tally(metrics,'outcomes','post_check_rejected')
+    else:
+        tally(metrics,'outcomes','accepted')
+        metrics['profiles']+=1
+
+
+def report(metrics):
+    '''Summary of the metrics as a JSON-serializable dictionary. Stage times
+    are summed over the worker processes, so with several workers they can
+    add up to more than the wall time.'''
+    wall=time.time()-metrics['start']
+    metrics['wall']=wall
+    busy=sum(metrics['seconds'].values())
+    return {'wall_seconds':wall,
+            'files':metrics['files'],
+            'profiles':metrics['profiles'],
+            'files_per_second':metrics['files']/wall if wall>0 else 0.,
+            'profiles_per_second':metrics['profiles']/wall if wall>0 else 0.,
+            'stage_seconds':metrics['seconds'],
+            'stage_calls':metrics['calls'],
+            'stage_fraction':dict((s,t/busy if busy>0 else 0.) for s,t in metrics['seconds'].items()),
+            'outcomes':metrics['outcomes'],
+            'qc_codes':metrics['qc_codes'],
+            'rejected':metrics['rejected']}
+
+
+def print_report(metrics):
+    summary=report(metrics)
+    print('Processed %d files (%d profiles) in %.1f s: %.1f files/s, %.1f profiles/s'
+          %(summary['files'],summary['profiles'],summary['wall_seconds'],
+            summary['files_per_second'],summary['profiles_per_second']))
+    for s in stages:
+        if summary['stage_calls'].get(s,0)>0:
+            print('  %-10s %9.2f s  (%4.1f%%)' %(s,summary['stage_seconds'][s],100*summary['stage_fraction'][s]))
+    print('Outcomes:',summary['outcomes'])
+    print('QC codes:',summary['qc_codes'])
+    print('Rejection branches:',summary['rejected'])
+    return summary
+
+
+def save_report(metrics,report_file):
+    summary=report(metrics)
+    with open(report_file,'w') as fp:
+        json.dump(summary,fp,indent=2,sort_keys=True)
+    return summary
+
+
+def start_profiler(profile_file=None):
+    '''Start profiling with cProfile if profile_file is given (the stats are
+    written there by stop_profiler; read them with pstats or snakeviz). Only
+    the main process is profiled, so use workers=1 to see the time spent in
+    the processing itself.'''
+    if profile_file is None:
+        return None
+    profiler=cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler,profile_file):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
@@ -0,0 +1,178 @@
+'''This code keeps a cache of the results of "bgc_argo_data_process_public.py"
+for each profile file (the QC code and, for profiles that pass, the
+interpolated profile), so that re-running the processing after a GDAC update
+only has to process the profiles that are new or have changed. Results are
+stored in a small SQLite database under a key made from the file (its size
+and modification time, or an MD5 checksum of its contents) and the processing
+configuration (depth grid, variables, key_dict, the QC and interpolation
+code in profile_engine_public.py and the source of the processing functions
+that choose the variables and check the interpolated profiles), so changing
+any of these invalidates the cached results. The cache is kept below a
+maximum size by removing the least recently used results, every
+evict_every new results and when it is closed. This code was written by PhD student Rosalind Echols.
+'''
+
+import os
+import time
+import pickle
+import hashlib
+import inspect
+import sqlite3
+
+from gdac_index_public import file_checksum
+from pipeline_metrics_public import tally, rejection_branch
+
+
+def config_key(depths,var_all,key_dict,*extra,functions=()):
+    '''Hash of the processing configuration. The source of
+    profile_engine_public.py and of functions (e.g. the functions of the
+    processing program that choose between adjusted and raw variables and
+    run the post-interpolation check) is included, so any change to the QC
+    thresholds, the choice of variables or the interpolation gives a new key.'''
+    md5=hashlib.md5()
+    md5.update(repr([float(d) for d in depths]).encode())
+    md5.update(repr(list(var_all)).encode())
+    md5.update(repr(sorted(key_dict.items())).encode())
+    md5.update(repr(extra).encode())
+    engine=os.path.join(os.path.dirname(os.path.abspath(__file__)),'profile_engine_public.py')
+    with open(engine,'rb') as fp:
+        md5.update(fp.read())
+    for func in functions:
+        md5.update(inspect.getsource(func).encode())
+    return md5.hexdigest()
+
+
+def open_cache(cache_file,config,max_bytes=2*1024**3,checksum=False,evict_every=5000):
+    '''Open (or create) the cache. Returns a dictionary holding the database
+    connection, the configuration key and the hit/miss counters, which is
+    passed to the other functions in this module and to process_files. With
+    checksum=True files are identified by their contents rather than their
+    size and modification time, which is slower but survives copying the
+    data to a new location. The cache is trimmed to max_bytes after every
+    evict_every new results, so it stays bounded during a long run.'''
+    conn=sqlite3.connect(cache_file)
+    conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, qc INTEGER, '
+                 'data BLOB, size INTEGER, used REAL, branch TEXT)')
+    #caches from before the rejection branch was stored
+    if 'branch' not in [row[1] for row in conn.execute('PRAGMA table_info(results)')]:
+        conn.execute('ALTER TABLE results ADD COLUMN branch TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+    conn.commit()
+    return {'conn':conn,'config':config,'max_bytes':max_bytes,'checksum':checksum,
+            'evict_every':evict_every,'hits':0,'misses':0,'stored':0,'evicted':0,'pending':set()}
+
+
+def file_key(cache,f):
+    #key for the results of processing file f with the cache configuration
+    if cache['checksum']:
+        ident=file_checksum(f)
+    else:
+        stat=os.stat(f)
+        ident='%s:%d:%d' %(f,stat.st_size,stat.st_mtime_ns)
+    return hashlib.md5((ident+':'+cache['config']).encode()).hexdigest()
+
+
+def is_cached(cache,key):
+    found=cache['conn'].execute('SELECT 1 FROM results WHERE key=?',(key,)).fetchone() is not None
+    if found:
+        cache['hits']+=1
+    else:
+        cache['misses']+=1
+    return found
+
+
+def lookup(cache,key):
+    #(qc, profile) for a cached result, and its rejection branch (None if the
+    #result is not in the cache)
+    row=cache['conn'].execute('SELECT qc, data, branch FROM results WHERE key=?',(key,)).fetchone()
+    if row is None:
+        return None
+    qc,data,branch=row
+    cache['conn'].execute('UPDATE results SET used=? WHERE key=?',(time.time(),key))
+    return (qc,pickle.loads(data) if data is not None else None),branch
+
+
+def store(cache,key,result,branch=None):
+    qc,profile=result
+    data=pickle.dumps(profile,protocol=pickle.HIGHEST_PROTOCOL) if profile is not None else None
+    size=len(data) if data is not None else 0
+    cache['conn'].execute('INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?)',
+                          (key,qc,data,size,time.time(),branch))
+    cache['stored']+=1
+    if cache['stored']%cache['evict_every']==0:
+        evict(cache)
+    elif cache['stored']%1000==0:
+        cache['conn'].commit()
+
+
+def evict(cache):
+    '''Remove the least recently used results until the cache is below
+    max_bytes, except those that cached_results has still to read. Returns
+    the number of results removed.'''
+    conn=cache['conn']
+    total=conn.execute('SELECT COALESCE(SUM(size),0) FROM results').fetchone()[0]
+    removed=[]
+    if total>cache['max_bytes']:
+        for key,size in conn.execute('SELECT key, size FROM results ORDER BY used'):
+            if total<=cache['max_bytes']:
+                break
+            if key in cache['pending']:
+                continue
+            removed.append((key,))
+            total-=size
+        conn.executemany('DELETE FROM results WHERE key=?',removed)
+    conn.commit()
+    cache['evicted']+=len(removed)
+    return len(removed)
+
+
+def cached_results(all_files,cache,process,skipped=None,metrics=None):
+    '''Yield the result for each file in all_files, in order, taking it from
+    the cache when possible. process(files) must yield the results for a list
+    of files in order; it is only given the files that are not cached. The
+    rejection branch of each new result (with the reasons for files skipped
+    before QC from skipped, filled in by process) is stored with it, and
+    counted in metrics for cached results.'''
+    keys=[file_key(cache,f) for f in all_files]
+    hits=[is_cached(cache,key) for key in keys]
+    #the hits are kept from eviction (by the stores below) until they are read
+    cache['pending'].update(key for key,hit in zip(keys,hits) if hit)
+    missing=process([f for f,hit in zip(all_files,hits) if not hit])
+    #cached results are only read back when their turn comes, so they are
+    #never all in memory at once
+    for f,key,hit in zip(all_files,keys,hits):
+        cached=lookup(cache,key) if hit else None
+        cache['pending'].discard(key)
+        if cached is not None:
+            result,branch=cached
+            if branch is not None:
+                tally(metrics,'rejected',branch)
+        else:
+            #not cached, or removed from the cache (e.g. by another run) since
+            #it was found
+            result=next(missing) if not hit else next(process([f]))
+            reason=skipped.pop(f,None) if skipped is not None else None
+            store(cache,key,result,rejection_branch(result[0],result[1],reason))
+        yield result
+    cache['conn'].commit()
+
+
+def cache_report(cache):
+    '''Print and return the hit/miss counts and the size of the cache.'''
+    conn=cache['conn']
+    count,size=conn.execute('SELECT COUNT(*), COALESCE(SUM(size),0) FROM results').fetchone()
+    lookups=cache['hits']+cache['misses']
+    report={'hits':cache['hits'],'misses':cache['misses'],'stored':cache['stored'],
+            'evicted':cache['evicted'],'entries':count,'bytes':size,
+            'hit_rate':cache['hits']/lookups if lookups else 0.}
+    print('Cache: %d hits, %d misses (%.1f%% hit rate), %d results stored, %d evicted, %d entries, %.1f MB'
+          %(report['hits'],report['misses'],100*report['hit_rate'],report['stored'],
+            report['evicted'],report['entries'],report['bytes']/1e6))
+    return report
+
+
+def close_cache(cache):
+    evict(cache)
+    report=cache_report(cache)
+    cache['conn'].close()
+    return report
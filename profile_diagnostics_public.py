@@ -0,0 +1,140 @@
+'''This code computes diagnostics of every profile at once for "GMM_figures.ipynb"
+and "GMM_curve_fit.ipynb": the mixed layer depth from a density threshold
+(MLD), the base of the chlorophyll mixed layer from a chlorophyll threshold
+(CHL_MLD), the depth and value of the chlorophyll maximum (CHL_MAX_DEPTH,
+CHL_MAX), the first depth at which chlorophyll is below half of its surface
+value (ZHALF) and the mean chlorophyll of the top 7 levels (FSURF). Each
+threshold is found with a first crossing along the depth axis of the whole
+(profiles, depths) array instead of a loop over the profiles. add_diagnostics
+stores them as variables on the dataset (and optionally in a netCDF file, with
+a fingerprint of the profile dates and positions, so they are only computed
+once). This code was written by PhD student Rosalind
+Echols.
+'''
+
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+
+
+def first_crossing(mask,start=0):
+    #index of the first True in each row of mask at or after start (-1 if none)
+    mask=np.array(mask,dtype=bool)
+    mask[:,:start]=False
+    return np.where(mask.any(1),mask.argmax(1),-1)
+
+
+def depth_at(depth,index):
+    #depth of each profile at index (depth is one grid or one row per profile; nan where index is -1)
+    depth=np.asarray(depth,dtype=float)
+    index=np.asarray(index)
+    rows=np.broadcast_to(depth,(len(index),depth.shape[-1]))
+    return np.where(index>=0,rows[np.arange(len(index)),np.maximum(index,0)],np.nan)
+
+
+def density_mld(pdensity,depth,threshold=0.03,ref=2):
+    '''Mixed layer depth: the depth above the first level below ref where the
+    density is more than threshold above the density at ref (10 m). Returns
+    the depth and the level (nan and -1 where there is none).'''
+    pdensity=np.asarray(pdensity,dtype=float)
+    with np.errstate(invalid='ignore'):
+        ind=first_crossing(pdensity>pdensity[:,ref:ref+1]+threshold,ref+1)
+    ind=np.where(ind>=0,ind-1,-1)
+    return depth_at(depth,ind),ind
+
+
+def chl_mld(chla,depth,threshold=0.01,ref=2):
+    '''Base of the chlorophyll mixed layer: the depth above the first level
+    below ref where the chlorophyll is at least threshold below the value at
+    ref. Returns the depth and the level (nan and -1 where there is none).'''
+    chla=np.asarray(chla,dtype=float)
+    with np.errstate(invalid='ignore'):
+        ind=first_crossing(chla<=chla[:,ref:ref+1]-threshold,ref+1)
+    ind=np.where(ind>=0,ind-1,-1)
+    return depth_at(depth,ind),ind
+
+
+def chl_max(chla,depth):
+    #depth, value and level of the chlorophyll maximum (the shallowest one if tied)
+    chla=np.asarray(chla,dtype=float)
+    valid=~np.isnan(chla).all(1)
+    ind=np.where(valid,np.nanargmax(np.where(valid[:,None],chla,0.),1),-1)
+    return depth_at(depth,ind),np.where(valid,chla[np.arange(len(chla)),np.maximum(ind,0)],np.nan),ind
+
+
+def half_surface_depth(chla,depth):
+    #first depth where the chlorophyll is below half of the surface value (nan if none)
+    chla=np.asarray(chla,dtype=float)
+    with np.errstate(invalid='ignore'):
+        ind=first_crossing(chla<chla[:,:1]/2)
+    return depth_at(depth,ind)
+
+
+def surface_mean(chla,levels=7):
+    #mean chlorophyll of the top levels (fsurf in the curve fits; nan if all are missing)
+    chla=np.asarray(chla,dtype=float)[:,:levels]
+    n=(~np.isnan(chla)).sum(1)
+    with np.errstate(invalid='ignore'):
+        return np.nansum(chla,1)/n
+
+
+def fingerprint(data):
+    #md5 of the dates and positions of the profiles in data (as in
+    #aggregate_cube_public.py), to check that stored diagnostics are for them
+    columns=[]
+    for var in ['JULD','LATITUDE','LONGITUDE']:
+        if var in data:
+            values=np.asarray(data[var].values)
+            values=values.astype('datetime64[ns]') if values.dtype.kind=='M' else values.astype(float)
+            columns.append(values.view('i8'))
+    md5=hashlib.md5()
+    if columns:
+        md5.update(np.ascontiguousarray(np.column_stack(columns)).tobytes())
+    return md5.hexdigest()
+
+
+def add_diagnostics(data,chl_thresholds=(0.01,0.04),density_threshold=0.03,diagnostics_file=None):
+    '''Add MLD, CHL_MLD (one column for each of chl_thresholds), CHL_MAX_DEPTH,
+    CHL_MAX, ZHALF and FSURF to data (an xarray Dataset with CHLA and DEPTH,
+    and PDENSITY, or PSAL and TEMP to compute it as the notebook does). If
+    diagnostics_file exists and is for the same profiles (number and
+    fingerprint of their dates and positions), the diagnostics are
+    read from it; otherwise they are computed and, if diagnostics_file is
+    given, saved there.'''
+    dim=data['CHLA'].dims[0]
+    n=data.sizes[dim]
+    chl_thresholds=[float(t) for t in chl_thresholds]
+    profiles=fingerprint(data)
+    variables=None
+    if diagnostics_file is not None and os.path.exists(diagnostics_file):
+        with xr.open_dataset(diagnostics_file) as stored:
+            if (stored.sizes['profile']==n and list(stored['chl_threshold'].values)==chl_thresholds
+                    and stored.attrs.get('density_threshold')==density_threshold
+                    and stored.attrs.get('fingerprint')==profiles):
+                variables=dict((k,v.values) for k,v in stored.data_vars.items())
+            else:
+                print('Stored diagnostics are for other profiles or thresholds; computing them again')
+
+    if variables is None:
+        chla=data['CHLA'].values
+        depth=data['DEPTH'].values
+        variables={}
+        if 'PDENSITY' not in data and 'PSAL' in data and 'TEMP' in data:
+            import gsw
+            data=data.assign(PDENSITY=(data['CHLA'].dims,np.asarray(gsw.rho(data['PSAL'],data['TEMP'],0))))
+        if 'PDENSITY' in data:
+            variables['MLD']=density_mld(data['PDENSITY'].values,depth,density_threshold)[0]
+        variables['CHL_MLD']=np.column_stack([chl_mld(chla,depth,t)[0] for t in chl_thresholds])
+        variables['CHL_MAX_DEPTH'],variables['CHL_MAX']=chl_max(chla,depth)[:2]
+        variables['ZHALF']=half_surface_depth(chla,depth)
+        variables['FSURF']=surface_mean(chla)
+        if diagnostics_file is not None:
+            xr.Dataset(dict((k,(('profile','chl_threshold') if v.ndim>1 else ('profile',),v))
+                            for k,v in variables.items()),
+                       coords={'chl_threshold':chl_thresholds},
+                       attrs={'density_threshold':density_threshold,
+                              'fingerprint':profiles}).to_netcdf(diagnostics_file)
+
+    data=data.assign(dict((k,((dim,'chl_threshold') if v.ndim>1 else (dim,),v)) for k,v in variables.items()))
+    return data.assign_coords(chl_threshold=chl_thresholds)
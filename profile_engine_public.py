@@ -0,0 +1,305 @@
+'''This code contains array versions of the per-profile quality control and
+interpolation steps in "bgc_argo_data_process_public.py". Rather than looping
+over the data points of one profile at a time, the steps are written as
+operations on a stack of profiles, padded with nans to a common number of
+levels, so that many profiles can be handled at once. qc_codes returns the
+same QC codes as quality_control, and interpolate_profiles the same 5 m
+profiles as interpolate_data (to within floating point rounding). This code
+was written by PhD student Rosalind Echols.
+'''
+
+import time
+import warnings
+import numpy as np
+
+
+def pad_profiles(profiles,fill=np.nan,n_levels=None):
+    #stack a list of 1D profiles of different lengths into a 2D array,
+    #padding the end of the shorter profiles with nans
+    if n_levels is None:
+        n_levels=max([len(p) for p in profiles]+[1])
+    stack=fill*np.ones((len(profiles),n_levels))
+    for n,p in enumerate(profiles):
+        stack[n,:len(p)]=p
+    return stack
+
+
+def first_true(mask):
+    #index of the first True value in each row, and whether there is one
+    found=mask.any(axis=1)
+    return np.where(found,mask.argmax(axis=1),mask.shape[1]),found
+
+
+def qc_codes(pres,values,chla,lat,lon):
+    '''QC codes (0-6, see quality_control) for a stack of profiles. pres,
+    values (the variable being checked) and chla are 2D arrays of
+    (profiles, levels), padded with nans; lat and lon are 1D arrays.
+
+    Profiles with no valid data points are given qc=2. quality_control raises
+    an error for these (and for the rare profiles whose deepest valid pressure
+    is exactly 200), but they never reach it in the main program.'''
+    pres=np.atleast_2d(np.asarray(pres,dtype=float))
+    values=np.atleast_2d(np.asarray(values,dtype=float))
+    chla=np.atleast_2d(np.asarray(chla,dtype=float))
+    lat=np.atleast_1d(lat)
+    lon=np.atleast_1d(lon)
+    levels=np.arange(pres.shape[1])
+
+    valid=~np.isnan(values)
+    n_valid=valid.sum(axis=1)
+    valid_pres=np.where(valid,pres,np.nan)
+
+    with warnings.catch_warnings(), np.errstate(invalid='ignore'):
+        warnings.simplefilter('ignore',category=RuntimeWarning)
+
+        #1: no position
+        qc1=np.isnan(lat)|np.isnan(lon)
+
+        #2: valid data does not reach 200 dbar or does not start above 10 dbar
+        qc2=(n_valid==0)|(np.nanmax(valid_pres,axis=1)<200)|(np.nanmin(valid_pres,axis=1)>10)
+
+        #3: gaps of more than 20 dbar between valid data points above the
+        #first valid point at or below 200 dbar
+        surf,found=first_true(valid&(pres>=200))
+        last_valid=np.maximum.accumulate(np.where(valid,levels,-1),axis=1)
+        previous=np.concatenate([-np.ones((len(pres),1),dtype=int),last_valid[:,:-1]],axis=1)
+        step=pres-np.take_along_axis(pres,np.maximum(previous,0),axis=1)
+        gaps=valid&(previous>=0)&(levels<surf[:,None])&(step>20)
+        qc3=gaps.any(axis=1)
+
+        #4: 10 or fewer data points
+        qc4=n_valid<=10
+
+        #5: large chlorophyll values below 200 dbar (mean of everything deeper
+        #than the first level below 200 dbar)
+        d200,found=first_true(pres>200)
+        deep=np.where(levels>=d200[:,None],chla,np.nan)
+        qc5=np.nanmean(deep,axis=1)>0.3
+
+        #6: almost all of the data is either negative or nan; padding adds the
+        #same number of nans and levels, so it does not change the difference
+        nans=np.isnan(values).sum(axis=1)
+        negative=(values<0).sum(axis=1)
+        qc6=np.abs(nans+negative-values.shape[1])<=10
+
+    return np.select([qc1,qc2,qc3,qc4,qc5,qc6],[1,2,3,4,5,6],0)
+
+
+def dataset_qc(data,variable):
+    #QC code for a single profile dataset; same result as quality_control
+    return int(qc_codes(data['PRES'].values[0],data[variable].values[0],data['CHLA'].values[0],
+                        data['LATITUDE'].values[0],data['LONGITUDE'].values[0])[0])
+
+
+def in_black_sea(lat,lon):
+    #deep red fluorescence is a known issue in the Black Sea
+    return (27.5<lon)&(lon<42.5)&(41<lat)&(lat<47)
+
+
+def compress(valid,*arrays):
+    #move the valid points of each row to the start of the row (keeping their
+    #order); returns the index used and the reordered arrays
+    order=np.argsort(~valid,axis=1,kind='stable')
+    return order,[np.take_along_axis(a,order,axis=1) for a in arrays]
+
+
+def median_filter5(values,valid):
+    '''5-point median filter along each row, applied to the valid points only.
+    Same as ndimage.median_filter(values[n,valid[n]],size=5) for each row,
+    including the reflection of the data at both ends.'''
+    n_valid=valid.sum(axis=1)[:,None,None]
+    order,(packed,)=compress(valid,values)
+    levels=np.arange(values.shape[1])
+    index=levels[None,:,None]+np.arange(-2,3)[None,None,:]
+    index=np.where(index<0,-index-1,index)
+    index=np.where(index>=n_valid,2*n_valid-index-1,index)
+    index=np.clip(index,0,values.shape[1]-1)
+    windows=packed[np.arange(len(values))[:,None,None],index]
+    filtered=np.sort(windows,axis=2)[:,:,2]
+
+    out=np.nan*np.ones(values.shape)
+    np.put_along_axis(out,order,filtered,axis=1)
+    out[~valid]=np.nan
+    return out
+
+
+def interp_linear(x,y,valid,targets):
+    '''Linear interpolation (and extrapolation) of each row of y(x) onto
+    targets, using only the valid points. This follows interp1d with
+    fill_value='extrapolate': points are sorted by x, and the two nearest
+    points (the first or last two outside the range) are used. The result is
+    computed in float64, while interp1d works in the precision of the data
+    (float32 in the Argo files), so the two agree to within float32 rounding
+    (e.g. about 1e-5 mg m^-3 for CHLA), not bit for bit.'''
+    order=np.lexsort((x,~valid),axis=1)
+    xs=np.take_along_axis(x,order,axis=1)
+    ys=np.take_along_axis(y,order,axis=1)
+    n_valid=valid.sum(axis=1)
+    xs[np.arange(x.shape[1])[None,:]>=n_valid[:,None]]=np.inf
+
+    index=(xs[:,:,None]<targets[None,None,:]).sum(axis=1)
+    index=np.clip(index,1,np.maximum(n_valid,2)[:,None]-1)
+    x_lo=np.take_along_axis(xs,index-1,axis=1)
+    x_hi=np.take_along_axis(xs,index,axis=1)
+    y_lo=np.take_along_axis(ys,index-1,axis=1)
+    y_hi=np.take_along_axis(ys,index,axis=1)
+    slope=(y_hi-y_lo)/(x_hi-x_lo)
+
+    return slope*(targets[None,:]-x_lo)+y_lo
+
+
+def make_grid(max_depth=250,spacing=5):
+    #depth grid from the surface to max_depth (m), e.g. 0, 5, ..., 250
+    return np.arange(0,max_depth+spacing/2.,spacing)
+
+
+def dark_levels(depths,dark_span=45):
+    #the deepest dark_span m of the grid, used for the dark offset; for the 5 m
+    #grid to 250 m, these are the 10 deepest values, as in interpolate_data
+    depths=np.asarray(depths,dtype=float)
+    return depths>=depths[-1]-dark_span
+
+
+def chla_fixups(chl,lat,lon,dark=None):
+    '''Post-processing of interpolated chlorophyll profiles, as in
+    interpolate_data: subtract the smallest of the 10 deepest values, or of
+    the levels in dark (see dark_levels), except in the Black Sea, replace an
+    infinite surface value with the next value, and replace negative
+    near-surface values with the first positive value; rows with no positive
+    values are set to nan.'''
+    if dark is None:
+        dark=np.arange(chl.shape[1])>=chl.shape[1]-10
+    with np.errstate(invalid='ignore'):
+        offset=np.where(in_black_sea(lat,lon),0.,np.nanmin(chl[:,dark],axis=1))
+        out=chl-offset[:,None]
+        out[:,0]=np.where(np.isinf(out[:,0]),out[:,1],out[:,0])
+
+        negative=out[:,0]<0
+        pos,found=first_true(out>0)
+        fill=np.take_along_axis(out,np.minimum(pos,out.shape[1]-1)[:,None],axis=1)
+        levels=np.arange(out.shape[1])[None,:]
+        out=np.where((negative&found)[:,None]&(levels<pos[:,None]),fill,out)
+        out[negative&~found]=np.nan
+
+    return out
+
+
+def interpolate_profiles(values,depth,depths,var,lat=None,lon=None,valid=None,filtered=None,chunk=None,
+                         max_cells=2e7):
+    '''Interpolate a stack of profiles of one variable onto the depth grid.
+    values and depth are 2D arrays of (profiles, levels), padded with nans;
+    valid defaults to the non-nan values. Profiles with fewer than 2 valid
+    points are returned as nans.
+
+    Rows where filtered is True are median filtered before interpolation and
+    post-processed with chla_fixups, which needs lat and lon. By default this
+    is every row when var is 'CHLA'; note that interpolate_data only does this
+    for the unadjusted CHLA variable, not for CHLA_ADJUSTED.
+
+    Profiles are done chunk at a time; by default the chunk size is chosen so
+    that the temporary (profiles, levels, depths) array has at most max_cells
+    elements, which bounds the memory used for fine depth grids.'''
+    values=np.atleast_2d(np.asarray(values,dtype=float))
+    depth=np.atleast_2d(np.asarray(depth,dtype=float))
+    depths=np.asarray(depths,dtype=float)
+    if valid is None:
+        valid=~np.isnan(values)
+    if filtered is None:
+        filtered=np.ones(len(values),dtype=bool)&(var=='CHLA')
+    filtered=np.asarray(filtered,dtype=bool)
+    out=np.nan*np.ones((len(values),len(depths)))
+    if chunk is None:
+        chunk=max(1,int(max_cells//(values.shape[1]*len(depths)+1)))
+    dark=dark_levels(depths)
+
+    #work through the profiles in chunks to bound the size of the temporary
+    #(profiles, levels, depths) comparison array
+    for start in range(0,len(values),chunk):
+        rows=np.arange(start,min(start+chunk,len(values)))
+        rows=rows[valid[rows].sum(axis=1)>=2]
+        if len(rows)==0:
+            continue
+        v,d,m,f=values[rows],depth[rows],valid[rows],filtered[rows]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            if f.any():
+                v=v.copy()
+                v[f]=median_filter5(v[f],m[f])
+            result=interp_linear(d,v,m,depths)
+        if f.any():
+            result[f]=chla_fixups(result[f],np.asarray(lat)[rows][f],np.asarray(lon)[rows][f],dark)
+        out[rows]=result
+
+    return out
+
+
+def interpolate_variables(stack,depth,depths,lat,lon,filtered=None):
+    #interpolate every variable in stack (a dictionary of 2D arrays, e.g. TEMP,
+    #PSAL, DOXY, NITRATE and CHLA) onto the depth grid; filtered is passed on
+    #for CHLA
+    return dict((var,interpolate_profiles(stack[var],depth,depths,var,lat,lon,
+                                          filtered=filtered if var=='CHLA' else None)) for var in stack)
+
+
+def benchmark_interpolation(datasets,depths=np.arange(0,251,5),variables=['TEMP','PSAL','DOXY','NITRATE','CHLA']):
+    '''Time interpolate_data (one profile and variable at a time) and
+    interpolate_variables (all profiles at once) on a list of (already
+    loaded) profile datasets with a DEPTH variable, and report the largest
+    difference between them (float32 rounding of the data, not zero).'''
+    from bgc_argo_data_process_public import interpolate_data
+
+    variables=[v for v in variables if all(v in data.keys() for data in datasets)]
+    start=time.perf_counter()
+    original={}
+    for var in variables:
+        original[var]=np.nan*np.ones((len(datasets),len(depths)))
+        for n,data in enumerate(datasets):
+            mask=~np.isnan(data[var].values[0])
+            original[var][n]=interpolate_data(data,var,depths,mask)
+    t_original=time.perf_counter()-start
+
+    start=time.perf_counter()
+    stack=dict((var,pad_profiles([data[var].values[0] for data in datasets])) for var in variables)
+    depth=pad_profiles([np.ravel(data['DEPTH'].values) for data in datasets])
+    lat=np.array([data['LATITUDE'].values[0] for data in datasets])
+    lon=np.array([data['LONGITUDE'].values[0] for data in datasets])
+    batch=interpolate_variables(stack,depth,depths,lat,lon)
+    t_batch=time.perf_counter()-start
+
+    print('interpolate_data: %.1f profiles/s' %(len(datasets)/max(t_original,1e-9)))
+    print('interpolate_variables: %.1f profiles/s' %(len(datasets)/max(t_batch,1e-9)))
+    diff=dict((var,np.nanmax(np.abs(original[var]-batch[var]),initial=0)) for var in variables)
+    print('Largest differences: ', diff)
+
+    return t_original,t_batch,diff
+
+
+def benchmark_qc(datasets,variable='CHLA'):
+    '''Time quality_control, dataset_qc and a single batched qc_codes call on a
+    list of (already loaded) profile datasets and check that all three give
+    the same codes.'''
+    from bgc_argo_data_process_public import quality_control
+
+    timings={}
+    start=time.perf_counter()
+    original=[quality_control(data,variable)[0] for data in datasets]
+    timings['quality_control']=time.perf_counter()-start
+
+    start=time.perf_counter()
+    single=[dataset_qc(data,variable) for data in datasets]
+    timings['dataset_qc']=time.perf_counter()-start
+
+    start=time.perf_counter()
+    stack={}
+    for var in ['PRES',variable,'CHLA']:
+        stack[var]=pad_profiles([data[var].values[0] for data in datasets])
+    batch=qc_codes(stack['PRES'],stack[variable],stack['CHLA'],
+                   [data['LATITUDE'].values[0] for data in datasets],
+                   [data['LONGITUDE'].values[0] for data in datasets])
+    timings['qc_codes']=time.perf_counter()-start
+
+    agree=original==single==list(batch)
+    for k in timings:
+        print('%s: %.1f profiles/s' %(k,len(datasets)/max(timings[k],1e-9)))
+    print('Same QC codes: ', agree)
+
+    return timings,agree
@@ -0,0 +1,142 @@
+'''This code keeps the raw (not yet interpolated) profiles used by
+"bgc_argo_data_process_public.py" in a single archive file, so that QC and
+gridding experiments do not have to reopen hundreds of thousands of
+individual profile files. The archive is a netCDF file using the CF
+"contiguous ragged array" layout: the levels of all profiles are stored one
+after the other along an "obs" dimension, and a row_size variable gives the
+number of levels of each profile. The obs dimension has a fixed size, so
+each variable is one contiguous block in the file; the levels are kept in
+scratch files while the archive is built and copied in when it is finished,
+so the archive file only appears once it is complete. Profile rows line up
+with the file list that was used to build the archive, and profiles that
+were skipped (no CHLA data) have a row_size of 0 and a STATUS code. The file
+is written in netCDF3 (64-bit offset) format so that it can be memory mapped
+(scipy.io.netcdf_file with mmap=True), and any set of profiles can be
+gathered into padded 2D arrays without a loop over the profiles. This code
+was written by PhD student Rosalind Echols.
+'''
+
+import os
+import numpy as np
+import netCDF4
+
+#STATUS codes for the profile rows
+status_codes={'archived':0,'skip_file':1,'no_chla_variable':2,'all_nan_chla':3}
+
+
+def create_archive(archive_file,n_profiles,obs_vars,profile_vars,dtype='f4',name_length=32):
+    '''Start an archive for n_profiles profiles. obs_vars are stored for every
+    level (as dtype; the GDAC files store float32, so 'f4' keeps the values
+    exactly), profile_vars (float64) once per profile. Returns a dictionary
+    for append_rows and finish_archive; units and attrs can be set in it.'''
+    writer={'file':archive_file,'n_profiles':n_profiles,'dtype':np.dtype(dtype),
+            'name_length':name_length,'n_written':0,'units':{},'attrs':{}}
+    writer['row_size']=np.zeros(n_profiles,dtype='i4')
+    writer['STATUS']=-np.ones(n_profiles,dtype='i1')
+    writer['FILE']=np.zeros((n_profiles,name_length),dtype='S1')
+    writer['profile']=dict((var,np.nan*np.ones(n_profiles)) for var in profile_vars)
+    #the levels of each obs variable are appended to their own scratch file
+    #until the total number of levels is known
+    writer['spool']=dict((var,open('%s.%s.part' %(archive_file,var),'wb')) for var in obs_vars)
+    return writer
+
+
+def append_rows(writer,start,records):
+    '''Write records (dictionaries with a 'status' code, a 'name' and, for
+    archived profiles, 'obs' and 'profile' dictionaries of values) to the
+    profile rows from start onwards, appending their levels to the obs
+    variables.'''
+    name_length=writer['name_length']
+    for i,record in enumerate(records):
+        row=start+i
+        writer['STATUS'][row]=record['status']
+        name=record['name'].encode()[:name_length].ljust(name_length,b'\x00')
+        writer['FILE'][row]=np.frombuffer(name,dtype='S1')
+        if record['status']!=0:
+            continue
+        size=len(record['obs']['PRES'])
+        writer['row_size'][row]=size
+        for var,fp in writer['spool'].items():
+            np.asarray(record['obs'].get(var,np.nan*np.ones(size)),dtype=writer['dtype']).tofile(fp)
+        for var,value in record['profile'].items():
+            writer['profile'][var][row]=value
+    writer['n_written']=start+len(records)
+    return writer['n_written']
+
+
+def finish_archive(writer,block=2**24):
+    '''Write the archive file. The obs dimension is fixed (not unlimited), so
+    that each obs variable is a single contiguous block in the file rather
+    than interleaved with the others record by record; the levels are copied
+    from the scratch files block values at a time.'''
+    n_obs=int(writer['row_size'].sum(dtype=np.int64))
+    part=writer['file']+'.part'
+    nc=netCDF4.Dataset(part,'w',format='NETCDF3_64BIT_OFFSET')
+    nc.set_fill_off()
+    nc.createDimension('profile',writer['n_profiles'])
+    #(a size of 0 would make the dimension unlimited)
+    nc.createDimension('obs',max(n_obs,1))
+    nc.createDimension('name_length',writer['name_length'])
+    row_size=nc.createVariable('row_size','i4',('profile',))
+    row_size.sample_dimension='obs'
+    row_size[:]=writer['row_size']
+    nc.createVariable('STATUS','i1',('profile',))[:]=writer['STATUS']
+    nc.createVariable('FILE','S1',('profile','name_length'))[:]=writer['FILE']
+    for var,values in writer['profile'].items():
+        nc.createVariable(var,'f8',('profile',),fill_value=np.nan)[:]=values
+    for var,fp in writer['spool'].items():
+        fp.close()
+        nc.createVariable(var,writer['dtype'],('obs',),fill_value=np.nan)
+    for var,units in writer['units'].items():
+        nc[var].units=units
+    nc.featureType='profile'
+    nc.n_written=writer['n_written']
+    for name,value in writer['attrs'].items():
+        nc.setncattr(name,value)
+    for var,fp in writer['spool'].items():
+        with open(fp.name,'rb') as src:
+            for n in range(0,n_obs,block):
+                nc[var][n:min(n+block,n_obs)]=np.fromfile(src,dtype=writer['dtype'],count=block)
+        os.remove(fp.name)
+    nc.close()
+    os.replace(part,writer['file'])
+    return n_obs
+
+
+def open_archive(archive_file):
+    '''Open an archive with memory mapping. Returns a dictionary of the
+    (memory mapped) variables, the offset of each profile in the obs
+    dimension, and the file names and attributes.'''
+    from scipy.io import netcdf_file
+    nc=netcdf_file(archive_file,'r',mmap=True,maskandscale=False)
+    archive=dict((var,nc.variables[var].data) for var in nc.variables if var!='FILE')
+    archive['attrs']=dict((k.decode() if isinstance(k,bytes) else k,v) for k,v in nc._attributes.items())
+    archive['units']=dict((var,nc.variables[var].units.decode()) for var in nc.variables
+                          if hasattr(nc.variables[var],'units'))
+    archive['FILE']=np.array([b''.join(row).decode().rstrip('\x00') for row in nc.variables['FILE'].data])
+    archive['offset']=np.concatenate([[0],np.cumsum(archive['row_size'],dtype=np.int64)])
+    archive['file']=nc
+    return archive
+
+
+def gather(archive,var,rows,n_levels=None):
+    '''Padded 2D array (rows, levels) of an obs variable for the given profile
+    rows, filled with nans past the end of each profile.'''
+    rows=np.asarray(rows)
+    sizes=archive['row_size'][rows]
+    if n_levels is None:
+        n_levels=max(int(sizes.max()) if len(rows) else 0,1)
+    levels=np.arange(n_levels)[None,:]
+    inside=levels<sizes[:,None]
+    index=np.where(inside,archive['offset'][rows][:,None]+levels,0)
+    values=np.asarray(archive[var][index.ravel()] if len(archive[var]) else np.zeros(index.size),
+                      dtype=float).reshape(index.shape)
+    values[~inside]=np.nan
+    return values
+
+
+def close_archive(archive):
+    #drop the references to the memory mapped arrays before closing the file
+    nc=archive.pop('file')
+    archive.clear()
+    nc.close()
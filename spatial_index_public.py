@@ -0,0 +1,72 @@
+'''This code bins profiles into a latitude/longitude grid (e.g. 1x1 or 5x5
+degree boxes) in a single vectorized pass, for the test subsets used to choose
+the number of clusters in "GMM_Public.ipynb" (one randomly chosen profile from
+each box) and for the maps of the number of profiles in each box in
+"GMM_figures.ipynb". The index stores the profiles sorted by box with the
+start of each box, so the profiles in any box can be looked up directly, and
+random draws of one profile per box (seeded, so test subsets can be
+reproduced) need no loop over the boxes. This code was written by PhD student
+Rosalind Echols.
+'''
+
+import numpy as np
+
+
+def grid_index(lat,lon,resolution=1.,lat_min=-90.,lat_max=90.,lon_min=-180.,lon_max=180.):
+    '''Index of the profiles at lat, lon in a grid of resolution degree boxes
+    from lat_min to lat_max and lon_min to lon_max. Boxes include their
+    southern and western edges (profiles exactly on lat_max or lon_max go in
+    the last box); profiles outside the grid, or without a position, are not
+    in any box (cell -1). Cells are numbered row by row from the south-west
+    corner: cell=row*n_lon+column.'''
+    lat=np.asarray(lat,dtype=float)
+    lon=np.asarray(lon,dtype=float)
+    n_lat=int(round((lat_max-lat_min)/resolution))
+    n_lon=int(round((lon_max-lon_min)/resolution))
+    with np.errstate(invalid='ignore'):
+        row=np.floor((lat-lat_min)/resolution)
+        column=np.floor((lon-lon_min)/resolution)
+        row[lat==lat_max]=n_lat-1
+        column[lon==lon_max]=n_lon-1
+        inside=(row>=0)&(row<n_lat)&(column>=0)&(column<n_lon)
+    cell=np.where(inside,np.nan_to_num(row)*n_lon+np.nan_to_num(column),-1).astype(int)
+
+    #profiles sorted by cell (in their original order within each cell), and
+    #where each cell starts in the sorted list
+    order=np.argsort(cell,kind='stable')
+    order=order[cell[order]>=0]
+    starts=np.searchsorted(cell[order],np.arange(n_lat*n_lon+1))
+    return {'cell':cell,'order':order,'starts':starts,'n_lat':n_lat,'n_lon':n_lon,
+            'resolution':resolution,'lat_edges':lat_min+resolution*np.arange(n_lat+1),
+            'lon_edges':lon_min+resolution*np.arange(n_lon+1)}
+
+
+def cell_counts(index):
+    #(n_lat, n_lon) array of the number of profiles in each box
+    return np.diff(index['starts']).reshape(index['n_lat'],index['n_lon'])
+
+
+def cell_profiles(index,cell):
+    #indices of the profiles in a cell (a cell number, or a (row, column) pair)
+    if isinstance(cell,tuple):
+        cell=cell[0]*index['n_lon']+cell[1]
+    return index['order'][index['starts'][cell]:index['starts'][cell+1]]
+
+
+def occupied_cells(index):
+    #cell numbers of the boxes with at least one profile, in order
+    return np.flatnonzero(np.diff(index['starts'])>0)
+
+
+def sample_cells(index,draws=20,seed=None):
+    '''Choose one profile at random from each box with data, draws times
+    (independently, so a box with one profile gives the same profile in every
+    draw). Returns a (draws, number of boxes with data) array of profile
+    indices, with the boxes in cell order. The same seed gives the same
+    draws.'''
+    rng=np.random.default_rng(seed)
+    cells=occupied_cells(index)
+    starts=index['starts'][cells]
+    sizes=index['starts'][cells+1]-starts
+    picks=starts[None,:]+(rng.random((draws,len(cells)))*sizes[None,:]).astype(int)
+    return index['order'][picks]
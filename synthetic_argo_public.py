@@ -0,0 +1,213 @@
+'''This code writes synthetic BGC Argo profile files that look like the
+synthetic (S) profile files from the GDAC, so that the processing in
+"bgc_argo_float_list_public.py" and "bgc_argo_data_process_public.py" can be
+tested and timed without the full local copy of the GDAC. Each file holds a
+single profile of PRES, TEMP, PSAL, DOXY, NITRATE and CHLA (and, for some
+floats, the _ADJUSTED variables) with LATITUDE, LONGITUDE and JULD, in the
+same layout (N_PROF, N_LEVELS) and with the same fill values as the real files.
+Profiles are drawn from a set of "kinds": realistic profiles that pass QC, and
+profiles with missing positions, shallow, coarse or sparse sampling, high
+deep chlorophyll, negative data, missing CHLA or spikes, which trigger each of
+the QC codes and rejection branches. Delayed mode (SD) files can be duplicated
+with a real time (SR) file, and descending (D) profiles can be added, to
+exercise the file list. This code was written by PhD student Rosalind Echols.
+'''
+
+import os
+import csv
+import itertools
+import numpy as np
+import netCDF4
+from concurrent.futures import ProcessPoolExecutor
+
+fill_value=99999.
+juld_units='days since 1950-01-01 00:00:00'
+
+#QC code expected from quality_control for each kind of profile (None: the
+#file is skipped before QC because it has no CHLA data). 'spike' profiles pass
+#QC but are removed by the check after interpolation. 'sparse' profiles pass
+#the pressure checks with only a few levels: the gap check (qc 3) only looks
+#above the first level at or below 200 dbar, so e.g. PRES of 5, 10, 200 and
+#300 passes it, and the profile is rejected for having 10 points or fewer.
+kind_qc={'good':0,'black_sea':0,'no_position':1,'shallow':2,'coarse':3,'sparse':4,'deep_chla':5,
+         'negative':6,'spike':0,'no_chla':None,'nan_chla':None}
+
+#default mix of profile kinds (fractions of all profiles)
+default_kinds={'good':0.73,'black_sea':0.03,'no_position':0.02,'shallow':0.04,'coarse':0.05,
+               'sparse':0.02,'deep_chla':0.02,'negative':0.02,'spike':0.02,'no_chla':0.03,
+               'nan_chla':0.02}
+
+
+def pressure_levels(rng,kind):
+    #high resolution in the upper 300 dbar, coarser below, as for most BGC floats
+    top=rng.uniform(0.5,5)
+    if kind=='sparse':
+        #two levels near the surface, then one just below 200 dbar and a few deeper
+        upper=[top,top+rng.uniform(3,15)]
+        lower=np.sort(rng.uniform(250,2000,int(rng.integers(2,7))))
+        return np.concatenate([upper,[rng.uniform(200,210)],lower])
+    if kind=='shallow':
+        return np.arange(top,rng.uniform(60,190),rng.uniform(1,5))
+    step=rng.uniform(21,40) if kind=='coarse' else rng.uniform(1,5)
+    upper=np.arange(top,300,step)
+    lower=np.arange(upper[-1]+rng.uniform(10,25),rng.uniform(1000,2000),rng.uniform(10,50))
+    return np.concatenate([upper,lower])
+
+
+def make_profile(rng,kind='good',gap_fraction=0.1,lat=None,lon=None):
+    '''Make a dictionary with the variables of a single profile of the given
+    kind. About gap_fraction/2 of the data points of each variable are missing
+    (NaN).'''
+    pres=pressure_levels(rng,kind)
+    n=len(pres)
+    depth=pres*0.99
+
+    #mixed layer over an exponential thermocline, with matching salinity,
+    #oxygen and nitrate profiles
+    mld=rng.uniform(10,120)
+    below=np.clip(depth-mld,0,None)
+    sst=rng.uniform(5,29)
+    temp=3+(sst-3)*np.exp(-below/rng.uniform(100,400))+rng.normal(0,0.02,n)
+    psal=rng.uniform(33.5,36.5)+0.3*(1-np.exp(-below/300))+rng.normal(0,0.005,n)
+    doxy=rng.uniform(180,300)-rng.uniform(50,150)*(1-np.exp(-below/200))+rng.normal(0,1,n)
+    nitrate=rng.uniform(0,5)+rng.uniform(15,40)*(1-np.exp(-below/300))+rng.normal(0,0.2,n)
+
+    #chlorophyll: mixed layer value and/or a deep chlorophyll maximum, decaying
+    #to a small background (dark) value with sensor noise. The background is
+    #not negative: with a shallow mixed layer and a weak, narrow maximum almost
+    #every level is background, and a negative one would give qc 6
+    surface=rng.uniform(0.02,1.5)*(depth<=mld)
+    dcm=rng.uniform(0,2)*np.exp(-(depth-rng.uniform(20,150))**2/(2*rng.uniform(5,30)**2))
+    chla=np.clip(surface+dcm,0,None)*np.exp(-np.clip(depth-250,0,None)/50)
+    chla+=rng.uniform(0,0.03)+rng.normal(0,0.003,n)
+
+    if kind=='deep_chla':
+        chla[pres>200]+=rng.uniform(0.4,1)
+    elif kind=='negative':
+        chla=-np.abs(chla)-0.01
+    elif kind=='spike':
+        #a block of impossible values that survives the median filter
+        start=int(np.searchsorted(pres,rng.uniform(20,100)))
+        chla[start:start+20]=rng.uniform(150,500)
+
+    #single missing points (never two in a row, or the first point), so that
+    #gaps alone do not change the QC code of a profile
+    profile={'PRES':pres,'TEMP':temp,'PSAL':psal,'DOXY':doxy,'NITRATE':nitrate,'CHLA':chla}
+    for var in ['TEMP','PSAL','DOXY','NITRATE','CHLA']:
+        profile[var][(rng.random(n)<gap_fraction)&(np.arange(n)%2==1)]=np.nan
+    if kind=='nan_chla':
+        profile['CHLA'][:]=np.nan
+    elif kind=='no_chla':
+        del profile['CHLA']
+
+    if kind=='black_sea':
+        lat,lon=rng.uniform(42,45),rng.uniform(30,40)
+    if lat is None:
+        lat=rng.uniform(-70,70)
+    if lon is None:
+        lon=rng.uniform(-180,180)
+    if kind=='no_position':
+        lat,lon=np.nan,np.nan
+    profile['LATITUDE']=lat
+    profile['LONGITUDE']=lon
+    profile['JULD']=rng.uniform(18000,26000)
+    return profile
+
+
+def add_adjusted(rng,profile,all_nan=False):
+    #delayed mode style adjusted variables (e.g. CHLA divided by 2), or
+    #adjusted variables that are present but empty
+    for var,scale in [('TEMP',1.),('PSAL',1.),('DOXY',1.05),('NITRATE',1.),('CHLA',0.5)]:
+        if var in profile:
+            profile[var+'_ADJUSTED']=np.nan*profile[var] if all_nan else profile[var]*scale
+    return profile
+
+
+def write_profile(file_path,profile):
+    '''Write a profile dictionary to a netCDF file in the same layout as the
+    GDAC synthetic profile files (netCDF classic format).'''
+    with netCDF4.Dataset(file_path,'w',format='NETCDF3_CLASSIC') as nc:
+        nc.createDimension('N_PROF',1)
+        nc.createDimension('N_LEVELS',len(profile['PRES']))
+        for var in profile:
+            if var in ['LATITUDE','LONGITUDE','JULD']:
+                v=nc.createVariable(var,'f8',('N_PROF',),fill_value=fill_value)
+                if var=='JULD':
+                    v.units=juld_units
+                    v.calendar='standard'
+            else:
+                v=nc.createVariable(var,'f4',('N_PROF','N_LEVELS'),fill_value=fill_value)
+            value=np.atleast_1d(np.asarray(profile[var],dtype=float))
+            v[:]=np.ma.masked_invalid(value[None] if v.ndim==2 else value)
+
+
+def archive_plan(n_profiles,seed=0,profiles_per_float=100,kinds=None,duplicate_fraction=0.1,
+                 descending_fraction=0.02,adjusted_fraction=0.5,gap_fraction=0.1):
+    '''List of (file name, kind, seed, options) for an archive of about
+    n_profiles profiles, grouped into floats of profiles_per_float cycles.'''
+    rng=np.random.default_rng(seed)
+    kinds=kinds or default_kinds
+    names=list(kinds)
+    weights=np.array([kinds[k] for k in names],dtype=float)
+    n_floats=max(1,int(np.ceil(n_profiles/profiles_per_float)))
+    plan=[]
+    for f in range(n_floats):
+        number=5900000+f
+        adjusted=rng.random()<adjusted_fraction
+        lat,lon=rng.uniform(-70,70),rng.uniform(-180,180)
+        for cycle in range(1,min(profiles_per_float,n_profiles-f*profiles_per_float)+1):
+            kind=names[rng.choice(len(names),p=weights/weights.sum())]
+            s=int(rng.integers(2**31))
+            options={'lat':lat+rng.normal(0,0.5),'lon':lon+rng.normal(0,0.5),
+                     'gap_fraction':gap_fraction,'adjusted':adjusted}
+            mode='SD' if adjusted else 'SR'
+            plan.append(('%s%d_%03d.nc' %(mode,number,cycle),kind,s,options))
+            if mode=='SD' and rng.random()<duplicate_fraction:
+                plan.append(('SR%d_%03d.nc' %(number,cycle),kind,s,dict(options,adjusted=False)))
+            if rng.random()<descending_fraction:
+                plan.append(('%s%d_%03dD.nc' %(mode,number,cycle),kind,s+1,options))
+    return plan
+
+
+def write_planned(path,plan):
+    for name,kind,s,options in plan:
+        rng=np.random.default_rng(s)
+        profile=make_profile(rng,kind,options['gap_fraction'],options['lat'],options['lon'])
+        if options['adjusted']:
+            add_adjusted(rng,profile)
+        write_profile(os.path.join(path,name),profile)
+    return len(plan)
+
+
+def make_archive(path,n_profiles,seed=0,workers=None,chunksize=200,**kwargs):
+    '''Write a synthetic archive of about n_profiles profiles (plus SR
+    duplicates and descending profiles) to path, along with "expected.csv",
+    which lists the kind and expected QC code of every file, and
+    "float_list.txt", which lists the float numbers. Keyword arguments are
+    passed to archive_plan. Returns the plan.'''
+    os.makedirs(path,exist_ok=True)
+    plan=archive_plan(n_profiles,seed=seed,**kwargs)
+    chunks=[plan[n:n+chunksize] for n in range(0,len(plan),chunksize)]
+    if workers==1:
+        for chunk in chunks:
+            write_planned(path,chunk)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(write_planned,itertools.repeat(path),chunks))
+
+    with open(os.path.join(path,'expected.csv'),'w',newline='') as fp:
+        out=csv.writer(fp)
+        out.writerow(['file','kind','qc'])
+        for name,kind,s,options in plan:
+            out.writerow([name,kind,'' if kind_qc[kind] is None else kind_qc[kind]])
+    with open(os.path.join(path,'float_list.txt'),'w') as fp:
+        fp.write('\n'.join(sorted(set(name[2:9] for name,kind,s,options in plan))))
+
+    return plan
+
+
+def read_expected(path):
+    #dictionary of file name: (kind, expected QC code or None)
+    with open(os.path.join(path,'expected.csv')) as fp:
+        return dict((row['file'],(row['kind'],int(row['qc']) if row['qc'] else None))
+                    for row in csv.DictReader(fp))